@@ -28,7 +28,7 @@ async def admin_user_list(user=Depends(current_superuser)):
 async def search_stocks(keyword: str, user=Depends(current_superuser)):
     url = 'https://searchadapter.eastmoney.com/api/suggest/get'
     params = {'type': '14', 'markettype': '', 'mktnum': '', 'jys':'', 'classify': '', 'securitytype':'', 'status': '', 'count': '10', 'input': keyword}
-    response = net.fetch_url(url, params=params)
+    response = await net.fetch_url_async(url, params=params)
     searched = json.loads(response)['QuotationCodeTable']
     if searched['Status'] != 0 or searched['TotalCount'] < 1:
         return []
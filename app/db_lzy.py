@@ -1,6 +1,8 @@
 from typing import AsyncGenerator
 from functools import cached_property
-from sqlalchemy import select, delete, func, or_
+from sqlalchemy import select, insert, update, delete, func, or_, tuple_, bindparam, UniqueConstraint
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, AsyncEngine
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.lofig import Config
@@ -136,6 +138,22 @@ async def query_group_counts(model, field, *clauses):
         return {row[0]: row[1] for row in result.all()}
 
 
+async def query_group_max(model, field, group_field, *clauses):
+    """
+    查询分组最大值
+    field: 取最大值的字段名称，如 'time'
+    group_field: 分组字段名称，如 'code'
+    返回: 字典，键为分组字段值，值为最大值
+    """
+    async with db.get_async_session() as session:
+        column = getattr(model, field) if isinstance(field, str) else field
+        gcolumn = getattr(model, group_field) if isinstance(group_field, str) else group_field
+        query = select(gcolumn, func.max(column)).group_by(gcolumn)
+        if clauses:
+            query = query.where(*clauses)
+        result = await session.execute(query)
+        return {row[0]: row[1] for row in result.all()}
+
 async def upsert_one(model, data, unique_fields):
     """
     插入或更新单条记录
@@ -162,68 +180,152 @@ async def upsert_one(model, data, unique_fields):
         if updated:
             await session.commit()
 
-async def insert_many(model, data_list, unique_fields=[]):
+def unique_key_matched(model, unique_fields):
+    """
+    unique_fields是否正好是表的主键或唯一约束，是则可以使用数据库原生的upsert
+    """
+    table = model.__table__
+    keysets = [{c.name for c in table.primary_key.columns}]
+    keysets += [{c.name for c in cons.columns} for cons in table.constraints if isinstance(cons, UniqueConstraint)]
+    keysets += [{c.name for c in idx.columns} for idx in table.indexes if idx.unique]
+    return set(unique_fields) in keysets
+
+def group_by_columns(data_list):
+    """
+    按字段集合分组，同一组的记录可以用一条语句批量执行
+    """
+    groups = {}
+    for data in data_list:
+        groups.setdefault(tuple(data.keys()), []).append(data)
+    return groups.items()
+
+async def query_existing(session, model, keys, unique_fields, fields=()):
+    """
+    一次查询多条记录
+    keys: 唯一字段值的元组列表
+    fields: 除唯一字段外需要查询的字段
+    返回: 字典，键为唯一字段值元组，值为记录字典
+    """
+    keycols = [getattr(model, field) for field in unique_fields]
+    if len(keycols) == 1:
+        cond = keycols[0].in_([k[0] for k in keys])
+    else:
+        cond = tuple_(*keycols).in_(keys)
+    cols = keycols + [getattr(model, field) for field in fields if field not in unique_fields]
+    result = await session.execute(select(*cols).where(cond))
+    nkey = len(keycols)
+    return {tuple(row[:nkey]): row._asdict() for row in result.all()}
+
+def upsert_statement(dialect, table, columns, unique_fields):
+    """
+    生成数据库原生的upsert语句: sqlite为INSERT ... ON CONFLICT DO UPDATE, mysql为INSERT ... ON DUPLICATE KEY UPDATE
+    """
+    update_cols = [c for c in columns if c not in unique_fields]
+    if dialect == 'sqlite':
+        stmt = sqlite_insert(table)
+        if not update_cols:
+            return stmt.on_conflict_do_nothing(index_elements=unique_fields)
+        return stmt.on_conflict_do_update(index_elements=unique_fields, set_={c: stmt.excluded[c] for c in update_cols})
+    stmt = mysql_insert(table)
+    update_cols = update_cols or unique_fields[:1]
+    return stmt.on_duplicate_key_update({c: stmt.inserted[c] for c in update_cols})
+
+async def write_upserts(session, model, to_add, to_update, unique_fields):
+    """
+    批量写入新增和修改的记录，同样字段的记录合并为一条语句
+    """
+    table = model.__table__
+    dialect = session.bind.dialect.name
+    if dialect in ('sqlite', 'mysql') and unique_key_matched(model, unique_fields):
+        for columns, rows in group_by_columns(to_add + to_update):
+            await session.execute(upsert_statement(dialect, table, columns, unique_fields), rows)
+        return
+
+    for columns, rows in group_by_columns(to_add):
+        await session.execute(insert(table), rows)
+    for columns, rows in group_by_columns(to_update):
+        update_cols = [c for c in columns if c not in unique_fields]
+        stmt = update(table).where(*[table.c[f] == bindparam(f'k_{f}') for f in unique_fields]).values(
+            {c: bindparam(f'v_{c}') for c in update_cols})
+        params = [{**{f'k_{f}': r[f] for f in unique_fields}, **{f'v_{c}': r[c] for c in update_cols}} for r in rows]
+        await session.execute(stmt, params)
+
+async def insert_many(model, data_list, unique_fields=[], chunk_size=500):
     """
     批量插入多条记录，忽略已存在的记录
     data_list: 字典列表，包含字段和值
     unique_fields: 唯一字段列表，用于判断记录是否存在
+    chunk_size: 每次查询已存在记录的数量
+    返回: 插入的记录数
     """
     if not data_list:
-        return
+        return 0
 
     async with db.get_async_session() as session:
         if not unique_fields:
             to_add = [model(**data) for data in data_list]
             session.add_all(to_add)
             await session.commit()
-            return
-
-        to_add = []
-        for data in data_list:
-            filters = [getattr(model, field) == data[field] for field in unique_fields]
-            existing = await session.execute(select(model).where(*filters))
-            instance = existing.scalar_one_or_none()
-
-            if not instance:
-                to_add.append(model(**data))
+            return len(to_add)
+
+        added = 0
+        seen = set()
+        for i in range(0, len(data_list), chunk_size):
+            chunk = {}
+            for data in data_list[i:i + chunk_size]:
+                key = tuple(data[field] for field in unique_fields)
+                if key not in seen:
+                    seen.add(key)
+                    chunk[key] = data
+            if not chunk:
+                continue
+            existing = await query_existing(session, model, list(chunk.keys()), unique_fields)
+            to_add = [data for key, data in chunk.items() if key not in existing]
+            for columns, rows in group_by_columns(to_add):
+                await session.execute(insert(model.__table__), rows)
+            added += len(to_add)
 
-        if to_add:
-            session.add_all(to_add)
+        if added > 0:
             await session.commit()
+        return added
 
-async def upsert_many_bulk(model, data_list, unique_fields):
+async def upsert_many_bulk(model, data_list, unique_fields, chunk_size=500):
     """
     批量插入或更新多条记录
+    每块记录先一次查询出已存在的记录，比较后只写入新增和有变化的记录，
+    sqlite/mysql使用原生upsert语句写入
     data_list: 字典列表，包含字段和值
     unique_fields: 唯一字段列表，用于判断记录是否存在
+    chunk_size: 每块记录数
+    返回: (插入记录数, 更新记录数)
     """
-    async with db.get_async_session() as session:
-        to_add = []
-        update_count = 0
-        for data in data_list:
-            filters = [getattr(model, field) == data[field] for field in unique_fields]
-            existing = await session.execute(select(model).where(*filters))
-            instance = existing.scalar_one_or_none()
-
-            if not instance:
-                to_add.append(model(**data))
-                continue
+    # 同一唯一键出现多次时以最后一条为准
+    rows = {}
+    for data in data_list:
+        rows[tuple(data[field] for field in unique_fields)] = data
+    rows = list(rows.items())
 
-            updated = False
-            for key, value in data.items():
-                if getattr(instance, key) != value:
-                    setattr(instance, key, value)
-                    updated = True
-            if updated:
-                update_count += 1
-
-        if to_add:
-            session.add_all(to_add)
-
-        if to_add or updated:
+    async with db.get_async_session() as session:
+        add_count, update_count = 0, 0
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            fields = {k for _, data in chunk for k in data.keys()}
+            existing = await query_existing(session, model, [key for key, _ in chunk], unique_fields, fields)
+            to_add, to_update = [], []
+            for key, data in chunk:
+                if key not in existing:
+                    to_add.append(data)
+                elif any(existing[key][k] != v for k, v in data.items()):
+                    to_update.append(data)
+            if to_add or to_update:
+                await write_upserts(session, model, to_add, to_update, unique_fields)
+            add_count += len(to_add)
+            update_count += len(to_update)
+
+        if add_count or update_count:
             await session.commit()
 
-        return len(to_add), update_count
+        return add_count, update_count
 
 async def upsert_many(model, data_list, unique_fields, chunk_size=1000):
     """
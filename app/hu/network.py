@@ -1,22 +1,45 @@
 import requests
 import time
 import json
+import asyncio
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 try:
     import brotli
 except Exception:
     brotli = None
-from typing import Union
+from typing import Union, List, Dict, Callable, Awaitable, Any
 from tenacity import retry, wait_fixed, stop_after_attempt, retry_if_exception_type, wait_exponential
 from . import classproperty
 
 
+# 网络请求的重试策略，同步和异步请求共用
+retry_on_network_error = dict(
+    wait=wait_exponential(multiplier=1, min=1, max=5),
+    stop=stop_after_attempt(3),
+    retry=retry_if_exception_type((requests.Timeout, requests.HTTPError, requests.ConnectionError)))
+
+
 class Network:
+    # 每个host的连接池大小，也是异步请求的最大并发数
+    pool_size = 16
+    timeout = 10
+
     @classproperty
     def session(cls) -> requests.Session:
         session = requests.Session()
         session.headers.update(cls.headers)
+        adapter = HTTPAdapter(pool_connections=cls.pool_size, pool_maxsize=cls.pool_size, pool_block=True)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
         return session
 
+    @classproperty
+    def executor(cls) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=cls.pool_size, thread_name_prefix='network')
+
     @classproperty
     def headers(cls) -> dict:
         return {
@@ -32,20 +55,24 @@ class Network:
         return {**cls.headers, **headers}
 
     @classmethod
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=5),
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((requests.Timeout, requests.HTTPError, requests.ConnectionError)))
-    def fetch_url(cls, url: str, headers: dict=None, params: dict = None, timeout: int = 10) -> Union[str, None]:
-        if headers is None and params is None:
-            response = cls.session.get(url, timeout=timeout)
-        elif params is None:
-            response = cls.session.get(url, headers=headers, timeout=timeout)
-        elif headers is None:
-            response = cls.session.get(url, params=params, timeout=timeout)
-        else:
-            response = cls.session.get(url, params=params, headers=headers, timeout=timeout)
+    def request(cls, url: str, headers: dict = None, params: dict = None, timeout: int = None) -> requests.Response:
+        """
+        通过连接池发送GET请求，状态码错误时抛出HTTPError
+        """
+        response = cls.session.get(url, headers=headers, params=params, timeout=timeout or cls.timeout)
         response.raise_for_status()
+        return response
+
+    @classmethod
+    async def request_async(cls, url: str, headers: dict = None, params: dict = None, timeout: int = None) -> requests.Response:
+        """
+        在网络线程池中发送GET请求，不阻塞事件循环
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(cls.executor, partial(cls.request, url, headers, params, timeout))
+
+    @staticmethod
+    def response_text(response: requests.Response) -> str:
         if response.headers.get('Content-Encoding') == 'br':
             if not brotli:
                 raise RuntimeError("Brotli compression is not supported. Please install the 'brotli' library.")
@@ -53,18 +80,140 @@ class Network:
             return decompressed.decode('utf-8')
         return response.text
 
+    @classmethod
+    @retry(**retry_on_network_error)
+    def fetch_url(cls, url: str, headers: dict=None, params: dict = None, timeout: int = 10) -> Union[str, None]:
+        return cls.response_text(cls.request(url, headers, params, timeout))
+
+    @classmethod
+    @retry(**retry_on_network_error)
+    async def fetch_url_async(cls, url: str, headers: dict=None, params: dict = None, timeout: int = 10) -> Union[str, None]:
+        return cls.response_text(await cls.request_async(url, headers, params, timeout))
+
+
+class RateLimiter:
+    """按最小间隔限制调用频率，线程安全"""
+
+    def __init__(self, rate: float = 0):
+        """
+        Args:
+            rate: 每秒最多调用次数，0表示不限制
+        """
+        self.interval = 1 / rate if rate and rate > 0 else 0
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """阻塞到允许下一次调用"""
+        if self.interval <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FetchPipeline:
+    """
+    下载/写入流水线
+
+    阻塞的下载函数在线程池中并发执行，不阻塞事件循环；下载结果由单独的写入协程按完成顺序保存，
+    网络等待与磁盘写入重叠。下载中和待写入的批次数有上限，写入慢时暂停提交新的下载。
+    """
+
+    def __init__(self, concurrency: int = 4, rates: Dict[str, float] = None, pending: int = None):
+        """
+        Args:
+            concurrency: 同时下载的批次数
+            rates: 数据源到每秒最多请求次数的映射，未配置的数据源不限制
+            pending: 下载中和待写入的批次数上限，默认为concurrency的2倍
+        """
+        self.concurrency = max(int(concurrency), 1)
+        self.limiters = {src: RateLimiter(rate) for src, rate in (rates or {}).items()}
+        self.pending = pending or self.concurrency * 2
+
+    def limiter(self, source: str) -> RateLimiter:
+        if source not in self.limiters:
+            self.limiters[source] = RateLimiter()
+        return self.limiters[source]
+
+    def fetch(self, source: str, func: Callable, args: tuple):
+        self.limiter(source).wait()
+        return func(*args)
+
+    async def run(self, jobs: List[tuple], save: Callable[[Any], Awaitable]) -> Dict[str, Any]:
+        """
+        执行流水线
+
+        Args:
+            jobs: (数据源, 下载函数, 参数元组)列表
+            save: 保存一个批次下载结果的协程函数，结果为空时不调用
+
+        Returns:
+            统计信息 {'jobs', 'failed': 失败的(job, 异常)列表, 'fetch_seconds', 'save_seconds', 'seconds'}
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.pending)
+        queue = asyncio.Queue()
+        done = object()
+        stats = {'jobs': len(jobs), 'failed': [], 'fetch_seconds': 0.0, 'save_seconds': 0.0}
+        stime = time.time()
+
+        async def fetch_one(executor, job):
+            ftime = time.time()
+            try:
+                result = await loop.run_in_executor(executor, self.fetch, *job)
+            except Exception as e:
+                stats['failed'].append((job, e))
+                result = None
+            stats['fetch_seconds'] += time.time() - ftime
+            await queue.put((job, result))
+
+        async def produce(executor):
+            tasks = []
+            try:
+                for job in jobs:
+                    await slots.acquire()
+                    tasks.append(asyncio.ensure_future(fetch_one(executor, job)))
+                await asyncio.gather(*tasks)
+            finally:
+                await queue.put(done)
+
+        async def write():
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                job, result = item
+                try:
+                    if result:
+                        wtime = time.time()
+                        await save(result)
+                        stats['save_seconds'] += time.time() - wtime
+                except Exception as e:
+                    stats['failed'].append((job, e))
+                finally:
+                    slots.release()
+
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetch') as executor:
+            await asyncio.gather(produce(executor), write())
+        stats['seconds'] = time.time() - stime
+        return stats
+
 
 class EmRequest():
     def __init__(self) -> None:
         self.headers = Network.headers.copy()
 
-    @retry(
-        wait=wait_exponential(multiplier=1, min=1, max=5),
-        stop=stop_after_attempt(3),
-        retry=retry_if_exception_type((requests.Timeout, requests.HTTPError, requests.ConnectionError)))
+    @retry(**retry_on_network_error)
     def getRequest(self, headers=None):
-        rsp = Network.session.get(self.getUrl(), headers=headers)
-        rsp.raise_for_status()
+        return Network.request(self.getUrl(), headers=headers).text
+
+    @retry(**retry_on_network_error)
+    async def getRequestAsync(self, headers=None):
+        rsp = await Network.request_async(self.getUrl(), headers=headers)
         return rsp.text
 
     def getUrl(self):
@@ -78,6 +227,9 @@ class EmRequest():
 
 
 class EmDataCenterRequest(EmRequest):
+    # 已知总页数后同时请求的最大页数
+    concurrency = 4
+
     def __init__(self):
         super().__init__()
         self.page = 1
@@ -92,22 +244,55 @@ class EmDataCenterRequest(EmRequest):
     def getUrl(self):
         pass
 
-    async def getNext(self, headers=None):
-        dcresponse = json.loads(self.getRequest(headers))
+    def getPageUrl(self, page):
+        self.page = page
+        return self.getUrl()
+
+    async def fetchPage(self, page, headers=None):
+        """
+        请求一页数据
+
+        Returns:
+            响应中的result，请求失败返回None
+        """
+        url = self.getPageUrl(page)
+        dcresponse = json.loads(await Network.fetch_url_async(url, headers=headers))
         if not dcresponse['success']:
-            print('EmDataCenterRequest getUrl', self.getUrl())
+            print('EmDataCenterRequest getUrl', url)
             print('EmDataCenterRequest Error, message', dcresponse['message'], 'code', dcresponse['code'])
-            return
-
-        if (dcresponse['result'] and dcresponse['result']['data']):
-            self.fecthed += dcresponse['result']['data']
+            return None
+        return dcresponse['result']
 
-        if (dcresponse['result']['pages'] == self.page):
+    async def savePage(self, result):
+        if result and result['data']:
+            self.fecthed = result['data']
             await self.saveFecthed()
+        self.fecthed = []
+
+    async def getNext(self, headers=None):
+        """
+        请求第一页得到总页数后，并发请求其余页，每页到达后立即保存
+        """
+        start = self.page
+        first = await self.fetchPage(start, headers)
+        if not first:
+            return
+        pages = first['pages']
+        await self.savePage(first)
+
+        sem = asyncio.Semaphore(self.concurrency)
+        async def _fetch(page):
+            async with sem:
+                return await self.fetchPage(page, headers)
 
-        if (dcresponse['result']['pages'] > self.page):
-            self.page += 1
-            await self.getNext(headers)
+        tasks = [asyncio.ensure_future(_fetch(p)) for p in range(start + 1, pages + 1)]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                await self.savePage(await fut)
+        finally:
+            for t in tasks:
+                t.cancel()
+        self.page = max(start, pages)
 
     async def saveFecthed(self):
         print(self.fecthed)
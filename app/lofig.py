@@ -113,6 +113,45 @@ class Config:
             os.makedirs(h5ts)
         return h5dir
 
+    @classmethod
+    def kline_storage(cls):
+        """K线SQLite存储方式: 'tables' 每只股票每种K线一张表, 'partitioned' 每种K线一张表"""
+        return cls.client_config().get('kline_storage', 'tables')
+
+    @classmethod
+    def transaction_storage(cls):
+        """交易数据SQLite存储方式: 'tables' 每只股票一张表逐笔一行, 'blocks' 每只股票每个交易日一个压缩数据块"""
+        return cls.client_config().get('transaction_storage', 'tables')
+
+    @classmethod
+    def kline_fetch_config(cls):
+        """
+        K线批量下载参数: concurrency 同时下载的批次数, batch_size 每批股票数,
+        rates 数据源(stockrt接口名klines/fklines)每秒最多请求次数
+        """
+        cfg = {'concurrency': 4, 'batch_size': 500, 'rates': {}}
+        cfg.update(cls.client_config().get('kline_fetch', {}))
+        return cfg
+
+    @classmethod
+    def sqlite_pragmas(cls):
+        """
+        SQLite连接参数，每次建立连接时以PRAGMA执行，值为None的项不设置。
+        默认WAL日志使API读取不被夜间写入阻塞，synchronous=NORMAL在WAL下只在检查点同步磁盘，
+        mmap_size/cache_size(负数为KiB)减少读取时的系统调用，busy_timeout(毫秒)为等待写锁的时间
+        """
+        cfg = {
+            'busy_timeout': 20000,
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'mmap_size': 268435456,
+            'cache_size': -65536,
+            'temp_store': 'MEMORY',
+            'journal_size_limit': 67108864,
+        }
+        cfg.update(cls.client_config().get('sqlite_pragmas', {}))
+        return cfg
+
     @classmethod
     def database_config(cls):
         return cls.all_configs().get('database', {})
@@ -90,4 +90,16 @@ class MdlZtLead(Base):
 
     __table_args__ = (
         PrimaryKeyConstraint('code', 'date', name='pk_stock_zt_lead_pickup'),
-    )
\ No newline at end of file
+    )
+
+class MdlSelectorCheckpoint(Base):
+    __tablename__ = "stock_selector_checkpoints"
+
+    selector = Column(String(64), nullable=False)
+    code = Column(String(20), nullable=False)
+    time = Column(String(20), nullable=False)  # 已处理的最后一根K线
+    state = Column(String(255), nullable=True)  # 滚动状态，json
+
+    __table_args__ = (
+        PrimaryKeyConstraint('selector', 'code', name='pk_selector_checkpoints'),
+    )
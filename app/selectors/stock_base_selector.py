@@ -1,20 +1,112 @@
+import os
+import json
 import asyncio
+import multiprocessing
 from typing import Optional
 from datetime import datetime
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
 from traceback import format_exc
+import numpy as np
+import stockrt as srt
 from app.lofig import logger
 from app.stock.models import MdlAllStock
 from app.stock.date import TradingDate
 from app.stock.history import Khistory
 from app.stock.schemas import KNode
 from app.db import query_values, query_aggregate, insert_many, upsert_many, or_, array_to_dict_list
+from .models import MdlSelectorCheckpoint
+
+
+# 与KNode字段一致的轻量K线记录，供子进程中的计算使用
+KRow = namedtuple('KRow', ['time', 'open', 'close', 'high', 'low', 'volume', 'amount', 'change', 'change_px', 'amplitude', 'turnover'])
+
+
+def to_krows(kd):
+    """
+    结构化数组转换为KRow列表，缺少的字段填0
+
+    Args:
+        kd: read_kline(columnar=True)返回的结构化数组
+    """
+    names = kd.dtype.names
+    cols = [kd[f].tolist() if f in names else [0] * len(kd) for f in KRow._fields]
+    return [KRow(*row) for row in zip(*cols)]
+
+
+class KlineCache():
+    """
+    运行期内共享的日K线缓存
+
+    按(code, fqt)保存从某个开始日期到最新的连续K线数组，开始日期不早于已缓存开始日期的请求通过切片返回，
+    总字节数超过上限时按最近最少使用淘汰，缓存的数组为只读
+    """
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, code: str, start: str, fqt: int = 0):
+        """
+        Returns:
+            (是否命中, K线数组或None)
+        """
+        key = (code, fqt)
+        entry = self.entries.get(key)
+        if entry is None or start < entry[0]:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        kd = entry[1]
+        if kd is None:
+            return True, None
+        kd = kd[np.searchsorted(kd['time'], start, side='left'):]
+        return True, kd if len(kd) > 0 else None
+
+    def put(self, code: str, start: str, fqt: int, kd) -> None:
+        key = (code, fqt)
+        if key in self.entries:
+            self._remove(key)
+        if kd is not None:
+            kd.flags.writeable = False
+        self.entries[key] = (start, kd)
+        self.nbytes += 0 if kd is None else kd.nbytes
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key) -> None:
+        start, kd = self.entries.pop(key)
+        self.nbytes -= 0 if kd is None else kd.nbytes
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total > 0 else 0
+        return (f'hits: {self.hits}, misses: {self.misses}, hit rate: {rate:.1%}, evictions: {self.evictions}, '
+                f'entries: {len(self.entries)}, size: {self.nbytes / 1024 / 1024:.1f}MB')
 
 
 class StockBaseSelector():
+    # 运行期共享的K线缓存，由kline_cache_scope设置
+    kline_cache: Optional[KlineCache] = None
+    # 作用域内共享的计算进程池，首次使用时创建，退出kline_cache_scope时关闭
+    process_pool: Optional[ProcessPoolExecutor] = None
+    pool_scoped = False
+    # CPU阶段每批处理的股票数，下一批的K线在上一批计算时读取
+    cpu_batch_size = 200
+
     def __init__(self, max_workers: int = 2) -> None:
         self.max_workers = max_workers
+        self.cpu_workers = os.cpu_count() or 1
         self.wkstocks = []
         self.wkselected = []
+        self.checkpoints = {}
+        self.checkpoint_updates = {}
 
     @property
     def db(self):
@@ -32,6 +124,32 @@ class StockBaseSelector():
             self.wkstocks = [[c, date] for c, in stks]
         self.wkselected = []
 
+    async def load_checkpoints(self) -> dict:
+        """
+        读取本选股器各股票的处理进度
+
+        Returns:
+            {code: (最后处理的K线时间, 滚动状态dict)}
+        """
+        rows = await query_values(
+            MdlSelectorCheckpoint, ['code', 'time', 'state'], MdlSelectorCheckpoint.selector == self.__class__.__name__)
+        self.checkpoints = {c: (t, json.loads(st) if st else {}) for c, t, st in rows}
+        self.checkpoint_updates = {}
+        return self.checkpoints
+
+    def update_checkpoint(self, code: str, time: str, state: Optional[dict] = None) -> None:
+        """记录股票的处理进度，post_process之后保存"""
+        self.checkpoints[code] = (time, state or {})
+        self.checkpoint_updates[code] = (time, state or {})
+
+    async def save_checkpoints(self) -> None:
+        if len(self.checkpoint_updates) == 0:
+            return
+        name = self.__class__.__name__
+        values = [{'selector': name, 'code': c, 'time': t, 'state': json.dumps(st)} for c, (t, st) in self.checkpoint_updates.items()]
+        await upsert_many(MdlSelectorCheckpoint, values, ['selector', 'code'])
+        self.checkpoint_updates = {}
+
     async def post_process(self, update=False) -> None:
         """后处理"""
         if len(self.wkselected) > 0:
@@ -48,9 +166,176 @@ class StockBaseSelector():
                 await insert_many(self.db, array_to_dict_list(self.db, self.wkselected), uniq_fields)
 
     async def task_processing(self, item) -> None:
-        """任务处理逻辑"""
+        """任务处理逻辑，定义了task_compute的选股器按 读取K线->计算->合并 依次处理"""
+        if not self.has_cpu_stage():
+            return
+        kd, = await self.load_klines([item])
+        if kd is None:
+            return
+        result = self.task_compute(item, kd, *await self.compute_args(item))
+        await self.task_merge(item, result)
+
+    def kline_request(self, item):
+        """
+        CPU阶段需要的日K线
+
+        Returns:
+            (code, start, fqt)，返回None则跳过该项
+        """
+        return None
+
+    async def compute_args(self, item) -> tuple:
+        """传给task_compute的附加参数，需可pickle"""
+        return ()
+
+    @staticmethod
+    def task_compute(item, kd, *args):
+        """
+        CPU阶段: 在子进程中处理单项任务，只能使用参数，不能访问self和数据库
+
+        Args:
+            item: wkstocks中的一项
+            kd: 日K线结构化数组
+            args: compute_args返回的附加参数
+
+        Returns:
+            计算结果，由task_merge在主进程中合并
+        """
+        return None
+
+    async def task_merge(self, item, result) -> None:
+        """合并task_compute的结果"""
         pass
 
+    def has_cpu_stage(self) -> bool:
+        return type(self).task_compute is not StockBaseSelector.task_compute
+
+    @classmethod
+    @contextmanager
+    def kline_cache_scope(cls, max_bytes: int = 512 * 1024 * 1024):
+        """
+        在作用域内所有选股器共享K线缓存，退出时记录命中统计
+
+        Args:
+            max_bytes: 缓存字节数上限
+        """
+        cache = KlineCache(max_bytes)
+        StockBaseSelector.kline_cache = cache
+        StockBaseSelector.pool_scoped = True
+        try:
+            yield cache
+        finally:
+            StockBaseSelector.kline_cache = None
+            StockBaseSelector.pool_scoped = False
+            pool, StockBaseSelector.process_pool = StockBaseSelector.process_pool, None
+            if pool is not None:
+                # 任务都已完成，不等待子进程退出
+                pool.shutdown(wait=False)
+            logger.info('kline cache released, %s', cache.stats())
+
+    @staticmethod
+    def new_process_pool(max_workers: int) -> ProcessPoolExecutor:
+        """
+        创建计算进程池，子进程由forkserver(不支持时用spawn)启动，不继承主进程的事件循环、数据库连接和缓存
+
+        Args:
+            max_workers: 子进程数
+        """
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+    def acquire_executor(self) -> Optional[ProcessPoolExecutor]:
+        """
+        获取计算进程池，在kline_cache_scope内时所有选股器共用一个进程池
+
+        Returns:
+            进程池，cpu_workers<=1时返回None在主进程中计算
+        """
+        if self.cpu_workers <= 1:
+            return None
+        if not StockBaseSelector.pool_scoped:
+            return self.new_process_pool(self.cpu_workers)
+        if StockBaseSelector.process_pool is None:
+            StockBaseSelector.process_pool = self.new_process_pool(self.cpu_workers)
+        return StockBaseSelector.process_pool
+
+    async def get_kd_array(self, code: str, start: str, fqt: int = 0):
+        if not TradingDate.is_trading_date(start):
+            start = TradingDate.next_trading_date(start)
+        cache = StockBaseSelector.kline_cache
+        if cache is not None:
+            hit, kd = cache.get(code, start, fqt)
+            if hit:
+                return kd
+        kd = await Khistory.read_kline(code, 'd', start=start, fqt=fqt, columnar=True)
+        if kd is None or len(kd) == 0:
+            kd = None
+        if cache is not None:
+            cache.put(code, start, fqt, kd)
+        return kd
+
+    async def load_klines(self, items):
+        """
+        I/O阶段: 读取一批任务的日K线
+
+        Returns:
+            与items对应的结构化数组列表，无数据或不需要处理的为None
+        """
+        async def _load(item):
+            req = self.kline_request(item)
+            if req is None:
+                return None
+            return await self.get_kd_array(*req)
+        return await asyncio.gather(*[_load(item) for item in items])
+
+    async def run_pipeline(self) -> None:
+        """
+        分阶段执行: 主进程按批读取K线，子进程并行计算，结果按wkstocks顺序在主进程合并
+        下一批的读取与上一批的计算重叠进行
+        """
+        loop = asyncio.get_running_loop()
+        compute = type(self).task_compute
+        executor = self.acquire_executor()
+
+        async def _submit(items):
+            klines = await self.load_klines(items)
+            batch = []
+            for item, kd in zip(items, klines):
+                if kd is None:
+                    continue
+                args = await self.compute_args(item)
+                if executor is None:
+                    fut = loop.create_future()
+                    try:
+                        fut.set_result(compute(item, kd, *args))
+                    except Exception as e:
+                        fut.set_exception(e)
+                else:
+                    fut = loop.run_in_executor(executor, compute, item, kd, *args)
+                batch.append((item, fut))
+            return batch
+
+        async def _merge(batch):
+            results = await asyncio.gather(*[f for _, f in batch], return_exceptions=True)
+            for (item, _), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error('error in task_compute %s: %s', item, result)
+                    continue
+                await self.task_merge(item, result)
+
+        try:
+            pending = None
+            for i in range(0, len(self.wkstocks), self.cpu_batch_size):
+                batch = await _submit(self.wkstocks[i:i + self.cpu_batch_size])
+                if pending is not None:
+                    await _merge(pending)
+                pending = batch
+            if pending is not None:
+                await _merge(pending)
+        finally:
+            if executor is not None and executor is not StockBaseSelector.process_pool:
+                await loop.run_in_executor(None, executor.shutdown)
+
     async def start_multi_task(self, date: Optional[str] = None) -> None:
         """
         启动异步任务
@@ -63,7 +348,9 @@ class StockBaseSelector():
 
         ctime = datetime.now()
 
-        if self.max_workers <= 1:
+        if self.has_cpu_stage():
+            await self.run_pipeline()
+        elif self.max_workers <= 1:
             for item in self.wkstocks:
                 await self.task_processing(item)
         else:
@@ -92,10 +379,12 @@ class StockBaseSelector():
 
         # 记录执行时间
         elapsed = datetime.now() - ctime
-        logger.info(f'异步任务完成，工作线程数: {self.max_workers}，耗时: {elapsed}')
+        workers = self.cpu_workers if self.has_cpu_stage() else self.max_workers
+        logger.info(f'异步任务完成，工作线程数: {workers}，耗时: {elapsed}')
 
-        # 后处理
+        # 后处理，选股结果保存后再保存处理进度
         await self.post_process()
+        await self.save_checkpoints()
 
     async def update_pickups(self):
         if getattr(self.db, 'time', None) is not None:
@@ -108,11 +397,38 @@ class StockBaseSelector():
         await self.start_multi_task(mdate)
 
     async def get_kd_data(self, code:str, start:str, fqt:int=0):
-        if not TradingDate.is_trading_date(start):
-            start = TradingDate.next_trading_date(start)
-        kd = await Khistory.read_kline(code, 'd', start=start, fqt=fqt)
-        if kd is None or len(kd) == 0:
+        kd = await self.get_kd_array(code, start, fqt)
+        if kd is None:
             return None
+        names = kd.dtype.names
+        return self.to_knodes([dict(zip(names, row)) for row in kd.tolist()])
+
+    async def get_kd_data_batch(self, starts: dict, end: str):
+        """
+        一次查询读取多只股票的日K数据
+
+        Args:
+            starts: {code: 开始日期}
+            end: 结束日期
+
+        Returns:
+            {code: KNode列表}，没有数据的股票不包含在内
+        """
+        if len(starts) == 0:
+            return {}
+        fcodes = {srt.get_fullcode(c): c for c in starts}
+        kd = await Khistory.read_cross_section(min(starts.values()), end, list(fcodes.keys()))
+        rows = {}
+        names = kd.dtype.names
+        for row in kd.tolist():
+            kl = dict(zip(names, row))
+            c = fcodes[kl.pop('code')]
+            if kl['time'] >= starts[c]:
+                rows.setdefault(c, []).append(kl)
+        return {c: self.to_knodes(kl) for c, kl in rows.items()}
+
+    @staticmethod
+    def to_knodes(kd):
         def safe_get(record, field_name, default=0.0):
             return record.get(field_name, default)
 
@@ -130,7 +446,8 @@ class StockBaseSelector():
             turnover=safe_get(kl, 'turnover', 0)
         ) for kl in kd]
 
-    def check_lbc(self, allkl, zdf=10):
+    @staticmethod
+    def check_lbc(allkl, zdf=10):
         lbc, fid, lid = 0, 0, 0
         mxlbc, mxfid, mxlid = 0, 0, 0
         for i in range(0, len(allkl)):
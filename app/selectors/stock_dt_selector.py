@@ -79,8 +79,9 @@ class StockDtMap(StockBaseSelector):
                 if code not in self.dtdtl:
                     self.dtdtl[code] = await self.getdtl(code, step)
 
-                dtl = self.dtdtl[code]
-                kd = await self.get_kd_data(code, start=dtl[-1]['date'])
+            kdmap = await self.get_kd_data_batch({code: self.dtdtl[code][-1]['date'] for code, *_ in premap}, nxdate)
+            for code, step, suc in premap:
+                kd = kdmap.get(code)
                 if not kd:
                     continue
                 lkl = [k for k in kd if k.time == nxdate]
@@ -4,7 +4,7 @@ from app.stock.models import MdlStockBkMap
 from app.stock.date import TradingDate
 from app.db import query_values, upsert_one, upsert_many, delete_records
 from .models import Mdl3Bull
-from .stock_base_selector import StockBaseSelector
+from .stock_base_selector import StockBaseSelector, to_krows
 
 
 class StockTrippleBullSelector(StockBaseSelector):
@@ -102,21 +102,37 @@ class StockTrippleBullSelector(StockBaseSelector):
                 j += 1
             return allkl[j if j < len(allkl) else -1].time
 
-    async def task_processing(self, item):
+    def kline_request(self, item):
         c, sdate = item
         if c in self.blockedst:
-            return
+            return None
         kdate = (datetime.strptime(sdate, r'%Y-%m-%d') + timedelta(days=-12)).strftime(r"%Y-%m-%d")
-        allkl = await self.get_kd_data(c, start=kdate)
-        if allkl is None or len(allkl) == 0:
-            return
+        return c, kdate, 0
+
+    async def compute_args(self, item):
+        c = item[0]
+        return self.nonefdates.get(c), self.maxfdates.get(c)
+
+    @staticmethod
+    def task_compute(item, kd, nonefdate, maxfdate):
+        """
+        Args:
+            nonefdate: 该股票未结束记录的日期
+            maxfdate: 该股票已结束记录的最大结束日期
+
+        Returns:
+            (upstocks, selected, maxfdate)
+        """
+        c, sdate = item
+        allkl = to_krows(kd)
+        upstocks, selected = [], []
 
         i = 0
         while i < len(allkl) and allkl[i].time < sdate:
             i += 1
 
         if i >= len(allkl):
-            return
+            return upstocks, selected, maxfdate
 
         while i < len(allkl):
             if i < 2:
@@ -138,11 +154,12 @@ class StockTrippleBullSelector(StockBaseSelector):
             uprice = max(allkl[i].high, allkl[i-1].high, allkl[i-2].high)
             support = min(allkl[i].low, allkl[i-1].low, allkl[i-2].low)
             fdate = None
+            lowest = min(allkl[i-2].low, allkl[i-1].low, allkl[i].low)
             while j < len(allkl):
                 if allkl[j].high > uprice or allkl[j].change < -0.05:
                     fdate = allkl[j].time
                     break
-                lowest = min([kl.low for kl in allkl[i-2 : j+1]])
+                lowest = min(lowest, allkl[j].low)
                 if (uprice - lowest) / uprice > 0.1:
                     fdate = allkl[j].time
                     break
@@ -152,22 +169,30 @@ class StockTrippleBullSelector(StockBaseSelector):
                 j += 1
 
             if fdate is not None:
-                if c in self.nonefdates:
-                    if self.nonefdates[c] == allkl[i].time:
-                        self.upstocks.append([fdate, c, self.nonefdates[c]])
+                if nonefdate is not None:
+                    if nonefdate == allkl[i].time:
+                        upstocks.append([fdate, c, nonefdate])
                     else:
-                        self.upstocks.append([allkl[i-2].time, c, self.nonefdates[c]])
-                        self.wkselected.append([allkl[i].time, c, 1, allkl[i-2].time, fdate])
-                    self.maxfdates[c] = fdate
+                        upstocks.append([allkl[i-2].time, c, nonefdate])
+                        selected.append([allkl[i].time, c, 1, allkl[i-2].time, fdate])
+                    maxfdate = fdate
                     i = j
                     continue
-            if c not in self.maxfdates or allkl[i-2].time > self.maxfdates[c]:
-                if fdate is not None and (c not in self.maxfdates or self.maxfdates[c] < fdate):
-                    self.maxfdates[c] = fdate
-                if c in self.nonefdates and self.nonefdates[c] != allkl[i].time:
-                    self.upstocks.append([allkl[i-2].time, c, self.nonefdates[c]])
-                self.wkselected.append([allkl[i].time, c, 1, allkl[i-2].time, fdate])
+            if maxfdate is None or allkl[i-2].time > maxfdate:
+                if fdate is not None and (maxfdate is None or maxfdate < fdate):
+                    maxfdate = fdate
+                if nonefdate is not None and nonefdate != allkl[i].time:
+                    upstocks.append([allkl[i-2].time, c, nonefdate])
+                selected.append([allkl[i].time, c, 1, allkl[i-2].time, fdate])
             i = j
+        return upstocks, selected, maxfdate
+
+    async def task_merge(self, item, result):
+        upstocks, selected, maxfdate = result
+        self.upstocks.extend(upstocks)
+        self.wkselected.extend(selected)
+        if maxfdate is not None:
+            self.maxfdates[item[0]] = maxfdate
 
     async def post_process(self):
         await upsert_many(self.db, [dict(zip(['fdate', 'code', 'date'], x)) for x in self.upstocks], ['code', 'date'])
@@ -4,7 +4,7 @@ from app.stock.models import MdlAllStock
 from app.stock.date import TradingDate
 from app.db import query_one_record, query_values, query_aggregate, upsert_one, delete_records
 from .models import MdlZt0hrst0
-from .stock_base_selector import StockBaseSelector
+from .stock_base_selector import StockBaseSelector, to_krows
 from .stock_ztlead_selector import StockHotStocksOpenSelector
 
 
@@ -76,19 +76,22 @@ class StockHotStocksRetryZt0Selector(StockBaseSelector):
                     self.wkstocks.append((c,zd,days,step, 66))
         self.wkstocks = sorted(self.wkstocks, key=lambda x: (x[0], x[1]))
 
-    async def task_processing(self, item):
+    def kline_request(self, item):
         c,d,days,step,rdays = item
-        allkl = await self.get_kd_data(c, TradingDate.prev_trading_date(d, days), fqt=1)
+        return c, TradingDate.prev_trading_date(d, days), 1
+
+    @staticmethod
+    def task_compute(item, kd):
+        c,d,days,step,rdays = item
+        allkl = to_krows(kd)
         post_days = len([x for x in allkl if x.time > d])
         if post_days < 66:
-            self.wkselected.append([d,c,days,step,66-post_days,''])
-            return
+            return [d,c,days,step,66-post_days,'']
         i = 0
         while i < len(allkl) and allkl[i].time < d:
             i += 1
-        if not any([round(x.change, 2) >= 0.1 and x.high == x.close for x in allkl if x.time > d and allkl.index(x) - i < 66]):
-            self.wkselected.append([d,c,days,step,0,allkl[i+66].time])
-            return
+        if not any([round(x.change, 2) >= 0.1 and x.high == x.close for j, x in enumerate(allkl) if x.time > d and j - i < 66]):
+            return [d,c,days,step,0,allkl[i+66].time]
         last_zid = i + 66
         while last_zid > i:
             if round(allkl[last_zid].change, 2) >= 0.1 and allkl[last_zid].high == allkl[last_zid].close:
@@ -107,9 +110,11 @@ class StockHotStocksRetryZt0Selector(StockBaseSelector):
                 break
         fianal_zid = max(fianal_zid, i + 66)
         if fianal_zid >= len(allkl):
-            self.wkselected.append([d,c,days,step,fianal_zid - len(allkl) + 1, ''])
-        else:
-            self.wkselected.append([d,c,days,step,0,allkl[fianal_zid].time])
+            return [d,c,days,step,fianal_zid - len(allkl) + 1, '']
+        return [d,c,days,step,0,allkl[fianal_zid].time]
+
+    async def task_merge(self, item, result):
+        self.wkselected.append(result)
 
     async def post_process(self, update=False):
         return await super().post_process(True)
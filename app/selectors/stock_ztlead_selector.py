@@ -1,18 +1,15 @@
 from typing import Optional
 from app.lofig import logger
 from app.stock import async_lru, zdf_from_code, zt_priceby
-from app.stock.history import srt, StockZtInfo, StockZtInfo10jqka
+from app.stock.history import srt, Khistory, StockZtInfo, StockZtInfo10jqka
 from app.stock.models import MdlAllStock, MdlDayZtStocks, MdlStockBkMap, MdlStockBk, MdlDayDtStocks
 from app.stock.date import TradingDate
-from app.db import query_values, query_one_value, query_aggregate, query_group_counts, array_to_dict_list, upsert_many, or_
+from app.db import query_values, query_one_value, query_aggregate, query_group_counts, query_group_max, array_to_dict_list, upsert_many, or_
 from .models import MdlHotstksOpen, MdlDayZdtEmotion, MdlZtLead
-from .stock_base_selector import StockBaseSelector
+from .stock_base_selector import StockBaseSelector, to_krows
 
 
 class StockZtDaily(StockBaseSelector):
-    def __init__(self):
-        super().__init__(1)
-
     @property
     def db(self):
         return MdlDayZtStocks
@@ -44,8 +41,17 @@ class StockZtDaily(StockBaseSelector):
             self.wkstocks = [[c, date] for c, in stks]
             self.wkselected = []
 
+        # 有处理进度的股票只读取进度之后的K线，全部重算时忽略进度
+        # 进度不早于开始日期(重算较早日期或删除记录后重建)时丢弃进度，否则会跳过这些日期
+        checkpoints = {} if onlycalc else await self.load_checkpoints()
+        lbc1dates = await query_group_max(self.db, 'time', 'code', MdlDayZtStocks.lbc == 1)
         for i, w in enumerate(self.wkstocks):
-            sdate = await query_aggregate('max', self.db, 'time', MdlDayZtStocks.code == w[0], MdlDayZtStocks.lbc == 1)
+            if w[0] in checkpoints:
+                if checkpoints[w[0]][0] < w[1]:
+                    self.wkstocks[i].append(checkpoints[w[0]][0])
+                    continue
+                self.checkpoints.pop(w[0])
+            sdate = lbc1dates.get(w[0])
             if sdate is None or sdate == 0:
                 sdate = ''
             else:
@@ -114,42 +120,69 @@ class StockZtDaily(StockBaseSelector):
         if osel[4] == 1 and osel[5] > 1:
             logger.error(f'error lbc and days: {osel}')
 
-    async def task_processing(self, item):
+    def kline_request(self, item):
         c, zdate, sdate = item
-        allkl = await self.get_kd_data(c, start=sdate)
-        if allkl is None or len(allkl) == 0:
-            return
+        return c, sdate, 0
 
+    async def compute_args(self, item):
+        c = item[0]
         zdf = zdf_from_code(c)
         if zdf == 10 and await self.is_st_stock(c):
             zdf = 5
-        mkt = [10, 20, 30, 5].index(zdf)
+        ckpt = self.checkpoints.get(c)
+        return zdf, ckpt
 
-        i = 0
-        while i < len(allkl):
-            if allkl[i].time < zdate:
-                i += 1
-                continue
-            if i == 0 and allkl[i].close == allkl[i].high and allkl[i].change * 100 >= zdf - 0.1:
-                await self.merge_selected([c, allkl[i].time, 0, 0, 1, 1, 0, "", "", mkt])
-                i += 1
-                continue
+    @staticmethod
+    def task_compute(item, kd, zdf, ckpt=None):
+        """
+        逐根K线更新连板状态，zdate及之后的每个涨停日都记录一条当日的连板数和总天数
+        涨停按zt_priceby计算的涨停价判断(无前收盘价时按涨幅)，连续3根K线不涨停则连板中断重新计数
 
-            c0 = allkl[i-1].close
-            zt_prc = zt_priceby(c0, zdf=zdf)
-            if allkl[i].close == allkl[i].high and (allkl[i].close >= zt_prc or c0 + allkl[i].change_px >= zt_prc):
-                while True:
-                    lbc, fdate, ldate = self.check_lbc(allkl, zdf=zdf)
-                    if TradingDate.calc_trading_days(ldate, zdate) > 4:
-                        allkl = [d for d in allkl if d.time > ldate]
-                        continue
-                    break
-                days = len([d for d in allkl if d.time >= fdate and d.time <= ldate])
-                if lbc == 1 and days != 1:
-                    logger.warning(f'consider wrong lbc: {lbc}, {days}, {item}')
-                    days = 1
-                await self.merge_selected([c, ldate, 0, 0, lbc, days, 0, "", "", mkt])
-            i += 1
+        Args:
+            ckpt: (已处理的最后K线时间, 连板状态)，从该K线之后继续处理
+
+        Returns:
+            (涨停记录列表, (最后K线时间, 连板状态))
+        """
+        c, zdate, sdate = item
+        mkt = [10, 20, 30, 5].index(zdf)
+        ptime, state = ckpt if ckpt else ('', {})
+        lclose = state.get('close')
+        lbc, fdate, days, gap = state.get('lbc', 0), state.get('fdate', ''), state.get('days', 0), state.get('gap', 0)
+
+        selected = []
+        for kl in to_krows(kd):
+            if kl.time <= ptime:
+                lclose = kl.close
+                continue
+            if lclose is None:
+                zt = kl.close == kl.high and kl.change * 100 >= zdf - 0.1
+            else:
+                zt_prc = zt_priceby(lclose, zdf=zdf)
+                zt = kl.close == kl.high and (kl.close >= zt_prc or lclose + kl.change_px >= zt_prc)
+            if zt:
+                if lbc > 0:
+                    lbc += 1
+                    days += gap + 1
+                else:
+                    lbc, fdate, days = 1, kl.time, 1
+                gap = 0
+                if kl.time >= zdate:
+                    selected.append([c, kl.time, 0, 0, lbc, days, 0, "", "", mkt])
+            elif lbc > 0:
+                gap += 1
+                if gap >= 3:
+                    lbc, fdate, days, gap = 0, '', 0, 0
+            lclose = kl.close
+            ptime = kl.time
+        return selected, (ptime, {'close': lclose, 'lbc': lbc, 'fdate': fdate, 'days': days, 'gap': gap})
+
+    async def task_merge(self, item, result):
+        selected, (ptime, state) = result
+        for sel in selected:
+            await self.merge_selected(sel)
+        if ptime:
+            self.update_checkpoint(item[0], ptime, state)
 
     async def get_hot_stocks(self, date):
         zts = await query_values(self.db, ['code', 'time', 'days', 'lbc'], self.db.time >= date, self.db.mkt != 3)
@@ -245,15 +278,11 @@ class StockZdtEmotion(StockBaseSelector):
             row.append(self.daydtcnt[sdate] if sdate in self.daydtcnt else 0)
             amt = 0
             if sdate in self.dayztinfo:
-                for c in self.dayztinfo[sdate]:
-                    allkl = await self.get_kd_data(c, sdate)
-                    if not allkl or len(allkl) == 0:
-                        logger.info(f'no kl data for {c}, {sdate}')
-                        break
-                    if allkl[0].time != sdate:
-                        logger.info(f'invalid kl data for {c}, {sdate}')
-                        break
-                    amt += allkl[0].amount
+                kd = await Khistory.read_cross_section(sdate, codes=self.dayztinfo[sdate])
+                if len(kd) < len(self.dayztinfo[sdate]):
+                    missed = set(srt.get_fullcode(c) for c in self.dayztinfo[sdate]) - set(kd['code'].tolist())
+                    logger.info(f'no kl data for {missed}, {sdate}')
+                amt = float(kd['amount'].sum())
             row.append(amt)
             values.append(row)
             ndate = TradingDate.next_trading_date(sdate)
@@ -0,0 +1,114 @@
+"""复权因子计算"""
+import numpy as np
+
+
+class AdjustFactors:
+    """
+    复权因子表
+
+    由分红送转记录整理出按除权除息日排序的 (日期, 每股送转, 每股派息)，
+    复权时按K线时间定位所在区间，对整列价格做一次仿射变换 p' = a * p + b
+    """
+    price_cols = ('open', 'close', 'high', 'low')
+
+    def __init__(self, bndata=None):
+        """
+        Args:
+            bndata: 分红记录列表，需包含ex_dividend_date, total_bonus, cash_dividend（均为每10股）
+        """
+        events = []
+        for bn in bndata or []:
+            date = bn.ex_dividend_date
+            if not date:
+                continue
+            ratio = float(bn.total_bonus or 0) / 10
+            cash = float(bn.cash_dividend or 0) / 10
+            if ratio == 0 and cash == 0:
+                continue
+            events.append((date, ratio, cash))
+        events.sort()
+        self.dates = np.array([e[0] for e in events], dtype='U20')
+        self.ratios = np.array([e[1] for e in events], dtype=np.float64)
+        self.cashes = np.array([e[2] for e in events], dtype=np.float64)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def _pre_coefs(self, n):
+        """前复权系数，第k项为依次应用第k..n-1次除权的复合变换"""
+        a = np.ones(n + 1)
+        b = np.zeros(n + 1)
+        for k in range(n - 1, -1, -1):
+            ak = 1 / (1 + self.ratios[k])
+            a[k] = a[k + 1] * ak
+            b[k] = a[k + 1] * (-self.cashes[k] * ak) + b[k + 1]
+        return a, b
+
+    def _post_coefs(self):
+        """后复权系数，第k项为依次应用第0..k-1次除权的复合变换"""
+        n = len(self)
+        a = np.ones(n + 1)
+        b = np.zeros(n + 1)
+        for k in range(n):
+            a[k + 1] = a[k] * (1 + self.ratios[k])
+            b[k + 1] = b[k] * (1 + self.ratios[k]) + self.cashes[k]
+        return a, b
+
+    def factors(self, times, fqt):
+        """
+        计算每根K线的复权系数
+
+        Args:
+            times: 按时间升序的K线时间
+            fqt: 1: 前复权 2: 后复权
+
+        Returns:
+            (a, b) 与times等长的数组，复权价格为 a * p + b
+        """
+        times = np.asarray(times, dtype='U20')
+        # 除权日不晚于K线时间的次数
+        idx = np.searchsorted(self.dates, times, side='right')
+        if fqt == 1:
+            # 前复权以最后一根K线为基准，之后的除权不计入
+            n = int(idx[-1]) if len(idx) > 0 else 0
+            a, b = self._pre_coefs(n)
+            idx = np.minimum(idx, n)
+        elif fqt == 2:
+            a, b = self._post_coefs()
+        else:
+            return np.ones(len(times)), np.zeros(len(times))
+        return a[idx], b[idx]
+
+    def apply(self, kldata, fqt):
+        """
+        对K线数据复权
+
+        Args:
+            kldata: 结构化数组、dict列表或列表/元组列表(time, open, close, high, low, ...)
+            fqt: 1: 前复权 2: 后复权
+
+        Returns:
+            复权后的数据，结构化数组返回副本，dict列表原地修改，列表/元组列表返回新的元组列表
+        """
+        if len(self) == 0 or len(kldata) == 0 or fqt not in (1, 2):
+            return kldata
+
+        if isinstance(kldata, np.ndarray):
+            result = kldata.copy()
+            a, b = self.factors(result['time'], fqt)
+            for col in self.price_cols:
+                result[col] = np.round(a * result[col] + b, 3)
+            return result
+
+        if isinstance(kldata[0], dict):
+            a, b = self.factors([kl['time'] for kl in kldata], fqt)
+            for col in self.price_cols:
+                prices = np.array([kl[col] for kl in kldata], dtype=np.float64)
+                for kl, p in zip(kldata, np.round(a * prices + b, 3).tolist()):
+                    kl[col] = p
+            return kldata
+
+        a, b = self.factors([kl[0] for kl in kldata], fqt)
+        prices = np.array([kl[1:5] for kl in kldata], dtype=np.float64)
+        prices = np.round(a[:, None] * prices + b[:, None], 3).tolist()
+        return [(kl[0], *p, *kl[5:]) for kl, p in zip(kldata, prices)]
@@ -1,6 +1,7 @@
 import os
 import json
 import datetime
+from bisect import bisect_left, bisect_right
 from bs4 import BeautifulSoup
 from app.hu import lru_cache, classproperty
 from app.hu.network import Network
@@ -9,17 +10,93 @@ from app.db import query_values, insert_many, array_to_dict_list
 from .models import MdlHolidays
 
 
+class HolidayFile:
+    """节假日列表，holidays.json修改后自动重新加载"""
+    def __init__(self):
+        self._mtime = None
+        self._holidays = []
+
+    def __get__(self, instance, owner):
+        path = owner.holidayfile
+        mtime = os.path.getmtime(path) if os.path.isfile(path) else None
+        if mtime != self._mtime:
+            self._holidays = []
+            if mtime is not None:
+                with open(path, 'r') as f:
+                    self._holidays = json.load(f)
+            self._mtime = mtime
+        return self._holidays
+
+
+class TradingCalendar():
+    """交易日历，按顺序保存所有交易日及其序号，日期运算通过二分查找或序号相减完成"""
+    def __init__(self, holidays, first_date, last_date):
+        """
+        Args:
+            holidays: 节假日列表
+            first_date: 日历第一天
+            last_date: 日历最后一天
+        """
+        self.source = holidays
+        self.source_len = len(holidays)
+        self.holidays = set(holidays)
+        self.first_date = first_date
+        self.last_date = last_date
+        self.days = []
+        d = datetime.datetime.strptime(first_date, '%Y-%m-%d').date()
+        end = datetime.datetime.strptime(last_date, '%Y-%m-%d').date()
+        oneday = datetime.timedelta(days=1)
+        while d <= end:
+            ds = d.isoformat()
+            if d.weekday() < 5 and ds not in self.holidays:
+                self.days.append(ds)
+            d += oneday
+        self.index = {ds: i for i, ds in enumerate(self.days)}
+
+    def built_from(self, holidays):
+        return self.source is holidays and self.source_len == len(holidays)
+
+    def count(self, bdate, edate):
+        """[bdate, edate]之间的交易日数"""
+        return max(bisect_right(self.days, edate) - bisect_left(self.days, bdate), 0)
+
+    def prev(self, date, ndays=1):
+        """date之前第ndays个交易日，超出日历范围返回None"""
+        i = bisect_left(self.days, date) - ndays
+        return self.days[i] if i >= 0 else None
+
+    def next(self, date, ndays=1):
+        """date之后第ndays个交易日，超出日历范围返回None"""
+        i = bisect_right(self.days, date) + ndays - 1
+        return self.days[i] if i < len(self.days) else None
+
+
 class TradingDate():
+    _calendar = None
+
     @classproperty
     def holidayfile(cls):
         return os.path.join(Config.h5_history_dir(), 'holidays.json')
 
-    @classproperty
-    def holidays(cls):
-        if os.path.isfile(cls.holidayfile):
-            with open(cls.holidayfile, 'r') as f:
-                return json.load(f)
-        return []
+    holidays = HolidayFile()
+
+    @classmethod
+    def calendar(cls, upto=None) -> TradingCalendar:
+        """
+        获取交易日历，节假日变化时重建
+
+        Args:
+            upto: 需要覆盖到的日期，超出当前日历时扩展日历
+        """
+        hol = cls.holidays
+        cal = cls._calendar
+        if cal is None or not cal.built_from(hol) or (upto is not None and upto > cal.last_date):
+            year = max(datetime.datetime.now().year + 1, int(max(hol)[:4]) if hol else 0)
+            if upto is not None:
+                year = max(year, int(upto[:4]) + 1)
+            cal = TradingCalendar(hol, cls.min_traded_date(), f'{year}-12-31')
+            cls._calendar = cal
+        return cal
 
     @classproperty
     def tradedayfile(cls):
@@ -66,7 +143,7 @@ class TradingDate():
             return False
         if date == cls.max_trading_date():
             return True
-        return date not in cls.holidays and datetime.datetime.strptime(date, '%Y-%m-%d').weekday() < 5
+        return date in cls.calendar(date).index
 
     @classmethod
     def is_trading_time(cls):
@@ -101,7 +178,7 @@ class TradingDate():
     @lru_cache(maxsize=1)
     def get_today_system_date(cls):
         url = 'http://www.sse.com.cn/js/common/systemDate_global.js'
-        sse = Network.session.get(url)
+        sse = Network.session.get(url, timeout=Network.timeout)
         if sse.status_code == 200:
             if 'var systemDate_global' in sse.text:
                 sys_date = sse.text.partition('var systemDate_global')[2].strip(' =;')
@@ -118,16 +195,16 @@ class TradingDate():
 
     @classmethod
     def is_holiday(cls, date=None):
+        holidays = cls.calendar().holidays
         if not date:
             daynow = datetime.datetime.now()
             date = daynow.strftime('%Y-%m-%d')
-            return date in cls.holidays or daynow.weekday() >= 5
-        if date in cls.holidays or datetime.datetime.strptime(date, '%Y-%m-%d').weekday() >= 5:
+            return date in holidays or daynow.weekday() >= 5
+        if date in holidays or datetime.datetime.strptime(date, '%Y-%m-%d').weekday() >= 5:
             return True
         return False
 
     @classmethod
-    @lru_cache(maxsize=10)
     def prev_trading_date(cls, date, ndays=1):
         """
         获取指定日期前第N个交易日
@@ -137,15 +214,12 @@ class TradingDate():
         """
         if date <= cls.min_traded_date():
             return cls.min_traded_date()
-        d = datetime.datetime.strptime(date, '%Y-%m-%d')
-        while ndays > 0:
-            d -= datetime.timedelta(days=1)
-            if not cls.is_holiday(d.strftime('%Y-%m-%d')):
-                ndays -= 1
-        return d.strftime('%Y-%m-%d')
+        if ndays <= 0:
+            return date
+        pdate = cls.calendar(date).prev(date, ndays)
+        return pdate if pdate is not None else cls.min_traded_date()
 
     @classmethod
-    @lru_cache(maxsize=10)
     def next_trading_date(cls, date, ndays=1):
         """
         获取指定日期后第N个交易日
@@ -155,25 +229,23 @@ class TradingDate():
         """
         if date < cls.min_traded_date():
             return cls.min_traded_date()
-        d = datetime.datetime.strptime(date, '%Y-%m-%d')
-        while ndays > 0:
-            d += datetime.timedelta(days=1)
-            if not cls.is_holiday(d.strftime('%Y-%m-%d')):
-                ndays -= 1
-        return min(d.strftime('%Y-%m-%d'), cls.max_trading_date())
+        if ndays <= 0:
+            return min(date, cls.max_trading_date())
+        cal = cls.calendar(date)
+        ndate = cal.next(date, ndays)
+        if ndate is None:
+            # 超出日历范围，按每年至少200个交易日扩展后重试
+            cal = cls.calendar(f'{int(date[:4]) + ndays // 200 + 1}-12-31')
+            ndate = cal.next(date, ndays)
+        return min(ndate, cls.max_trading_date())
 
     @classmethod
     def recent_trading_dates(cls, n):
         """获取最近N个交易日列表"""
-        dates = [cls.max_trading_date()]
-        d = datetime.datetime.strptime(cls.max_trading_date(), '%Y-%m-%d')
-        while len(dates) < n:
-            d -= datetime.timedelta(days=1)
-            date_str = d.strftime('%Y-%m-%d')
-            if not cls.is_holiday(date_str):
-                dates.append(date_str)
-        dates.reverse()
-        return dates
+        mxdate = cls.max_trading_date()
+        cal = cls.calendar(mxdate)
+        i = cal.index[mxdate]
+        return cal.days[max(i - n + 1, 0): i + 1]
 
     @classmethod
     def calc_trading_days(cls, bdate, edate):
@@ -183,17 +255,11 @@ class TradingDate():
         :param edate: 结束日期
         :return: 交易日数
         """
-        wkdays = 0
         if ' ' in bdate:
             bdate = bdate.split(' ')[0]
         if ' ' in edate:
             edate = edate.split(' ')[0]
-        d = datetime.datetime.strptime(bdate, '%Y-%m-%d')
-        while d <= datetime.datetime.strptime(edate, '%Y-%m-%d'):
-            if cls.is_trading_date(d.strftime('%Y-%m-%d')):
-                wkdays += 1
-            d += datetime.timedelta(days=1)
-        return wkdays
+        return cls.calendar(edate).count(bdate, edate)
 
     @classmethod
     def clear_cache(cls):
@@ -204,8 +270,7 @@ class TradingDate():
     @classmethod
     async def update_holiday(cls):
         url = 'https://www.tdx.com.cn/url/holiday/'
-        response = Network.session.get(url)
-        response.raise_for_status()
+        response = await Network.request_async(url)
         response.encoding = 'gbk'
         soup = BeautifulSoup(response.text, 'html.parser', from_encoding='gbk')
         txt_data = soup.select_one('textarea#data')
@@ -16,6 +16,7 @@ from app.db import (
     upsert_one, upsert_many, insert_many, delete_records)
 from . import dynamic_cache, lru_cache
 from .date import TradingDate
+from .adjust import AdjustFactors
 from .storage.sqlite import kls, fls
 from .models import (
     MdlAllStock, MdlStockList, MdlStockShare,MdlStockBk, MdlStockBkMap, MdlStockChanges, MdlStockBkChanges, MdlStockBkClsChanges,
@@ -23,6 +24,8 @@ from .models import (
 
 
 class Khistory:
+    _adjust_factors = {}
+
     @classproperty
     def stock_bonus_handler(cls):
         return StockShareBonus()
@@ -65,11 +68,15 @@ class Khistory:
         return await kls.get_latest_time(srt.get_fullcode(code), srt.to_int_kltype(kltype))
 
     @classmethod
-    async def count_bars_to_updated(cls, code, kltype=101):
-        kltype = srt.to_int_kltype(kltype)
-        if kltype not in kls.saved_kline_types:
-            return 0
-        mxdate = await cls.max_date(code, kltype)
+    async def max_dates(cls, codes, kltype='d'):
+        """批量获取最新K线时间，返回{code: 最新时间}，没有数据的为None"""
+        fcodes = {c: srt.get_fullcode(c) for c in codes}
+        latest = await kls.latest_times(list(set(fcodes.values())), srt.to_int_kltype(kltype))
+        return {c: latest.get(fc) for c, fc in fcodes.items()}
+
+    @classmethod
+    def bars_to_update(cls, mxdate, kltype=101):
+        """根据已保存的最新时间估算需要更新的K线数量"""
         guessed = cls.guess_bars_since(mxdate, kltype)
         if guessed == sys.maxsize:
             return guessed
@@ -78,33 +85,70 @@ class Khistory:
         return max(guessed, 0)
 
     @classmethod
-    async def read_kline(cls, code, kline_type, fqt=0, length=None, start=None):
-        """从HDF5文件中读取K线数据"""
+    async def count_bars_to_updated(cls, code, kltype=101):
+        kltype = srt.to_int_kltype(kltype)
+        if kltype not in kls.saved_kline_types:
+            return 0
+        mxdate = await cls.max_date(code, kltype)
+        return cls.bars_to_update(mxdate, kltype)
+
+    @classmethod
+    async def count_bars_to_updated_many(cls, codes, kltype=101):
+        """批量估算需要更新的K线数量，只查询一次水位表"""
+        kltype = srt.to_int_kltype(kltype)
+        if kltype not in kls.saved_kline_types:
+            return {c: 0 for c in codes}
+        mxdates = await cls.max_dates(codes, kltype)
+        return {c: cls.bars_to_update(mxdates[c], kltype) for c in codes}
+
+    @classmethod
+    async def read_kline(cls, code, kline_type, fqt=0, length=None, start=None, columnar=False):
+        """
+        读取K线数据
+
+        Args:
+            code: 股票代码
+            kline_type: K线类型
+            fqt: 复权类型 0: 不复权 1: 前复权 2: 后复权
+            length: 读取长度（最新的length条），None或0表示全部
+            start: 开始日期，指定时忽略length
+            columnar: True返回numpy结构化数组，False返回dict列表
+
+        Returns:
+            结构化数组或dict列表，没有数据表时返回None
+        """
         klt = srt.to_int_kltype(kline_type)
         if start is not None:
-            length = cls.guess_bars_since(start, klt)
-            if length == sys.maxsize:
-                length = 0
-            else:
-                length += 1
-        def_len = 0
-        if length is None:
-            length = def_len
+            length = 0
         code = srt.get_fullcode(code)
-        kldata = await kls.read_kline_data(code, klt, max(length, def_len))
+        kldata = await kls.read_kline_array(code, klt, length or 0, start)
         if kldata is None:
             return None
 
-        if len(kldata) > length:
-            kldata = kldata[-length:]
+        if fqt != 0 and len(kldata) > 0:
+            kldata = await cls.fix_price(code, kldata, fqt)
 
-        if start is not None:
-            kldata = [kl for kl in kldata if kl['time'] >= start]
-
-        if fqt == 0 or len(kldata) == 0:
+        if columnar:
             return kldata
+        return kls.array_to_dicts(kldata)
+
+    @classmethod
+    async def read_cross_section(cls, start, end=None, codes=None, kline_type='d'):
+        """
+        读取多只股票某日（或某时间段）的K线，一次查询返回
 
-        return await cls.fix_price(code, kldata, fqt)
+        Args:
+            start: 开始日期
+            end: 结束日期，None表示只取start当天
+            codes: 股票代码列表，None表示全部
+            kline_type: K线类型
+
+        Returns:
+            含code字段的结构化数组，code为完整代码，按(time, code)排序
+        """
+        if codes is not None:
+            codes = [srt.get_fullcode(c) for c in codes]
+        return await kls.read_cross_section(start, end, srt.to_int_kltype(kline_type), codes)
 
     @classmethod
     def fix_price_pre(cls, f0data, bndata):
@@ -112,94 +156,13 @@ class Khistory:
         前复权
 
         Args:
-            f0data: dict数组或元组列表
+            f0data: 结构化数组、dict数组或元组列表
             bndata: 分红数据列表
 
         Returns:
-            与输入相同类型的复权后数据
+            复权后数据
         """
-        # 判断输入类型
-        is_dict = isinstance(f0data[0], dict)
-
-        def fix_single_pre(p, gx):
-            for i in range(-1, -len(gx) - 1, -1):
-                if gx[i][0] == 0 and gx[i][1] == 0:
-                    continue
-                if gx[i][0] == 0:
-                    p -= gx[i][1]
-                    continue
-                p = (p - gx[i][1]) / (1 + gx[i][0])
-            return round(p, 3)
-
-        if is_dict:
-            result = f0data.copy()
-            fid = len(result) - 1
-            gx = [(0, 0)]
-
-            # 移除超出范围的分红数据
-            while len(bndata) > 0 and bndata[-1].ex_dividend_date > result[-1]['time']:
-                bndata.pop()
-
-            for bi in range(-1, -len(bndata) - 1, -1):
-                while fid >= 0:
-                    if result[fid]['time'] >= bndata[bi].ex_dividend_date:
-                        result[fid]['open'] = fix_single_pre(float(result[fid]['open']), gx)
-                        result[fid]['high'] = fix_single_pre(float(result[fid]['high']), gx)
-                        result[fid]['low'] = fix_single_pre(float(result[fid]['low']), gx)
-                        result[fid]['close'] = fix_single_pre(float(result[fid]['close']), gx)
-                        fid -= 1
-                        continue
-
-                    if bndata[bi].total_bonus is None or bndata[bi].total_bonus == '0':
-                        gx.append((0, float(bndata[bi].cash_dividend) / 10))
-                    elif bndata[bi].cash_dividend is None or bndata[bi].cash_dividend == '0':
-                        gx.append((float(bndata[bi].total_bonus) / 10, 0))
-                    else:
-                        gx.append((float(bndata[bi].total_bonus) / 10, float(bndata[bi].cash_dividend) / 10))
-                    break
-
-            while fid >= 0:
-                result[fid]['open'] = fix_single_pre(float(result[fid]['open']), gx)
-                result[fid]['high'] = fix_single_pre(float(result[fid]['high']), gx)
-                result[fid]['low'] = fix_single_pre(float(result[fid]['low']), gx)
-                result[fid]['close'] = fix_single_pre(float(result[fid]['close']), gx)
-                fid -= 1
-
-            return result
-        else:
-            # 处理元组列表（保持原有逻辑）
-            fid = len(f0data) - 1
-            gx = (0, 0),
-            l0data = list(f0data)
-            while len(bndata) > 0 and bndata[-1].ex_dividend_date > l0data[-1][0]:
-                bndata.pop()
-            for bi in range(-1, -len(bndata) - 1, -1):
-                while fid >= 0:
-                    if (l0data[fid][0] >= bndata[bi].ex_dividend_date):
-                        fdid = list(l0data[fid])
-                        fdid[1] = fix_single_pre(float(fdid[1]), gx)
-                        fdid[2] = fix_single_pre(float(fdid[2]), gx)
-                        fdid[3] = fix_single_pre(float(fdid[3]), gx)
-                        fdid[4] = fix_single_pre(float(fdid[4]), gx)
-                        l0data[fid] = tuple(fdid)
-                        fid -= 1
-                        continue
-                    if bndata[bi].total_bonus is None or bndata[bi].total_bonus == '0':
-                        gx += (0, float(bndata[bi].cash_dividend) / 10),
-                    elif bndata[bi].cash_dividend is None or bndata[bi].cash_dividend == '0':
-                        gx += (float(bndata[bi].total_bonus) / 10, 0),
-                    else:
-                        gx += (float(bndata[bi].total_bonus) / 10, float(bndata[bi].cash_dividend) / 10),
-                    break
-            while fid >= 0:
-                fdid = list(l0data[fid])
-                fdid[1] = fix_single_pre(float(fdid[1]), gx)
-                fdid[2] = fix_single_pre(float(fdid[2]), gx)
-                fdid[3] = fix_single_pre(float(fdid[3]), gx)
-                fdid[4] = fix_single_pre(float(fdid[4]), gx)
-                l0data[fid] = tuple(fdid)
-                fid -= 1
-            return tuple(l0data)
+        return AdjustFactors(bndata).apply(f0data, 1)
 
     @classmethod
     def fix_price_post(cls, f0data, bndata):
@@ -207,115 +170,53 @@ class Khistory:
         后复权
 
         Args:
-            f0data: dict数组或元组列表
+            f0data: 结构化数组、dict数组或元组列表
             bndata: 分红数据列表
 
         Returns:
-            与输入相同类型的复权后数据
+            复权后数据
         """
-        # 判断输入类型
-        is_dict = isinstance(f0data, dict)
-
-        def fix_single_post(p, gx):
-            for i in range(0, len(gx)):
-                if gx[i][0] == 0 and gx[i][1] == 0:
-                    continue
-                if gx[i][0] == 0:
-                    p += gx[i][1]
-                    continue
-                p = p * (1 + gx[i][0]) + gx[i][1]
-            return round(p, 3)
-
-        if is_dict:
-            result = f0data.copy()
-            gx = [(0, 0)]
-            fid = 0
-
-            for bi in range(0, len(bndata)):
-                while fid < len(result):
-                    if result[fid]['time'] < bndata[bi].ex_dividend_date:
-                        result[fid]['open'] = fix_single_post(float(result[fid]['open']), gx)
-                        result[fid]['high'] = fix_single_post(float(result[fid]['high']), gx)
-                        result[fid]['low'] = fix_single_post(float(result[fid]['low']), gx)
-                        result[fid]['close'] = fix_single_post(float(result[fid]['close']), gx)
-                        fid += 1
-                        continue
-
-                    if bndata[bi].total_bonus is None or bndata[bi].total_bonus == 0:
-                        gx.append((0, float(bndata[bi].cash_dividend) / 10))
-                    elif bndata[bi].cash_dividend is None or bndata[bi].cash_dividend == 0:
-                        gx.append((float(bndata[bi].total_bonus) / 10, 0))
-                    else:
-                        gx.append((float(bndata[bi].total_bonus) / 10, float(bndata[bi].cash_dividend) / 10))
-                    break
-
-            while fid < len(result):
-                result[fid]['open'] = fix_single_post(float(result[fid]['open']), gx)
-                result[fid]['high'] = fix_single_post(float(result[fid]['high']), gx)
-                result[fid]['low'] = fix_single_post(float(result[fid]['low']), gx)
-                result[fid]['close'] = fix_single_post(float(result[fid]['close']), gx)
-                fid += 1
-
-            return result
-        else:
-            # 处理元组列表（保持原有逻辑）
-            l0data = list(f0data)
-            gx = (0, 0),
-            fid = 0
-            for bi in range(0, len(bndata)):
-                while fid < len(l0data):
-                    if (l0data[fid][0] < bndata[bi].ex_dividend_date):
-                        fdid = list(l0data[fid])
-                        fdid[1] = fix_single_post(float(fdid[1]), gx)
-                        fdid[2] = fix_single_post(float(fdid[2]), gx)
-                        fdid[3] = fix_single_post(float(fdid[3]), gx)
-                        fdid[4] = fix_single_post(float(fdid[4]), gx)
-                        l0data[fid] = tuple(fdid)
-                        fid += 1
-                        continue
-                    if bndata[bi].total_bonus is None or bndata[bi].total_bonus == 0:
-                        gx += (0, float(bndata[bi].cash_dividend) / 10),
-                    elif bndata[bi].cash_dividend is None or bndata[bi].cash_dividend == 0:
-                        gx += (float(bndata[bi].total_bonus) / 10, 0),
-                    else:
-                        gx += (float(bndata[bi].total_bonus) / 10, float(bndata[bi].cash_dividend) / 10),
-                    break
-            while fid < len(l0data):
-                fdid = list(l0data[fid])
-                fdid[1] = fix_single_post(float(fdid[1]), gx)
-                fdid[2] = fix_single_post(float(fdid[2]), gx)
-                fdid[3] = fix_single_post(float(fdid[3]), gx)
-                fdid[4] = fix_single_post(float(fdid[4]), gx)
-                l0data[fid] = tuple(fdid)
-                fid += 1
-            return l0data
+        return AdjustFactors(bndata).apply(f0data, 2)
 
     @classmethod
-    async def fix_price(cls, code, f0data, fqt):
+    async def adjust_factors(cls, code) -> AdjustFactors:
+        """获取复权因子表，按代码缓存直到有新的分红记录保存"""
+        if code in cls._adjust_factors:
+            return cls._adjust_factors[code]
+
+        bndata = []
         kind = await query_one_value(MdlAllStock, 'typekind', MdlAllStock.code == code)
-        if kind is None:
-            return f0data
         bn: StockShareBonus = None
         if kind == 'ABStock' or kind == 'BJStock':
             bn = cls.stock_bonus_handler
         elif kind == 'LOF' or kind == 'ETF':
             bn = cls.fund_bonus_handler
-        else:
-            return f0data
+        if bn is not None:
+            bndata = await bn.getBonusHis(code) or []
 
-        bndata = await bn.getBonusHis(code)
-        if bndata is None or len(bndata) == 0:
-            return f0data
+        factors = AdjustFactors(bndata)
+        cls._adjust_factors[code] = factors
+        return factors
 
-        if fqt == 1:
-            return cls.fix_price_pre(f0data, bndata)
-        if fqt == 2:
-            return cls.fix_price_post(f0data, bndata)
-        return f0data
+    @classmethod
+    def invalidate_adjust_factors(cls, codes=None):
+        """清除复权因子缓存, codes为None时全部清除"""
+        if codes is None:
+            cls._adjust_factors.clear()
+            return
+        for c in codes:
+            cls._adjust_factors.pop(c, None)
+
+    @classmethod
+    async def fix_price(cls, code, f0data, fqt):
+        if fqt not in (1, 2) or f0data is None or len(f0data) == 0:
+            return f0data
+        factors = await cls.adjust_factors(code)
+        return factors.apply(f0data, fqt)
 
     @classmethod
-    async def save_kline(cls, code: str, kline_type: Union[int, str], kldata: List[dict]):
-        """保存K线数据到SQLite存储"""
+    async def save_kline(cls, code: str, kline_type: Union[int, str], kldata: List[dict], wait: bool = True):
+        """保存K线数据到SQLite存储，wait为False时不等待提交，之后需调用flush()"""
         if len(kldata) == 0:
             return False
         klt = srt.to_int_kltype(kline_type)
@@ -323,15 +224,38 @@ class Khistory:
             logger.error(f'kline_type {klt} not in saved_kline_types')
             return False
         if klt == 101:
-            for i, k in enumerate(kldata):
-                if 'change_px' not in k:
-                    kldata[i]['change_px'] = k['close'] - kldata[i-1]['close'] if i > 0 else 0
-                if 'change' not in k:
-                    kldata[i]['change'] = k['change_px'] / kldata[i-1]['close'] if i > 0 else 0
-                if 'amplitude' not in k:
-                    kldata[i]['amplitude'] = (k['high'] - k['low']) / kldata[i-1]['close'] if i > 0 else 0
+            cls.fill_daily_changes(kldata)
+
+        await kls.save_kline_data(code, kldata, klt, wait=wait)
+
+    @classmethod
+    async def flush(cls) -> List[tuple]:
+        """等待未等待提交的K线数据写入数据库，返回写入失败的[(股票代码, 异常)]"""
+        return await kls.flush()
+
+    @classmethod
+    async def save_klines(cls, kline_type: Union[int, str], datasets: dict) -> int:
+        """在一个事务中保存多只股票的K线数据，返回保存的记录数"""
+        klt = srt.to_int_kltype(kline_type)
+        if klt not in kls.saved_kline_types:
+            logger.error(f'kline_type {klt} not in saved_kline_types')
+            return 0
+        datasets = {c: d for c, d in datasets.items() if d}
+        if klt == 101:
+            for kldata in datasets.values():
+                cls.fill_daily_changes(kldata)
+        return await kls.save_kline_data_many(datasets, klt)
 
-        await kls.save_kline_data(code, kldata, klt)
+    @staticmethod
+    def fill_daily_changes(kldata: List[dict]):
+        """补充日K线缺失的涨跌额、涨跌幅和振幅"""
+        for i, k in enumerate(kldata):
+            if 'change_px' not in k:
+                kldata[i]['change_px'] = k['close'] - kldata[i-1]['close'] if i > 0 else 0
+            if 'change' not in k:
+                kldata[i]['change'] = k['change_px'] / kldata[i-1]['close'] if i > 0 else 0
+            if 'amplitude' not in k:
+                kldata[i]['amplitude'] = (k['high'] - k['low']) / kldata[i-1]['close'] if i > 0 else 0
 
 
 class StockList():
@@ -444,6 +368,7 @@ class StockShareBonus(EmDataCenterRequest):
             })
         if len(values) > 0:
             await insert_many(self.db, values, ['code', 'report_date'])
+            Khistory.invalidate_adjust_factors({v['code'] for v in values})
 
     async def dividenDateLaterThan(self, code, date=None):
         if date is None:
@@ -478,7 +403,7 @@ class FundShareBonus(StockShareBonus):
         return f'''https://fundf10.eastmoney.com/fhsp_{self.code[2:]}.html'''
 
     async def getNext(self, headers=None):
-        fhsp = self.getRequest(headers)
+        fhsp = await self.getRequestAsync(headers)
         soup = BeautifulSoup(fhsp, 'html.parser')
         fhTable = soup.find('table', {'class':'w782 comm cfxq'})
         self.fecthed = []
@@ -504,6 +429,7 @@ class FundShareBonus(StockShareBonus):
 
         cols = [c.name for c in self.db.__table__.columns]
         await upsert_many(self.db, [dict(zip(cols, row)) for row in self.fecthed], ['code', 'report_date'])
+        Khistory.invalidate_adjust_factors({row[0] for row in self.fecthed})
         self.fecthed = []
 
     async def getBonusHis(self, code):
@@ -535,7 +461,7 @@ class FflowRequest(EmRequest):
     async def getNext(self, headers=None):
         headers = self.headers.copy()
         headers['Referer'] = f'https://data.eastmoney.com/zjlx/{self.code[2:]}.html'
-        rsp = self.getRequest(headers)
+        rsp = await self.getRequestAsync(headers)
         fflow = json.loads(rsp)
         if fflow is None or 'data' not in fflow or fflow['data'] is None or 'klines' not in fflow['data']:
             logger.warning(fflow)
@@ -568,8 +494,19 @@ class FflowHistory:
         return await fls.get_latest_time(code)
 
     @classmethod
-    async def save_fflow(self, code, fflow):
-         await fls.save_fflow(code, fflow)
+    async def max_dates(cls, codes):
+        """批量获取资金流最新日期，返回{code: 最新日期}，没有数据的为None"""
+        latest = await fls.latest_times(list(codes))
+        return {c: latest.get(c) for c in codes}
+
+    @classmethod
+    async def save_fflow(self, code, fflow, wait=True):
+         await fls.save_fflow(code, fflow, wait=wait)
+
+    @classmethod
+    async def flush(cls) -> List[tuple]:
+        """等待未等待提交的资金流数据写入数据库，返回写入失败的[(股票代码, 异常)]"""
+        return await fls.flush()
 
     @classmethod
     async def update_fflow(cls, code):
@@ -654,7 +591,7 @@ class StockChanges(EmRequest):
         return f'http://push2ex.eastmoney.com/getAllStockChanges?type={t}&ut=7eea3edcaed734bea9cbfc24409ed989&pageindex={self.page}&pagesize={self.pageSize}&dpt=wzchanges'
 
     async def getNext(self):
-        chgs = json.loads(self.getRequest(self.headers))
+        chgs = json.loads(await self.getRequestAsync(self.headers))
         if 'data' not in chgs or chgs['data'] is None:
             if len(self.fecthed) > 0:
                 await self.saveFetched()
@@ -841,7 +778,7 @@ class StockBkChanges(BkChanges):
         return f'http://push2ex.eastmoney.com/getAllBKChanges?ut=7eea3edcaed734bea9cbfc24409ed989&dpt=wzchanges&pageindex={self.page}&pagesize={self.pageSize}'
 
     async def getNext(self):
-        chgs = json.loads(self.getRequest(self.headers))
+        chgs = json.loads(await self.getRequestAsync(self.headers))
         if 'data' not in chgs or chgs['data'] is None:
             return
 
@@ -967,7 +904,7 @@ class StockClsBkChanges(BkChanges):
 
     async def getNext(self):
         try:
-            chgs = json.loads(self.getRequest(self.headers))
+            chgs = json.loads(await self.getRequestAsync(self.headers))
             if 'data' not in chgs or chgs['data'] is None:
                 return
 
@@ -1058,7 +995,7 @@ class StockClsBkChanges(BkChanges):
         headers['Host'] = 'x-quote.cls.cn'
         for bk in ibks:
             iurl = f'https://x-quote.cls.cn/web_quote/plate/info?app=CailianpressWeb&os=web&secu_code={bk}&sv=8.4.6'
-            response = Network.fetch_url(iurl, headers=headers)
+            response = await Network.fetch_url_async(iurl, headers=headers)
             plinfo = json.loads(response)
             if 'data' not in plinfo:
                 continue
@@ -1292,7 +1229,7 @@ class StockDtInfo(EmRequest):
         self.headers['Host'] = 'push2ex.eastmoney.com'
         self.dtdata = []
         while True:
-            emback = json.loads(self.getRequest(self.headers))
+            emback = json.loads(await self.getRequestAsync(self.headers))
             if emback is None or emback['data'] is None:
                 logger.info('StockDtInfo invalid response! %s', emback)
                 if self.date < TradingDate.max_trading_date():
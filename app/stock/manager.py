@@ -8,13 +8,13 @@ from traceback import format_exc
 from datetime import datetime
 from stockrt.sources.eastmoney import Em
 from app.hu import classproperty, to_cls_secucode, time_stamp
-from app.hu.network import Network as net
-from app.lofig import logger
+from app.hu.network import Network as net, FetchPipeline
+from app.lofig import Config, logger
 from app.db import upsert_one, upsert_many, query_one_value, query_one_record, query_aggregate, query_values, delete_records
 from .models import MdlAllStock, MdlStockBk, MdlStockBkMap, MdlSMStats, MdlStockChanges
 from .schemas import PmStock
 from .history import (
-    Network, array_to_dict_list,
+    array_to_dict_list,
     Khistory as khis, FflowHistory as fhis, StockBkMap, StockBkChanges, StockClsBkChanges,
     StockList)
 from app.selectors import SelectorsFactory as sfac
@@ -76,18 +76,7 @@ class AllStocks:
         Args:
             kltype: K线类型 (d, w, m) 指数只保存这几种K线数据
         '''
-        rows = await query_values(cls.db)
-        target_types = ['Index', 'ETF', 'LOF', 'ABStock', 'BJStock', 'TSStock']
-        mxdate = TradingDate.max_trading_date()
-        if sectype in target_types:
-            target_code = [row.code for row in rows if row.typekind == sectype and (row.setup_date is None or row.setup_date <= mxdate)]
-        else:
-            if kltype == 'd':
-                stock_cns = {r.code: r.name for r in rows if r.code.startswith(('sh', 'sz', 'bj')) and r.typekind in ('ABStock', 'BJStock') and (r.setup_date is None or r.setup_date <= mxdate)}
-                target_code = await cls.update_stock_daily_kline_and_fflow(stock_cns)
-            else:
-                target_code = [row.code for row in rows if row.typekind in ('ABStock', 'BJStock') and (row.setup_date is None or row.setup_date <= mxdate)]
-
+        target_code = await cls.kline_targets(kltype, sectype)
         if not target_code:
             return
 
@@ -96,6 +85,33 @@ class AllStocks:
             mxdate = await khis.max_date('sh000001')
             TradingDate.update_max_traded_date(mxdate)
 
+    @classmethod
+    async def kline_targets(cls, kltype='d', sectype: str = None) -> List[str]:
+        '''
+        需要单独下载K线的股票代码，股票日K线先通过涨幅榜更新，只返回数据不连续的股票
+        Args:
+            kltype: K线类型
+            sectype: 证券类型，默认为A股和北交所股票
+        '''
+        target_types = ['Index', 'ETF', 'LOF', 'ABStock', 'BJStock', 'TSStock']
+        if sectype in target_types:
+            rows = await query_values(cls.db)
+            mxdate = TradingDate.max_trading_date()
+            return [row.code for row in rows if row.typekind == sectype and (row.setup_date is None or row.setup_date <= mxdate)]
+        if kltype == 'd':
+            rows = await query_values(cls.db)
+            mxdate = TradingDate.max_trading_date()
+            stock_cns = {r.code: r.name for r in rows if r.code.startswith(('sh', 'sz', 'bj')) and r.typekind in ('ABStock', 'BJStock') and (r.setup_date is None or r.setup_date <= mxdate)}
+            return await cls.update_stock_daily_kline_and_fflow(stock_cns) or []
+        return await cls.listed_stock_codes()
+
+    @classmethod
+    async def listed_stock_codes(cls) -> List[str]:
+        """已上市的A股和北交所股票代码"""
+        rows = await query_values(cls.db)
+        mxdate = TradingDate.max_trading_date()
+        return [row.code for row in rows if row.typekind in ('ABStock', 'BJStock') and (row.setup_date is None or row.setup_date <= mxdate)]
+
     @classmethod
     async def update_klines_by_code(cls, stocks, kltype: str='d') -> List[str]:
         """
@@ -109,7 +125,41 @@ class AllStocks:
             A list of stock codes for which the K-line data was not updated.
 
         """
-        uplens = {c: await khis.count_bars_to_updated(c, kltype) for c in stocks}
+        jobs = await cls.kline_fetch_jobs(stocks, kltype)
+        if not jobs:
+            return []
+        return await cls.run_kline_pipeline(jobs)
+
+    @classmethod
+    async def update_minute_klines(cls, kltypes: List[int], stocks: List[str] = None) -> List[str]:
+        """
+        更新股票的多种分钟K线，各K线类型的下载批次在同一个流水线中执行
+
+        Args:
+            kltypes: 分钟K线类型列表，如[15, 5, 1]
+            stocks: 股票代码列表，默认为所有已上市的股票
+
+        Returns:
+            更新失败的股票代码列表
+        """
+        if stocks is None:
+            stocks = await cls.listed_stock_codes()
+        jobs = []
+        for kltype in kltypes:
+            jobs += await cls.kline_fetch_jobs(stocks, kltype)
+        if not jobs:
+            return []
+        return await cls.run_kline_pipeline(jobs)
+
+    @classmethod
+    async def kline_fetch_jobs(cls, stocks, kltype) -> List[tuple]:
+        """
+        按需要更新的K线数量分组，生成下载批次
+
+        Returns:
+            FetchPipeline的(数据源, 下载函数, 参数)列表
+        """
+        uplens = await khis.count_bars_to_updated_many(stocks, kltype)
         fixlens = {}
         for c,l in uplens.items():
             if l == 0:
@@ -118,35 +168,57 @@ class AllStocks:
                 fixlens[l] = []
             fixlens[l].append(c)
         if not fixlens:
-            return
+            return []
         if 1 in fixlens and len(fixlens[1]) > 100:
             logger.warning('too many stocks to update for 1 day, please call update_kline_data("d") first!')
-            return
+            return []
+
+        ksize = Config.kline_fetch_config()['batch_size']
+        jobs = []
+        for l, codes in fixlens.items():
+            fkl = l == sys.maxsize
+            for i in range(0, len(codes), ksize):
+                jobs.append(('fklines' if fkl else 'klines', cls.fetch_klines, (codes[i:i+ksize], kltype, l, fkl)))
+        return jobs
 
-        async def update_and_save(codes, length, fkl=False):
-            # tdx = srt.rtsource('tdx')
-            # func = tdx.fklines if fkl else tdx.klines
-            func = srt.fklines if fkl else srt.klines
-            args = (codes, kltype, 0) if fkl else (codes, kltype, length, 0)
-            klines = func(*args)
-            for c in klines:
-                if c in stocks:
-                    await khis.save_kline(c, kltype, klines[c])
+    @staticmethod
+    def fetch_klines(codes, kltype, length, fkl=False):
+        """在下载线程中执行，返回(K线类型, 股票代码列表, {code: K线数据})"""
+        # tdx = srt.rtsource('tdx')
+        # func = tdx.fklines if fkl else tdx.klines
+        klines = srt.fklines(codes, kltype, 0) if fkl else srt.klines(codes, kltype, length, 0)
+        return kltype, codes, klines
+
+    @classmethod
+    async def run_kline_pipeline(cls, jobs: List[tuple]) -> List[str]:
+        """
+        并发下载K线并由写入协程按批次在一个事务中保存
+
+        Returns:
+            下载或保存失败的股票代码列表
+        """
+        async def save(result):
+            kltype, codes, klines = result
+            codes = set(codes)
+            await khis.save_klines(kltype, {c: v for c, v in klines.items() if c in codes})
 
+        cfg = Config.kline_fetch_config()
+        pipeline = FetchPipeline(cfg['concurrency'], cfg['rates'])
         ofmt = srt.set_array_format('json')
         # srt.set_default_sources('dklines', 'dklines', ('xueqiu', 'ths', 'eastmoney', 'tdx', 'sina'), True)
         srt.set_default_sources('dklines', 'dklines', ('xueqiu', 'ths', 'tdx', 'sina'), True)
-        ksize = 500
-        for l, codes in fixlens.items():
-            if l == sys.maxsize:
-                for i in range(0, len(codes), ksize):
-                    batch = codes[i:i+ksize]
-                    await update_and_save(batch, l, fkl=True)
-            else:
-                for i in range(0, len(codes), ksize):
-                    batch = codes[i:i+ksize]
-                    await update_and_save(batch, l, fkl=False)
-        srt.set_array_format(ofmt)
+        try:
+            stats = await pipeline.run(jobs, save)
+        finally:
+            srt.set_array_format(ofmt)
+
+        failed = []
+        for (src, func, args), e in stats['failed']:
+            logger.error(f'update klines failed {src} kltype={args[1]} {len(args[0])} stocks: {e}')
+            failed += args[0]
+        logger.info(f"klines updated: {stats['jobs']} batches in {stats['seconds']:.1f}s, "
+                    f"fetch {stats['fetch_seconds']:.1f}s, save {stats['save_seconds']:.1f}s, {len(stats['failed'])} failed")
+        return failed
 
     @classmethod
     async def update_stock_daily_kline_and_fflow(cls, cns: dict = {}):
@@ -176,20 +248,27 @@ class AllStocks:
                     continue
                 result[c]['amplitude'] = (stock['high'] - stock['low']) / stock['lclose']
         unconfirmed = []
+        mxdates = await khis.max_dates(list(result.keys()), 'd')
+        mxfdates = await fhis.max_dates(list(result.keys()))
+        pdate = TradingDate.prev_trading_date(TradingDate.max_trading_date())
         for c, kl in result.items():
             if kl['open'] == 0 or kl['high'] == 0 or kl['low'] == 0 or kl['close'] == 0:
                 logger.warning(f'invalid kline for {c}')
                 continue
-            mxdate = await khis.max_date(c, 'd')
-            if TradingDate.prev_trading_date(TradingDate.max_trading_date()) == mxdate:
-                await khis.save_kline(c, 'd', [kl])
+            if pdate == mxdates[c]:
+                await khis.save_kline(c, 'd', [kl], wait=False)
             else:
                 unconfirmed.append(c)
-            mxfdate = await fhis.max_date(c)
-            if 'main' in kl and TradingDate.prev_trading_date(TradingDate.max_trading_date()) == mxfdate:
-                await fhis.save_fflow(c, [kl])
+            if 'main' in kl and pdate == mxfdates[c]:
+                await fhis.save_fflow(c, [kl], wait=False)
             if c in cns and cns[c] != kl['name']:
                 await upsert_one(cls.db, {"code": c, "name": kl['name']}, ["code"])
+        # 各股票的写入由写入队列合并为少量事务，K线写入失败的股票单独获取K线
+        for c, e in await khis.flush():
+            logger.error(f'save daily kline failed {c}: {e}')
+            unconfirmed.append(c)
+        for c, e in await fhis.flush():
+            logger.error(f'save fflow failed {c}: {e}')
         return unconfirmed
 
     @classmethod
@@ -209,25 +288,29 @@ class AllStocks:
         await cls.update_transactions_by_code(stocks)
 
     @classmethod
-    async def update_transactions_by_code(cls, stocks: list = None):
+    async def update_transactions_by_code(cls, stocks: list = None) -> List[str]:
+        '''
+        更新股票的成交数据
+
+        Returns:
+            保存失败的股票代码列表
+        '''
         # 使用trans_adapter获取最新交易时间
-        stocks_with_time = []
-        for s in stocks:
-            max_time = await tss.get_latest_time(s)
-            if max_time and max_time < TradingDate.max_trading_date():
-                stocks_with_time.append(s)
-        stocks = stocks_with_time
+        latest = await tss.latest_times(stocks)
+        mxdate = TradingDate.max_trading_date()
+        stocks = [s for s in stocks if s in latest and latest[s] < mxdate]
         if not stocks:
             logger.info('no stocks need to update transactions')
-            return
+            return []
         if TradingDate.trading_started() and not TradingDate.trading_ended():
             logger.warning(f'transactions should not updated during trading!')
-            return
+            return []
 
         tsize = 1000
         date = TradingDate.max_traded_date()
         tdx = srt.rtsource('tdx')
         ofmt = srt.set_array_format('list')
+        failed = []
         for i in range(0, len(stocks), tsize):
             batch = stocks[i:i+tsize]
             trans = tdx.transactions(batch)
@@ -245,9 +328,13 @@ class AllStocks:
                     trans_dict = dict(zip(cols, t))
                     trans_dicts.append(trans_dict)
 
-                await tss.save_transaction(k, trans_dicts)
+                await tss.save_transaction(k, trans_dicts, wait=False)
+            for k, e in await tss.flush():
+                logger.error(f'save transactions failed {k}: {e}')
+                failed.append(k)
             logger.info(f'saved transactions for stocks: {i} - {i+len(batch)} / {len(stocks)}')
         srt.set_array_format(ofmt)
+        return failed
 
     @classmethod
     async def is_quited(cls, code):
@@ -426,7 +513,7 @@ class AllStocks:
         # https://q.stock.sohu.com/suggest/search/all?type=all&count=10&terminal=pc&callback=&keyword=
         for code in codes:
             url = f'https://q.stock.sohu.com/suggest/search/all?type=all&count=10&terminal=pc&callback=&keyword={code[-6:]}&_={time_stamp()}'
-            response = net.fetch_url(url)
+            response = await net.fetch_url_async(url)
             data = json.loads(response)
             if data and data['code'] == 200 and 'data' in data:
                 for s in data['data']:
@@ -651,7 +738,7 @@ class StockMarketStats():
             for i in range(0,len(up_down_stocks),200):
                 ccodes = ','.join([to_cls_secucode(c) for c in up_down_stocks[i: i+200]])
                 bUrl = f'https://x-quote.cls.cn/quote/stocks/basic?app=CailianpressWeb&fields={fields}&os=web&secu_codes={ccodes}&sv=8.4.6'
-                sbasics = json.loads(Network.fetch_url(bUrl, Network.get_headers({'Host': 'x-quote.cls.cn'})))
+                sbasics = json.loads(await net.fetch_url_async(bUrl, net.get_headers({'Host': 'x-quote.cls.cn'})))
                 if 'data' in sbasics:
                     for secu in sbasics['data']:
                         sbasic = sbasics['data'][secu]
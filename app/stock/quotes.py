@@ -1,12 +1,372 @@
+import time
+import threading
+from concurrent.futures import Future
 from traceback import format_exc
-from typing import Union, List, Dict, Any, Optional
-from bisect import bisect_left
+from collections import OrderedDict
+from typing import Union, List, Dict, Any, Optional, Callable
+import numpy as np
+from cachetools import LRUCache
 import stockrt as srt
 from app.lofig import logger
-from . import get_cache, get_async_lru_cache
+from . import get_cache
 from .date import TradingDate
 
 
+class BatchSingleFlight:
+    """
+    合并并发的上游请求
+
+    同一代码同时只有一个进行中的请求，其他调用者等待该请求的结果；
+    第一个未命中的调用者等待window秒，收集这段时间内其他调用者的未命中代码后合并为一次批量请求
+    """
+    def __init__(self, fetch: Callable[[List[str]], Dict[str, Any]], window: float = 0.02, timeout: float = 30):
+        """
+        Args:
+            fetch: 批量请求函数，参数为代码列表，返回代码到数据的映射
+            window: 合并请求的等待时间(秒)
+            timeout: 等待结果的最长时间(秒)
+        """
+        self.fetch = fetch
+        self.window = window
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.inflight: Dict[str, Future] = {}
+        self.pending: List[str] = []
+        self.batching = False
+        self.upstream_calls = 0
+
+    def get(self, codes: List[str]) -> Dict[str, Any]:
+        futures = {}
+        lead = False
+        with self.lock:
+            for c in codes:
+                fut = self.inflight.get(c)
+                if fut is None:
+                    fut = Future()
+                    self.inflight[c] = fut
+                    self.pending.append(c)
+                futures[c] = fut
+            if self.pending and not self.batching:
+                self.batching = True
+                lead = True
+
+        if lead:
+            if self.window > 0:
+                time.sleep(self.window)
+            with self.lock:
+                batch, self.pending = self.pending, []
+                self.batching = False
+            self._run(batch)
+
+        result = {}
+        for c, fut in futures.items():
+            data = fut.result(self.timeout)
+            if data is not None:
+                result[c] = data
+        return result
+
+    def _run(self, batch: List[str]) -> None:
+        data, error = None, None
+        try:
+            self.upstream_calls += 1
+            data = self.fetch(batch) or {}
+        except Exception as e:
+            error = e
+        with self.lock:
+            futures = [(c, self.inflight.pop(c)) for c in batch]
+        for c, fut in futures:
+            if error is not None:
+                fut.set_exception(error)
+            else:
+                fut.set_result(data.get(c))
+
+
+class TickArray:
+    """
+    当日逐笔成交的只读序列，按列保存在numpy数组中
+
+    时间为当日秒数(int32)，价格float32，成交量int64，买卖方向int8；
+    按下标访问时还原为 [t, p, v, bs] 格式
+    """
+    def __init__(self, date: str, secs: np.ndarray, price: np.ndarray, volume: np.ndarray, bs: np.ndarray, size: int):
+        self.date = date
+        self.secs = secs
+        self.price = price
+        self.volume = volume
+        self.bs = bs
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i: int) -> List[Any]:
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('tick index out of range')
+        s = int(self.secs[i])
+        return [f'{self.date} {s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}',
+                round(float(self.price[i]), 3), int(self.volume[i]), int(self.bs[i])]
+
+    @property
+    def nbytes(self) -> int:
+        return self.secs.nbytes + self.price.nbytes + self.volume.nbytes + self.bs.nbytes
+
+    def last_time(self) -> str:
+        """最后一笔成交的时间 HH:MM:SS，无数据时返回空字符串"""
+        if self.size == 0:
+            return ''
+        s = int(self.secs[self.size - 1])
+        return f'{s // 3600:02d}:{s % 3600 // 60:02d}:{s % 60:02d}'
+
+
+class TickBuffer(TickArray):
+    """
+    单只股票当日逐笔成交的追加缓冲区
+
+    容量不足时按倍数扩容，追加k笔成交的均摊开销为O(k)；
+    合并新数据时只替换最后一秒的成交，与上游按开始时间增量拉取的数据衔接。
+    快照与缓冲区共用数组，需要改写已发出快照范围内的数据时先复制到新数组(写时复制)
+    """
+    init_capacity = 256
+
+    def __init__(self, date: str = ''):
+        super().__init__(date, np.empty(0, np.int32), np.empty(0, np.float32),
+                         np.empty(0, np.int64), np.empty(0, np.int8), 0)
+        # 当前数组上已发出快照的最大长度
+        self.shared = 0
+
+    @staticmethod
+    def seconds(t: str) -> int:
+        """成交时间(YYYY-MM-DD HH:MM:SS或HH:MM:SS)转为当日秒数"""
+        hms = t.rpartition(' ')[2].split(':')
+        return int(hms[0]) * 3600 + int(hms[1]) * 60 + (int(hms[2]) if len(hms) > 2 else 0)
+
+    def _reserve(self, n: int) -> None:
+        """保证容量不小于n，并且从self.size开始写入不会修改已发出的快照"""
+        if n <= len(self.secs) and self.size >= self.shared:
+            return
+        capacity = max(n, len(self.secs) * 2, self.init_capacity) if n > len(self.secs) else len(self.secs)
+        # 分配新数组，已发出的快照仍引用旧数组
+        for name in ('secs', 'price', 'volume', 'bs'):
+            old = getattr(self, name)
+            arr = np.empty(capacity, old.dtype)
+            arr[:self.size] = old[:self.size]
+            setattr(self, name, arr)
+        self.shared = 0
+
+    def merge(self, date: str, ticks: List[List]) -> None:
+        """
+        合并新拉取的逐笔成交，日期变化时清空
+
+        Args:
+            date: 成交日期
+            ticks: 新成交列表，格式为 [t, p, v, a, bs] 或 [t, p, v, bs]
+        """
+        if date != self.date:
+            self.date = date
+            self.size = 0
+        if not ticks:
+            return
+
+        secs = [self.seconds(t[0]) for t in ticks]
+        start = 0
+        if self.size > 0:
+            last = self.secs[self.size - 1]
+            self.size = int(np.searchsorted(self.secs[:self.size], last, 'left'))
+            while start < len(secs) and secs[start] < last:
+                start += 1
+        k = len(ticks) - start
+        if k <= 0:
+            return
+
+        self._reserve(self.size + k)
+        end = self.size + k
+        self.secs[self.size:end] = secs[start:]
+        self.price[self.size:end] = [t[1] for t in ticks[start:]]
+        self.volume[self.size:end] = [t[2] for t in ticks[start:]]
+        self.bs[self.size:end] = [t[-1] for t in ticks[start:]]
+        self.size = end
+
+    def snapshot(self) -> TickArray:
+        """当前数据的视图，不复制数据，之后的合并不会修改快照中的数据"""
+        self.shared = max(self.shared, self.size)
+        return TickArray(self.date, self.secs[:self.size], self.price[:self.size],
+                         self.volume[:self.size], self.bs[:self.size], self.size)
+
+
+class TickStore:
+    """所有股票的逐笔成交缓冲区，总内存超过上限时淘汰最久未使用的股票"""
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: 所有缓冲区占用内存的上限(字节)
+        """
+        self.max_bytes = max_bytes
+        self.buffers: 'OrderedDict[str, TickBuffer]' = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, code: str) -> Optional[TickArray]:
+        """获取股票当前成交数据的快照，无数据时返回None"""
+        with self.lock:
+            buf = self.buffers.get(code)
+            if buf is None or buf.size == 0:
+                return None
+            self.buffers.move_to_end(code)
+            return buf.snapshot()
+
+    def last_time(self, code: str) -> str:
+        with self.lock:
+            buf = self.buffers.get(code)
+            return buf.last_time() if buf is not None else ''
+
+    def merge(self, code: str, date: str, ticks: List[List]) -> None:
+        with self.lock:
+            buf = self.buffers.get(code)
+            if buf is None:
+                buf = self.buffers[code] = TickBuffer(date)
+            self.buffers.move_to_end(code)
+            before = buf.nbytes
+            buf.merge(date, ticks)
+            self.nbytes += buf.nbytes - before
+            while self.nbytes > self.max_bytes and len(self.buffers) > 1:
+                _, evicted = self.buffers.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self) -> None:
+        with self.lock:
+            self.buffers.clear()
+            self.nbytes = 0
+
+
+class IntradayBarBuilder:
+    """
+    由逐笔成交增量合成分时K线
+
+    保存已完成的K线和当前未完成的K线，每次只处理上次之后新增的逐笔成交。
+    缓存合并时最后一秒的成交可能被替换，因此在每个新时间点开始前记录检查点，
+    更新时从最后一个时间点的检查点开始重算
+    """
+    def __init__(self, kline_type: int = 1):
+        """
+        Args:
+            kline_type: K线周期(分钟数，如1、5、15等)
+        """
+        self.kline_type = kline_type
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.rows: List[List[Any]] = []
+        self.bar: Optional[dict] = None
+        self.first_tick = None
+        self.consumed = 0
+        self._ckpt = (0, 0, None, None)
+        self._minute = None
+        self._bar_time = None
+
+    def update(self, transactions: List[List]) -> List[List[Any]]:
+        """
+        处理新增的逐笔成交并返回全部K线
+
+        Args:
+            transactions: 当日逐笔成交数据列表，格式为 [t, p, v, a, bs] 或 [t, p, v, bs]
+
+        Returns:
+            K线数据列表
+        """
+        with self.lock:
+            if not transactions:
+                self.reset()
+                return []
+
+            start = self._restore(transactions)
+            prev_t = transactions[start - 1][0] if start > 0 else None
+            for i in range(start, len(transactions)):
+                trans = transactions[i]
+                if trans[0] != prev_t:
+                    prev_t = trans[0]
+                    self._ckpt = (i, len(self.rows), dict(self.bar) if self.bar else None, transactions[i - 1] if i > 0 else None)
+                self._consume(trans)
+            self.consumed = len(transactions)
+            return self.rows + [self._row(self.bar)] if self.bar else list(self.rows)
+
+    def _restore(self, transactions: List[List]) -> int:
+        """回退到最后一个时间点的检查点，返回需要处理的起始位置，数据不连续时重建"""
+        idx, nrows, bar, before = self._ckpt
+        if self.first_tick != transactions[0] or len(transactions) < idx or (idx > 0 and transactions[idx - 1] != before):
+            self.reset()
+            self.first_tick = transactions[0]
+            return 0
+        del self.rows[nrows:]
+        self.bar = dict(bar) if bar else None
+        return idx
+
+    def bar_time(self, t: str) -> str:
+        """成交时间所属K线的时间，同一分钟内的成交复用上次结果"""
+        minute = t.rpartition(':')[0] if t.count(':') == 2 else t
+        if minute != self._minute:
+            self._minute = minute
+            self._bar_time = Quotes._bar_time(t, self.kline_type)
+        return self._bar_time
+
+    def _consume(self, trans: List) -> None:
+        if len(trans) == 4:
+            t, p, v, bs = trans
+        else:
+            t, p, v, a, bs = trans
+
+        if not self.bar and bs == 8:
+            return
+
+        amount = p * v
+        time_str = self.bar_time(t)
+        bar = self.bar
+        if bar and bar['time'] == time_str:
+            self._merge(bar, p, v, amount)
+            return
+        if bar:
+            self.rows.append(self._row(bar))
+        self.bar = self._new_bar(time_str, p, v, amount)
+
+    def _new_bar(self, time_str, p, v, amount) -> dict:
+        return {'time': time_str, 'open': p, 'close': p, 'high': p, 'low': p, 'volume': v, 'amount': amount}
+
+    def _merge(self, bar, p, v, amount) -> None:
+        if p > bar['high']:
+            bar['high'] = p
+        if p < bar['low']:
+            bar['low'] = p
+        bar['close'] = p
+        bar['volume'] += v
+        bar['amount'] += amount
+
+    def _row(self, bar) -> List[Any]:
+        return [bar['time'], bar['open'], bar['close'], bar['high'], bar['low'], bar['volume'], bar['amount']]
+
+
+class IntradayTlineBuilder(IntradayBarBuilder):
+    """由逐笔成交增量合成分时线 [time, price, volume, amount, avg_price]"""
+    def __init__(self):
+        super().__init__(1)
+
+    def _new_bar(self, time_str, p, v, amount) -> dict:
+        return {'time': time_str, 'price': p, 'volume': v, 'amount': amount}
+
+    def _merge(self, bar, p, v, amount) -> None:
+        bar['price'] = p
+        bar['volume'] += v
+        bar['amount'] += amount
+
+    def _row(self, bar) -> List[Any]:
+        if bar['volume'] == 0:
+            avg_price = self.rows[-1][4] if self.rows else bar['price']
+        else:
+            avg_price = bar['amount'] / bar['volume']
+        return [bar['time'], bar['price'], bar['volume'], bar['amount'], avg_price]
+
+
 class Quotes:
     """股票行情数据获取类，提供实时行情和K线数据"""
 
@@ -20,6 +380,31 @@ class Quotes:
         'default': 30  # 其他类型默认缓存30秒
     }
 
+    _flights: Dict[str, BatchSingleFlight] = {}
+    _flights_lock = threading.Lock()
+    _bar_builders = LRUCache(maxsize=10000)
+    _ticks = TickStore()
+    _bar_builders_lock = threading.Lock()
+
+    @classmethod
+    def _flight(cls, name: str, fetch: Callable[[List[str]], Dict[str, Any]]) -> BatchSingleFlight:
+        """获取指定类型请求的合并器"""
+        with cls._flights_lock:
+            if name not in cls._flights:
+                cls._flights[name] = BatchSingleFlight(fetch)
+            return cls._flights[name]
+
+    @classmethod
+    def _bar_builder(cls, code: str, kline_type: Union[int, str]) -> IntradayBarBuilder:
+        """获取股票指定周期的K线合成器，kline_type为't'时为分时线"""
+        key = (code, kline_type)
+        with cls._bar_builders_lock:
+            builder = cls._bar_builders.get(key)
+            if builder is None:
+                builder = IntradayTlineBuilder() if kline_type == 't' else IntradayBarBuilder(kline_type)
+                cls._bar_builders[key] = builder
+            return builder
+
     @classmethod
     def _normalize_codes(cls, codes: Union[str, List[str]]) -> List[str]:
         """标准化股票代码输入"""
@@ -79,7 +464,7 @@ class Quotes:
             )
 
             if uncached_codes:
-                new_quotes = srt.quotes(uncached_codes)
+                new_quotes = cls._flight('quotes', lambda codes: srt.quotes(codes)).get(uncached_codes)
                 result = cls._cache_and_merge_data(
                     result, new_quotes, 'quotes', cache_duration
                 )
@@ -153,19 +538,25 @@ class Quotes:
         )
 
         if uncached_codes:
-            if kline_type < 100 or kline_type % 15 == 0:
-                new_klines = cls.klines_from_transactions(uncached_codes, kline_type)
-            else:
-                new_klines = srt.klines(uncached_codes, kline_type, fq=0)
-            today = TradingDate.today()
-            for c, v in new_klines.items():
-                new_klines[c] = [kl for kl in v if kl[0] >= today]
+            new_klines = cls._flight(cache_key_prefix, lambda codes: cls._fetch_klines(codes, kline_type)).get(uncached_codes)
             result = cls._cache_and_merge_data(
                 result, new_klines, cache_key_prefix, cache_duration
             )
 
         return result
 
+    @classmethod
+    def _fetch_klines(cls, codes: List[str], kline_type: int) -> Dict[str, Any]:
+        """从上游获取当日K线"""
+        if kline_type < 100 or kline_type % 15 == 0:
+            new_klines = cls.klines_from_transactions(codes, kline_type)
+        else:
+            new_klines = srt.klines(codes, kline_type, fq=0)
+        today = TradingDate.today()
+        for c, v in new_klines.items():
+            new_klines[c] = [kl for kl in v if kl[0] >= today]
+        return new_klines
+
     @classmethod
     def get_transactions(cls, codes: str) -> Dict[str, Any]:
         normalized_codes = cls._normalize_codes(codes)
@@ -176,50 +567,49 @@ class Quotes:
         )
 
         if uncached_codes:
-            new_transactions = srt.transactions(uncached_codes, start=cls._cached_transaction_time(uncached_codes))
-            date = TradingDate.max_trading_date()
-            for c,v in new_transactions.items():
-                new_transactions[c] = [[t[0] if ' ' in t[0] else f'{date} {t[0]}'] + t[1:] for t in v]
-            ttl_cachedata = {c: v[-1][0] for c,v in new_transactions.items() if len(v) > 0}
+            ttl_cachedata = cls._flight('trans', lambda codes: cls._fetch_transactions(codes)).get(uncached_codes)
             result = cls._cache_and_merge_data(
                 result, ttl_cachedata, 'trans', cache_duration
             )
 
-            cls._cache_transactions(new_transactions)
-
         return cls._pick_cached_transactions(normalized_codes)
 
+    @classmethod
+    def _fetch_transactions(cls, codes: List[str]) -> Dict[str, Any]:
+        """从上游增量获取逐笔成交并缓存，返回每只股票的最新成交时间"""
+        new_transactions = srt.transactions(codes, start=cls._cached_transaction_time(codes))
+        date = TradingDate.max_trading_date()
+        for c,v in new_transactions.items():
+            new_transactions[c] = [[t[0] if ' ' in t[0] else f'{date} {t[0]}'] + t[1:] for t in v]
+        cls._cache_transactions(new_transactions)
+        return {c: v[-1][0] for c,v in new_transactions.items() if len(v) > 0}
+
     @classmethod
     def _cached_transaction_time(cls, codes: List[str]) -> Dict[str, Any]:
-        cache = get_async_lru_cache()
-        return {c: cache[f'trans_{c}'][-1][0].split(' ')[-1] if cache.get(f'trans_{c}') else '' for c in codes}
+        return {c: cls._ticks.last_time(c) for c in codes}
 
     @classmethod
     def _pick_cached_transactions(cls, codes: List[str]) -> Dict[str, Any]:
-        cache = get_async_lru_cache()
-        return {c: cache[f'trans_{c}'] for c in codes if cache.get(f'trans_{c}')}
+        result = {}
+        for c in codes:
+            ticks = cls._ticks.get(c)
+            if ticks is not None:
+                result[c] = ticks
+        return result
 
     @classmethod
     def _cache_transactions(cls, transactions: Dict[str, Any]):
-        cache = get_async_lru_cache()
         for c, v in transactions.items():
-            c_key = f'trans_{c}'
-            olddata = cache.get(c_key)
-            if not olddata:
-                cache[c_key] = v
+            if not v:
                 continue
-
-            last_cached_time = olddata[-1][0]
-            times = [t[0] for t in olddata]
-            old_valid_index = bisect_left(times, last_cached_time)
-            cache[c_key] = olddata[:old_valid_index] + [t for t in v if t[0] >= last_cached_time]
+            cls._ticks.merge(c, v[0][0].split(' ')[0], v)
 
     @classmethod
     def klines_from_transactions(cls, codes: List[str], kline_type: int) -> Dict[str, Any]:
         trans = cls.get_transactions(codes)
         result = {}
         for c, v in trans.items():
-            result[c] = cls._transactions_to_klines(v, kline_type)
+            result[c] = cls._bar_builder(c, kline_type).update(v)
         return result
 
     @classmethod
@@ -266,76 +656,22 @@ class Quotes:
         Returns:
             K线数据列表，格式为 [time, open, close, high, low, volume, amount]
         """
-        if not transactions:
-            return []
-
-        parsed: List[dict] = []
-        bar = {}
-        for trans in transactions:
-            if len(trans) == 4:
-                t, p, v, bs = trans
-            else:
-                t, p, v, a, bs = trans
-
-            if not bar and bs == 8:
-                continue
-
-            amount = p * v
-            time_str = cls._bar_time(t, kline_type)
-            if bar and bar['time'] == time_str:
-                bar['high'] = max(bar['high'], p)
-                bar['low'] = min(bar['low'], p)
-                bar['close'] = p
-                bar['volume'] += v
-                bar['amount'] += amount
-                continue
-            if bar:
-                parsed.append(bar)
-            bar = {'time': time_str, 'open': p, 'close': p, 'high': p, 'low': p, 'volume': v, 'amount': amount}
-
-        if bar:
-            parsed.append(bar)
-
-        return [[t['time'], t['open'], t['close'], t['high'], t['low'], t['volume'], t['amount']] for t in parsed]
+        return IntradayBarBuilder(kline_type).update(transactions)
 
     @classmethod
     def get_tlines(cls, codes: Union[str, List[str]]) -> List[List[Any]]:
         trans = cls.get_transactions(codes)
         result = {}
         for c, v in trans.items():
-            result[c] = cls._transactions_to_tlines(v)
+            result[c] = cls._bar_builder(c, 't').update(v)
         return result
 
     @classmethod
     def _transactions_to_tlines(cls, transactions: List[List]) -> List[List[Any]]:
-        if not transactions:
-            return []
-
-        parsed: List[dict] = []
-        bar = {}
-        for trans in transactions:
-            if len(trans) == 4:
-                t, p, v, bs = trans
-            else:
-                t, p, v, a, bs = trans
-
-            if not bar and bs == 8:
-                continue
-
-            amount = p * v
-            time_str = cls._bar_time(t, 1)
-            if bar and bar['time'] == time_str:
-                bar['price'] = p
-                bar['volume'] += v
-                bar['amount'] += amount
-                continue
-            if bar:
-                bar['avg_price'] = parsed[-1]['avg_price'] if bar['volume'] == 0 else bar['amount'] / bar['volume']
-                parsed.append(bar)
-            bar = {'time': time_str, 'price': p, 'volume': v, 'amount': amount}
-
-        if bar:
-            bar['avg_price'] = parsed[-1]['avg_price'] if bar['volume'] == 0 else bar['amount'] / bar['volume']
-            parsed.append(bar)
+        """
+        将逐笔成交数据转换为分时线
 
-        return [[t['time'], t['price'], t['volume'], t['amount'], t['avg_price']] for t in parsed]
+        Returns:
+            分时数据列表，格式为 [time, price, volume, amount, avg_price]
+        """
+        return IntradayTlineBuilder().update(transactions)
@@ -1,4 +1,5 @@
 import json
+import asyncio
 from fastapi import APIRouter, Query, HTTPException, Depends
 from typing import Optional
 from traceback import format_exc
@@ -255,17 +256,18 @@ async def stock_kline(
         codes_unfinished = []
         codes_unsaved = []
         for c in code:
-            data = await khis.read_kline(c, kltype, 0, length, start)
-            if data is None:
+            data = await khis.read_kline(c, kltype, 0, length, start, columnar=True)
+            if data is None or len(data) == 0:
                 codes_unsaved.append(c)
                 continue
-            result[c] = [list(kl.values()) for kl in data]
+            result[c] = data.tolist()
             if result[c][-1][0] < TradingDate.max_trading_date():
                 codes_unfinished.append(c)
 
         realtime_kline_enabled = await SystemSettings.get('realtime_kline_enabled', '0')
         if realtime_kline_enabled == '1' and len(codes_unfinished) > 0:
-            qklines = qot.get_klines(codes_unfinished, kltype)
+            # 行情请求和BatchSingleFlight的等待都是阻塞的，放到线程中执行
+            qklines = await asyncio.to_thread(qot.get_klines, codes_unfinished, kltype)
             for c, kl in qklines.items():
                 if c not in result:
                     result[c] = kl
@@ -275,7 +277,7 @@ async def stock_kline(
                     if fqt > 0:
                         result[c] = await khis.fix_price(c, result[c], fqt)
         if len(codes_unsaved) > 0:
-            result.update(srt.klines(codes_unsaved, kltype, length, fqt))
+            result.update(await asyncio.to_thread(srt.klines, codes_unsaved, kltype, length, fqt))
         return result
     except Exception as e:
         logger.error(e)
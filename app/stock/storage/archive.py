@@ -0,0 +1,298 @@
+import os
+import glob
+import json
+import numpy as np
+from typing import Dict, List, Optional
+from app.lofig import Config
+from .h5 import KLineStorage
+
+
+class KLineArchive:
+    """
+    K线列式归档
+
+    每种K线类型一个目录，每列一个定长二进制文件(与KLineStorage.saved_dtype相同的整数化格式)，
+    按np.memmap零拷贝读取；index.npy记录每只股票的数据段(code, offset, length)。
+    增量构建时新数据追加到列文件末尾，一只股票可能有多个数据段，compact()后每只股票只有一个数据段
+    """
+    storage = KLineStorage
+    index_dtype = np.dtype([('code', 'U16'), ('offset', 'int64'), ('length', 'int64')])
+    # 构建时每次追加的股票数上限，内存中只保留一批数据
+    build_chunk_size = 500
+
+    def __init__(self, kline_type: int = 101, root: str = None):
+        """
+        Args:
+            kline_type: K线类型
+            root: 归档目录，默认为 {history_dir}/archive/{kline_type}
+        """
+        self.kline_type = kline_type
+        self.root = root or os.path.join(Config.h5_history_dir(), 'archive', str(kline_type))
+        self.dtype = np.dtype(list(self.storage.saved_dtype.items()))
+        self._index = None
+        self._index_mtime = None
+        self._segments = {}
+        self._maps = {}
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.root, 'index.npy')
+
+    def column_path(self, col: str) -> str:
+        return os.path.join(self.root, f'{col}.bin')
+
+    @property
+    def index(self) -> np.ndarray:
+        """数据段索引，文件被修改后重新加载"""
+        mtime = os.stat(self.index_path).st_mtime_ns if os.path.isfile(self.index_path) else None
+        if self._index is None or mtime != self._index_mtime:
+            self._index = np.load(self.index_path) if mtime is not None else np.empty(0, self.index_dtype)
+            self._index_mtime = mtime
+            self._segments = {}
+            for i, code in enumerate(self._index['code'].tolist()):
+                self._segments.setdefault(code, []).append(i)
+            self._maps = {}
+        return self._index
+
+    @property
+    def nrows(self) -> int:
+        index = self.index
+        return int((index['offset'] + index['length']).max()) if len(index) else 0
+
+    def codes(self) -> List[str]:
+        self.index  # 确保索引已加载
+        return list(self._segments.keys())
+
+    def column(self, col: str) -> np.ndarray:
+        """整列数据的只读memmap，全市场扫描时配合index使用"""
+        nrows = self.nrows
+        if nrows == 0:
+            return np.empty(0, self.dtype[col])
+        if col not in self._maps:
+            self._maps[col] = np.memmap(self.column_path(col), dtype=self.dtype[col], mode='r', shape=(nrows,))
+        return self._maps[col]
+
+    def read(self, code: str, columns: List[str] = None) -> Optional[Dict[str, np.ndarray]]:
+        """
+        读取一只股票的原始整数数据
+
+        Args:
+            code: 股票代码
+            columns: 列名列表，默认全部
+
+        Returns:
+            列名到数组的映射，只有一个数据段时为memmap切片(零拷贝)；没有数据返回None
+        """
+        index = self.index
+        rows = self._segments.get(code)
+        if not rows:
+            return None
+        columns = columns or list(self.dtype.names)
+        result = {}
+        for col in columns:
+            data = self.column(col)
+            parts = [data[index[i]['offset']: index[i]['offset'] + index[i]['length']] for i in rows]
+            result[col] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return result
+
+    def read_kline_array(self, code: str, length: int = 0) -> Optional[np.ndarray]:
+        """读取并还原为与read_saved_data相同格式的结构化数组"""
+        cols = self.read(code)
+        if cols is None:
+            return None
+        n = len(cols['time'])
+        start = n - length if 0 < length < n else 0
+        data = np.empty(n - start, self.dtype)
+        for col, arr in cols.items():
+            data[col] = arr[start:]
+        return self.storage.restore_data(data, self.storage.time_only_date(self.kline_type))
+
+    def last_times(self) -> Dict[str, int]:
+        """每只股票最后一条数据的时间(YYYYMMDDhhmmss整数)"""
+        index = self.index
+        if len(index) == 0:
+            return {}
+        last_rows = [self._segments[c][-1] for c in self._segments]
+        ends = index['offset'][last_rows] + index['length'][last_rows] - 1
+        return dict(zip(self._segments.keys(), self.column('time')[ends].tolist()))
+
+    def _save_index(self, index: np.ndarray) -> None:
+        tmp = self.index_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, index)
+        os.replace(tmp, self.index_path)
+        self._index = None
+
+    def append(self, datasets: Dict[str, np.ndarray]) -> int:
+        """
+        追加多只股票的新数据，每只股票的数据需按时间排序且晚于已归档的数据
+
+        Args:
+            datasets: 股票代码到整数化结构化数组的映射
+
+        Returns:
+            追加的记录数
+        """
+        datasets = {c: d for c, d in datasets.items() if d is not None and len(d) > 0}
+        if not datasets:
+            return 0
+
+        os.makedirs(self.root, exist_ok=True)
+        nrows = self.nrows
+        segments = []
+        offset = nrows
+        for code, data in datasets.items():
+            segments.append((code, offset, len(data)))
+            offset += len(data)
+
+        for col in self.dtype.names:
+            path = self.column_path(col)
+            with open(path, 'ab') as f:
+                # 截掉上次未写完索引的数据
+                f.truncate(nrows * self.dtype[col].itemsize)
+                for data in datasets.values():
+                    f.write(np.ascontiguousarray(data[col], dtype=self.dtype[col]).tobytes())
+        self._maps = {}
+
+        self._save_index(np.concatenate([self.index, np.array(segments, dtype=self.index_dtype)]))
+        return offset - nrows
+
+    def compact(self) -> int:
+        """重写列文件，使每只股票只有一个连续数据段，返回股票数"""
+        index = self.index
+        if len(index) == 0:
+            return 0
+        codes = sorted(self._segments.keys())
+        segments = []
+        offset = 0
+        for code in codes:
+            length = int(index['length'][self._segments[code]].sum())
+            segments.append((code, offset, length))
+            offset += length
+
+        for col in self.dtype.names:
+            data = self.column(col)
+            tmp = self.column_path(col) + '.tmp'
+            with open(tmp, 'wb') as f:
+                for code in codes:
+                    for i in self._segments[code]:
+                        f.write(data[index[i]['offset']: index[i]['offset'] + index[i]['length']].tobytes())
+        self._maps = {}
+        # 先替换列文件再替换索引，中途失败时旧索引只会指向重写前的位置，需重新构建
+        for col in self.dtype.names:
+            os.replace(self.column_path(col) + '.tmp', self.column_path(col))
+        self._save_index(np.array(segments, dtype=self.index_dtype))
+        self.meta_write()
+        return len(codes)
+
+    def meta_write(self) -> None:
+        """记录归档的列格式和规模，便于其他程序直接读取列文件"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'meta.json'), 'w') as f:
+            json.dump({'kline_type': self.kline_type, 'dtype': self.dtype.descr, 'rows': self.nrows,
+                       'codes': len(self.codes())}, f)
+
+    def _complete(self, data: np.ndarray) -> np.ndarray:
+        """补齐缺失的列"""
+        if data.dtype == self.dtype:
+            return data
+        full = np.zeros(len(data), self.dtype)
+        for col in data.dtype.names:
+            if col in self.dtype.names:
+                full[col] = data[col]
+        return full
+
+    def build_from_h5(self, codes: List[str] = None) -> int:
+        """
+        从H5增量构建，只追加归档中最后时间之后的数据
+
+        Args:
+            codes: 股票代码列表，默认为H5中所有股票
+
+        Returns:
+            追加的记录数
+        """
+        storage = self.storage
+        group = storage.h5_saved_group(self.kline_type)
+        if codes is None:
+            codes = self.h5_codes()
+        last = self.last_times()
+        by_file = {}
+        for code in codes:
+            by_file.setdefault(storage.h5_saved_path(code, self.kline_type), []).append(code)
+
+        added = 0
+        try:
+            for file_path, fcodes in by_file.items():
+                for i in range(0, len(fcodes), self.build_chunk_size):
+                    datasets = {}
+                    with storage.handles.open(file_path) as f:
+                        if f is None or group not in f:
+                            break
+                        grp = f[group]
+                        for code in fcodes[i: i + self.build_chunk_size]:
+                            if code not in grp:
+                                continue
+                            dset = grp[code]
+                            start = 0
+                            if code in last:
+                                start = int(np.searchsorted(dset.fields('time')[:], last[code], 'right'))
+                            if start < len(dset):
+                                datasets[code] = self._complete(dset[start:])
+                    added += self.append(datasets)
+        finally:
+            # 释放只读句柄，其他进程才能写入这些H5文件
+            storage.handles.close()
+        self.meta_write()
+        return added
+
+    async def build_from_sqlite(self, sqlite_storage, codes: List[str] = None) -> int:
+        """
+        从SQLite增量构建，只追加归档中最后时间之后的数据
+
+        Args:
+            sqlite_storage: KLineSQLiteStorage或KLinePartitionedStorage
+            codes: 股票代码列表，默认为SQLite中该K线类型的所有股票
+
+        Returns:
+            追加的记录数
+        """
+        if codes is None:
+            codes = [c for c, t in await sqlite_storage.saved_codes() if t == self.kline_type]
+        last = self.last_times()
+        date_only = self.storage.time_only_date(self.kline_type)
+        starts = {c: None for c in codes}
+        if last:
+            known = [c for c in codes if c in last]
+            if known:
+                strs = self.storage.date_converter.int_to_time(np.array([last[c] for c in known]), date_only)
+                starts.update(zip(known, strs.tolist()))
+
+        added = 0
+        for i in range(0, len(codes), self.build_chunk_size):
+            chunk = {c: starts[c] for c in codes[i: i + self.build_chunk_size]}
+            datasets = {}
+            for code, arr in (await sqlite_storage.read_arrays_since(chunk, self.kline_type)).items():
+                if len(arr) == 0:
+                    continue
+                data = self._complete(self.storage.prepare_data(arr))
+                if code in last:
+                    data = data[data['time'] > last[code]]
+                if len(data) > 0:
+                    datasets[code] = data
+            added += self.append(datasets)
+        self.meta_write()
+        return added
+
+    def h5_codes(self) -> List[str]:
+        """H5中该K线类型的所有股票代码"""
+        storage = self.storage
+        sample = storage.h5_saved_path('xx000000', self.kline_type)
+        pattern = os.path.join(os.path.dirname(sample), '??' + os.path.basename(sample)[2:])
+        group = storage.h5_saved_group(self.kline_type)
+        codes = []
+        for file_path in sorted(glob.glob(pattern)):
+            with storage.handles.open(file_path) as f:
+                if f is not None and group in f:
+                    codes += list(f[group].keys())
+        return codes
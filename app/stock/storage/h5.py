@@ -1,8 +1,11 @@
 import os
+import time
+import threading
 import h5py
 import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Union, List, Dict, Any
-from functools import lru_cache
 from datetime import datetime
 import stockrt as srt
 from app.lofig import Config, logger
@@ -26,29 +29,215 @@ class FixedPointConverter:
         return int_array.astype('float64') / self.scale
 
 class TimeConverter:
+    """
+    时间在 YYYYMMDDhhmmss 整数、datetime64 和字符串之间转换
+    %Y-%m-%d[ %H:%M[:%S]] 格式按字节矩阵做整数运算，其他格式逐个用datetime转换
+    """
+    fast_fmts = {'%Y-%m-%d': 10, '%Y-%m-%d %H:%M': 16, '%Y-%m-%d %H:%M:%S': 19}
+    # 年月日时分秒各数字在 YYYY-MM-DD hh:mm:ss 中的位置
+    digit_pos = np.array([0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18])
+    digit_weight = 10 ** np.arange(13, -1, -1, dtype=np.int64)
+    template = np.frombuffer(b'0000-00-00 00:00:00', dtype=np.uint8)
+
     def __init__(self, time_fmt='%Y-%m-%d %H:%M:%S'):
         self.time_fmt = time_fmt
 
     def time_to_int(self, date_strs: np.ndarray):
-        """将字符串数组转为int时间（如20231129093000）"""
+        """将字符串或datetime64数组转为int时间（如20231129093000）"""
         if isinstance(date_strs, str):
             date_strs = np.array([date_strs])
+        date_strs = np.asarray(date_strs)
+        if date_strs.dtype.kind == 'M':
+            return self.datetime64_to_int(date_strs)
+        if self.time_fmt not in self.fast_fmts:
+            return self._time_to_int_slow(date_strs)
+
+        # 不足19位的部分填充为\0，按0处理
+        raw = np.ascontiguousarray(date_strs.astype('S19')).view(np.uint8).reshape(-1, 19)[:, self.digit_pos]
+        valid = ((raw >= 48) & (raw <= 57)) | (raw == 0)
+        if not valid.all():
+            raise ValueError(f'invalid time string: {date_strs.ravel()[~valid.all(axis=1)][0]}')
+        digits = np.where(raw == 0, 0, raw.astype(np.int64) - 48)
+        return digits @ self.digit_weight
+
+    def int_to_time(self, date_ints: np.ndarray, date_only=False):
+        """
+        将int时间数组转为字符串
+
+        Args:
+            date_ints: int时间数组
+            date_only: 只输出日期部分 YYYY-MM-DD
+        """
+        if np.isscalar(date_ints):
+            date_ints = np.array([date_ints])
+        date_ints = np.asarray(date_ints, dtype=np.int64)
+        if self.time_fmt not in self.fast_fmts:
+            return self._int_to_time_slow(date_ints, date_only)
+
+        width = 10 if date_only else self.fast_fmts[self.time_fmt]
+        ndigits = np.searchsorted(self.digit_pos, width)
+        mat = np.tile(self.template[:width], (len(date_ints), 1))
+        mat[:, self.digit_pos[:ndigits]] = date_ints[:, None] // self.digit_weight[:ndigits] % 10 + 48
+        return mat.view(f'S{width}').ravel().astype(f'U{width}')
+
+    def int_to_date(self, date_ints: np.ndarray):
+        """将int时间数组转为日期字符串 YYYY-MM-DD"""
+        return self.int_to_time(date_ints, date_only=True)
+
+    @staticmethod
+    def date_part(date_strs: np.ndarray):
+        """截取时间字符串数组的日期部分，只改变字符串宽度，不逐个解析"""
+        return np.asarray(date_strs).astype('U10')
+
+    @staticmethod
+    def int_to_datetime64(date_ints: np.ndarray):
+        """将int时间数组转为datetime64[s]"""
+        date_ints = np.asarray(date_ints, dtype=np.int64)
+        ymd, hms = np.divmod(date_ints, 1000000)
+        year, md = np.divmod(ymd, 10000)
+        month, day = np.divmod(md, 100)
+        hour, ms = np.divmod(hms, 10000)
+        minute, second = np.divmod(ms, 100)
+        months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+        days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+        return days.astype('datetime64[s]') + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+
+    @staticmethod
+    def datetime64_to_int(dts: np.ndarray):
+        """将datetime64数组转为int时间"""
+        dts = np.asarray(dts).astype('datetime64[s]')
+        days = dts.astype('datetime64[D]')
+        months = dts.astype('datetime64[M]')
+        years = dts.astype('datetime64[Y]')
+        year = years.astype(np.int64) + 1970
+        month = (months - years.astype('datetime64[M]')).astype(np.int64) + 1
+        day = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+        secs = (dts - days.astype('datetime64[s]')).astype(np.int64)
+        hour, secs = np.divmod(secs, 3600)
+        minute, second = np.divmod(secs, 60)
+        return (year * 10000 + month * 100 + day) * 1000000 + hour * 10000 + minute * 100 + second
+
+    def _time_to_int_slow(self, date_strs: np.ndarray):
         date_strs = np.where(np.char.str_len(date_strs) == 10, np.char.add(date_strs, ' 00:00:00'), date_strs)
         date_strs = np.where(np.char.str_len(date_strs) == 16, np.char.add(date_strs, ':00'), date_strs)
         fmt = self.time_fmt if '%S' in self.time_fmt else self.time_fmt + ':%S'
         dt = np.vectorize(lambda s: int(datetime.strptime(s, fmt).strftime('%Y%m%d%H%M%S')))
         return dt(date_strs)
 
-    def int_to_time(self, date_ints: np.ndarray):
-        """将int时间数组转为字符串"""
-        if np.isscalar(date_ints):
-            date_ints = np.array([date_ints])
-        dt = np.vectorize(lambda i: datetime.strptime(str(i), '%Y%m%d%H%M%S').strftime(self.time_fmt))
+    def _int_to_time_slow(self, date_ints: np.ndarray, date_only=False):
+        fmt = '%Y-%m-%d' if date_only else self.time_fmt
+        dt = np.vectorize(lambda i: datetime.strptime(str(i), '%Y%m%d%H%M%S').strftime(fmt))
         return dt(date_ints)
 
 
+class H5HandlePool:
+    """
+    HDF5文件句柄池
+
+    只读打开的文件保持打开，读操作共用已打开的句柄；写操作以读写模式打开，写完即关闭，
+    避免HDF5文件锁使其他进程无法打开该文件。其他进程写入前需调用close()关闭只读句柄。
+    所有访问通过同一把锁串行化(h5py本身也不支持并发访问)。
+    每个数据集有一个版本号，写入后递增，读缓存据此判断是否失效；
+    文件被其他进程修改(mtime变化)时重新打开，该文件所有数据集的缓存失效
+    """
+    def __init__(self, max_open: int = 32):
+        """
+        Args:
+            max_open: 最多同时打开的文件数，超出时关闭最久未使用的文件
+        """
+        self.max_open = max_open
+        self.lock = threading.RLock()
+        self.files: 'OrderedDict[str, list]' = OrderedDict()  # path -> [File, writable, mtime]
+        self.versions: Dict[tuple, int] = {}
+        self.file_versions: Dict[str, int] = {}
+        self.pid = os.getpid()
+        self._inherited = []
+
+    @staticmethod
+    def _mtime(path: str):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _close(self, path: str) -> None:
+        entry = self.files.pop(path, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _entry(self, path: str, write: bool):
+        if os.getpid() != self.pid:
+            # fork出的子进程不能使用父进程的句柄，也不能关闭它们
+            self.pid = os.getpid()
+            self._inherited = list(self.files.values())
+            self.files = OrderedDict()
+
+        entry = self.files.get(path)
+        if entry is not None:
+            if self._mtime(path) != entry[2]:
+                self._close(path)
+                self.file_versions[path] = self.file_versions.get(path, 0) + 1
+                entry = None
+            elif write and not entry[1]:
+                self._close(path)
+                entry = None
+
+        if entry is None:
+            if not write and not os.path.isfile(path):
+                return None
+            entry = [h5py.File(path, 'a' if write else 'r'), write, None]
+            entry[2] = self._mtime(path)
+            self.files[path] = entry
+            while len(self.files) > self.max_open:
+                self._close(next(iter(self.files)))
+        self.files.move_to_end(path)
+        return entry
+
+    @contextmanager
+    def open(self, path: str, write: bool = False):
+        """
+        获取打开的文件，只读时文件不存在返回None
+
+        Args:
+            path: 文件路径
+            write: 是否需要写入
+        """
+        with self.lock:
+            entry = self._entry(path, write)
+            if entry is None:
+                yield None
+                return
+            try:
+                yield entry[0]
+            finally:
+                if write:
+                    # 不保留读写句柄，之后的读操作以只读模式重新打开
+                    self._close(path)
+
+    def version(self, path: str, group: str, name: str) -> tuple:
+        """数据集当前的版本号"""
+        return self.file_versions.get(path, 0), self.versions.get((path, group, name), 0)
+
+    def bump(self, path: str, group: str, name: str) -> None:
+        """数据集被修改，使其读缓存失效"""
+        key = (path, group, name)
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+    def close(self, path: str = None) -> None:
+        """关闭指定文件或所有文件，需要其他进程写入这些文件前调用"""
+        with self.lock:
+            for p in [path] if path else list(self.files.keys()):
+                self._close(p)
+                self.file_versions[p] = self.file_versions.get(p, 0) + 1
+
+
 class H5Storage:
-    hdf5_compress_level = 9
+    # 新建数据集的分块和压缩参数，已有数据集保持创建时的参数
+    # chunk_rows: 每块行数，None由h5py自动选择; compression: 'gzip'/'lzf'/None; level: gzip压缩级别
+    h5_profile = {'chunk_rows': None, 'compression': 'gzip', 'level': 9, 'shuffle': False}
+    handles = H5HandlePool()
+    read_cache_size = 2000
+    _read_cache = OrderedDict()
     saved_dtype = {}
     restore_dtype = {'time': 'U20','volume': 'int64'}
     saved_kline_types = [101]
@@ -177,13 +366,19 @@ class H5Storage:
         return df_int
 
     @classmethod
-    def restore_data(cls, df_int):
-        """还原为浮点数"""
+    def restore_data(cls, df_int, date_only=False):
+        """
+        还原为浮点数
+
+        Args:
+            df_int: 整数化数据
+            date_only: 时间只保留日期部分
+        """
         dtypes = [(col, cls.restore_dtype.get(col, 'float64')) for col in df_int.dtype.names]
         df_float = np.empty(len(df_int), dtype=dtypes)
 
         if 'time' in df_int.dtype.names:
-            df_float['time'] = cls.date_converter.int_to_time(df_int['time'])
+            df_float['time'] = cls.date_converter.int_to_time(df_int['time'], date_only)
 
         for col in cls.price_cols:
             if col not in df_int.dtype.names:
@@ -212,82 +407,146 @@ class H5Storage:
         return 'data'
 
     @classmethod
-    def save_dataset(cls, fcode: str, ds_data = None, kline_type: Union[int, str] = 101):
-        """新数据连续且按时间排序"""
-        if ds_data is None or len(ds_data) == 0:
-            return
+    def profile(cls, kline_type: int = 101) -> Dict[str, Any]:
+        """数据集的存储参数"""
+        return cls.h5_profile
+
+    @classmethod
+    def dataset_options(cls, kline_type: int = 101) -> Dict[str, Any]:
+        """由存储参数生成create_dataset的参数"""
+        profile = cls.profile(kline_type)
+        options = {'chunks': (profile['chunk_rows'],) if profile.get('chunk_rows') else True}
+        if profile.get('compression'):
+            options['compression'] = profile['compression']
+            if profile['compression'] == 'gzip':
+                options['compression_opts'] = profile.get('level', 4)
+        if profile.get('shuffle'):
+            options['shuffle'] = True
+        return options
 
+    @classmethod
+    def to_saved_array(cls, ds_data) -> np.ndarray:
+        """list-of-dict或结构化数组转为整数化的保存格式"""
         # 处理数据格式：如果是list-of-dict，转换为numpy数组
         if isinstance(ds_data, list):
             dtypes = cls.saved_dtype.copy()
             dtypes.update(cls.restore_dtype)
             ds_data = cls.list_of_dicts_to_numpy(ds_data, dtypes)
-        elif ds_data is None:
+        return cls.prepare_data(ds_data)
+
+    @classmethod
+    def _append_dataset(cls, grp, ds_name: str, dset_int: np.ndarray, kline_type: int = 101) -> None:
+        """追加数据到数据集，与已保存的最后时间相同的记录被覆盖，数据集只扩展一次"""
+        if ds_name not in grp:
+            grp.create_dataset(ds_name, data=dset_int, maxshape=(None,), **cls.dataset_options(kline_type))
+            return
+
+        dset = grp[ds_name]
+
+        if len(dset) == 0:
+            dset.resize((len(dset_int),))
+            dset[:] = dset_int
             return
 
-        dset_int = cls.prepare_data(ds_data)
+        last_saved_time = dset[-1]['time']
+        new_first_time = dset_int[0]['time']
+
+        newer_mask = dset_int['time'] >= last_saved_time
+        newer_data = dset_int[newer_mask]
+        last_time_count = cls._tail_count(dset, last_saved_time)
+        new_size = len(newer_data) if new_first_time > last_saved_time else len(newer_data) - last_time_count
+        if new_size > 0:
+            dset.resize((len(dset) + new_size,))
+        dset[-len(newer_data):] = newer_data
+
+    @staticmethod
+    def _tail_count(dset, last_time) -> int:
+        """数据集末尾时间等于last_time的记录数，只读取末尾部分"""
+        n = min(len(dset), 256)
+        while True:
+            tail = dset.fields('time')[-n:]
+            count = int((tail == last_time).sum())
+            if count < n or n == len(dset):
+                return count
+            n = min(len(dset), n * 4)
+
+    @classmethod
+    def save_dataset(cls, fcode: str, ds_data = None, kline_type: Union[int, str] = 101):
+        """新数据连续且按时间排序"""
+        if ds_data is None or len(ds_data) == 0:
+            return
+
+        dset_int = cls.to_saved_array(ds_data)
         file_path = cls.h5_saved_path(fcode, kline_type)
         group = cls.h5_saved_group(kline_type)
-        ds_name = fcode
-
-        with h5py.File(file_path, 'a') as f:
-            if group not in f:
-                grp = f.create_group(group)
-            else:
-                grp = f[group]
 
-            if ds_name not in grp:
-                grp.create_dataset(
-                    ds_name, data=dset_int, maxshape=(None,), compression='gzip', compression_opts=cls.hdf5_compress_level)
-                return
+        with cls.handles.open(file_path, write=True) as f:
+            cls.handles.bump(file_path, group, fcode)
+            grp = f.require_group(group)
+            cls._append_dataset(grp, fcode, dset_int, kline_type)
 
-            dset = grp[ds_name]
+    @classmethod
+    def save_datasets(cls, datasets: Dict[str, Any], kline_type: int = 101) -> List[Dict[str, Any]]:
+        """
+        批量保存多只股票的数据，同一文件的数据集在一次打开中写入
 
-            if len(dset) == 0:
-                dset.resize((len(dset_int),))
-                dset[:] = dset_int
-                return
+        Args:
+            datasets: 股票代码到数据(list-of-dict或结构化数组)的映射
+            kline_type: K线类型
 
-            last_saved_time = dset[-1]['time']
-            new_first_time = dset_int[0]['time']
+        Returns:
+            每个文件的写入统计 [{'file', 'codes', 'rows', 'seconds'}]
+        """
+        by_file = {}
+        for fcode, ds_data in datasets.items():
+            if ds_data is not None and len(ds_data) > 0:
+                by_file.setdefault(cls.h5_saved_path(fcode, kline_type), []).append((fcode, ds_data))
 
-            newer_mask = dset_int['time'] >= last_saved_time
-            newer_data = dset_int[newer_mask]
-            last_time_count = (dset['time'] == last_saved_time).sum()
-            new_size = len(newer_data) if new_first_time > last_saved_time else len(newer_data) - last_time_count
-            if new_size > 0:
-                dset.resize((len(dset) + new_size,))
-            dset[-len(newer_data):] = newer_data
+        group = cls.h5_saved_group(kline_type)
+        stats = []
+        for file_path, items in by_file.items():
+            stime = time.time()
+            prepared = [(fcode, cls.to_saved_array(ds_data)) for fcode, ds_data in items]
+            with cls.handles.open(file_path, write=True) as f:
+                grp = f.require_group(group)
+                for fcode, dset_int in prepared:
+                    cls.handles.bump(file_path, group, fcode)
+                    cls._append_dataset(grp, fcode, dset_int, kline_type)
+            stats.append({'file': file_path, 'codes': len(prepared), 'rows': sum(len(d) for _, d in prepared),
+                          'seconds': time.time() - stime})
+        return stats
 
     @classmethod
-    @lru_cache(maxsize=2000)
     def read_saved_data(cls, fcode: str, length: int=0, kline_type: int=101) -> np.ndarray:
-        '''从HDF5文件中读取数据'''
+        '''从HDF5文件中读取数据，数据集未被修改时返回缓存的结果'''
         if kline_type not in cls.saved_kline_types:
             logger.error(f'kline_type {kline_type} not in (1, 5, 15, 101, 102, 103, 104, 105, 106)')
             return
         file_path = cls.h5_saved_path(fcode, kline_type)
-        if not os.path.isfile(file_path):
-            return
         group = cls.h5_saved_group(kline_type)
-        with h5py.File(file_path, 'r') as f:
-            if group not in f or fcode not in f[group]:
+        with cls.handles.open(file_path) as f:
+            if f is None or group not in f or fcode not in f[group]:
                 return
+            key = (cls, fcode, length, kline_type)
+            version = cls.handles.version(file_path, group, fcode)
+            cached = cls._read_cache.get(key)
+            if cached is not None and cached[0] == version:
+                cls._read_cache.move_to_end(key)
+                return cached[1]
             final_len = length if length > 0 else len(f[group][fcode])
-            klines = cls.restore_data(f[group][fcode][-final_len:])
-            if cls.time_only_date(kline_type):
-                klines['time'] = np.vectorize(lambda x: x.split(' ')[0])(klines['time'])
-            return klines
+            data = cls.restore_data(f[group][fcode][-final_len:], cls.time_only_date(kline_type))
+            cls._read_cache[key] = (version, data)
+            while len(cls._read_cache) > cls.read_cache_size:
+                cls._read_cache.popitem(last=False)
+            return data
 
     @classmethod
     def _min_max_date(cls, max_or_min: bool, fcode: str,  kline_type: int=101):
         """获取最大/最小日期"""
         file_path = cls.h5_saved_path(fcode, kline_type)
-        if not os.path.isfile(file_path):
-            return ''
         group = cls.h5_saved_group(kline_type)
-        with h5py.File(file_path, 'r') as f:
-            if group not in f or fcode not in f[group]:
+        with cls.handles.open(file_path) as f:
+            if f is None or group not in f or fcode not in f[group]:
                 return ''
             dset = f[group][fcode]
             if len(dset) == 0:
@@ -298,6 +557,33 @@ class H5Storage:
                 fl_time_str = fl_time_str.split(' ')[0]
             return fl_time_str
 
+    @classmethod
+    def max_dates(cls, fcodes: List[str], kline_type: int = 101) -> Dict[str, str]:
+        """
+        批量获取最大日期，同一文件只打开一次
+
+        Returns:
+            股票代码到最大日期的映射，没有数据的股票不包含在内
+        """
+        by_file = {}
+        for fcode in fcodes:
+            by_file.setdefault(cls.h5_saved_path(fcode, kline_type), []).append(fcode)
+
+        group = cls.h5_saved_group(kline_type)
+        times = {}
+        for file_path, codes in by_file.items():
+            with cls.handles.open(file_path) as f:
+                if f is None or group not in f:
+                    continue
+                grp = f[group]
+                for fcode in codes:
+                    if fcode in grp and len(grp[fcode]) > 0:
+                        times[fcode] = grp[fcode][-1]['time']
+        if not times:
+            return {}
+        strs = cls.date_converter.int_to_time(np.array(list(times.values())), cls.time_only_date(kline_type))
+        return dict(zip(times.keys(), strs.tolist()))
+
     @classmethod
     def max_date(cls, fcode: str, kline_type: int=101):
         """获取最大/最小日期"""
@@ -314,10 +600,11 @@ class H5Storage:
         file_path = cls.h5_saved_path(fcode, kline_type)
         if not os.path.isfile(file_path):
             return
-        with h5py.File(file_path, 'a') as f:
-            group = cls.h5_saved_group(kline_type)
+        group = cls.h5_saved_group(kline_type)
+        with cls.handles.open(file_path, write=True) as f:
             if group in f and fcode in f[group]:
                 del f[group][fcode]
+                cls.handles.bump(file_path, group, fcode)
 
 class KLineStorage(H5Storage):
     saved_dtype = {
@@ -337,6 +624,13 @@ class KLineStorage(H5Storage):
     saved_kline_types = [1, 5, 15, 101, 102, 103, 104, 105, 106]
     price_cols = ['open', 'high', 'low', 'close', 'change', 'change_px', 'amplitude', 'turnover']
     amount_cols = ['amount', 'volume']
+    h5_profile = {'chunk_rows': 256, 'compression': 'gzip', 'level': 4, 'shuffle': True}
+    # 分钟K线每日追加240/48/16条，低压缩级别写入快得多，文件反而比gzip 9更小
+    h5_minute_profile = {'chunk_rows': 1024, 'compression': 'gzip', 'level': 1, 'shuffle': True}
+
+    @classmethod
+    def profile(cls, kline_type: int = 101) -> Dict[str, Any]:
+        return cls.h5_minute_profile if kline_type < 100 else cls.h5_profile
 
     @staticmethod
     def default_kline_cache_size(kltype: int=101) -> int:
@@ -437,6 +731,7 @@ class FflowStorage(H5Storage):
     price_cols = ['mainp', 'smallp', 'middlep', 'bigp', 'superp']
     amount_cols = ['main', 'small', 'middle', 'big', 'super']
     saved_kline_types = [101]
+    h5_profile = {'chunk_rows': 256, 'compression': 'gzip', 'level': 4, 'shuffle': True}
 
     @classmethod
     def h5_saved_path(cls, fcode: str=None, kline_type: int=101) -> str:
@@ -486,6 +781,8 @@ class TransactionStorage(H5Storage):
     }
 
     price_cols = ['price']
+    # 每只股票每日数千条成交
+    h5_profile = {'chunk_rows': 4096, 'compression': 'gzip', 'level': 4, 'shuffle': True}
 
     @classproperty
     def date_converter(cls):
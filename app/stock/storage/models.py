@@ -1,15 +1,21 @@
 """股票数据存储模型定义"""
-from sqlalchemy import Column, String, Integer, Float, Index, Table, MetaData
+from sqlalchemy import Column, String, Integer, Float, LargeBinary, Index, Table, MetaData
 
 
 # 创建独立的元数据对象
 KLineMetaData = MetaData()
 FflowMetaData = MetaData()
 TransactionMetaData = MetaData()
+KLinePartMetaData = MetaData()
+TransactionBlockMetaData = MetaData()
+WatermarkMetaData = MetaData()
+UpdateJournalMetaData = MetaData()
 
 
 def create_kline_table(table_name):
     """动态创建K线数据表"""
+    if table_name in KLineMetaData.tables:
+        return KLineMetaData.tables[table_name]
     return Table(
         table_name,
         KLineMetaData,
@@ -28,8 +34,35 @@ def create_kline_table(table_name):
     )
 
 
+def create_kline_partition_table(kline_type):
+    """创建按K线类型分区的K线数据表，所有股票共用，(code, time)为聚簇主键"""
+    table_name = f"klines_{kline_type}"
+    if table_name in KLinePartMetaData.tables:
+        return KLinePartMetaData.tables[table_name]
+    return Table(
+        table_name,
+        KLinePartMetaData,
+        Column('code', String(20), primary_key=True, comment="股票代码"),
+        Column('time', String(20), primary_key=True, comment="时间"),
+        Column('open', Float, nullable=False, default=0.0, comment="开盘价"),
+        Column('close', Float, nullable=False, default=0.0, comment="收盘价"),
+        Column('high', Float, nullable=False, default=0.0, comment="最高价"),
+        Column('low', Float, nullable=False, default=0.0, comment="最低价"),
+        Column('volume', Integer, nullable=False, default=0, comment="成交量"),
+        Column('amount', Float, nullable=False, default=0.0, comment="成交额"),
+        Column('change', Float, nullable=False, default=0.0, comment="涨跌额"),
+        Column('change_px', Float, nullable=False, default=0.0, comment="涨跌幅"),
+        Column('amplitude', Float, nullable=False, default=0.0, comment="振幅"),
+        Column('turnover', Float, nullable=False, default=0.0, comment="换手率"),
+        Index(f'idx_{table_name}_time', 'time'),
+        sqlite_with_rowid=False,
+    )
+
+
 def create_fflow_table(table_name):
     """动态创建资金流数据表"""
+    if table_name in FflowMetaData.tables:
+        return FflowMetaData.tables[table_name]
     return Table(
         table_name,
         FflowMetaData,
@@ -50,6 +83,8 @@ def create_fflow_table(table_name):
 
 def create_transaction_table(table_name):
     """动态创建交易数据表"""
+    if table_name in TransactionMetaData.tables:
+        return TransactionMetaData.tables[table_name]
     return Table(
         table_name,
         TransactionMetaData,
@@ -61,3 +96,57 @@ def create_transaction_table(table_name):
         Column('bs', Integer, nullable=False, default=0, comment="买卖方向：1:buy, 2:sell, 0:中性/不明, 8:集合竞价"),
         Index(f'idx_{table_name}_time', 'time')
     )
+
+
+def create_transaction_block_table():
+    """创建按(股票代码, 交易日)分块的成交数据表，每个交易日的成交压缩为一个列式数据块"""
+    table_name = "trans_blocks"
+    if table_name in TransactionBlockMetaData.tables:
+        return TransactionBlockMetaData.tables[table_name]
+    return Table(
+        table_name,
+        TransactionBlockMetaData,
+        Column('code', String(20), primary_key=True, comment="股票代码"),
+        Column('date', String(10), primary_key=True, comment="交易日"),
+        Column('first_time', String(20), nullable=False, comment="首笔成交时间"),
+        Column('last_time', String(20), nullable=False, comment="末笔成交时间"),
+        Column('count', Integer, nullable=False, default=0, comment="成交记录数"),
+        Column('data', LargeBinary, nullable=False, comment="压缩的列式数据块"),
+        sqlite_with_rowid=False,
+    )
+
+
+def create_watermark_table():
+    """创建水位表，记录每只股票每种类型已保存数据的最新时间"""
+    table_name = "watermarks"
+    if table_name in WatermarkMetaData.tables:
+        return WatermarkMetaData.tables[table_name]
+    return Table(
+        table_name,
+        WatermarkMetaData,
+        Column('code', String(20), primary_key=True, comment="股票代码"),
+        Column('kltype', Integer, primary_key=True, comment="K线类型"),
+        Column('time', String(20), nullable=False, comment="最新时间"),
+        sqlite_with_rowid=False,
+    )
+
+
+def create_update_journal_table():
+    """创建更新日志表，记录每个交易日各任务步骤和批次的执行状态"""
+    table_name = "update_journal"
+    if table_name in UpdateJournalMetaData.tables:
+        return UpdateJournalMetaData.tables[table_name]
+    return Table(
+        table_name,
+        UpdateJournalMetaData,
+        Column('date', String(10), primary_key=True, comment="交易日"),
+        Column('task', String(32), primary_key=True, comment="任务名称"),
+        Column('step', String(64), primary_key=True, comment="步骤名称"),
+        Column('batch', Integer, primary_key=True, comment="批次序号，0为步骤本身"),
+        Column('status', String(10), nullable=False, comment="状态: pending/done/failed"),
+        Column('codes', String, nullable=False, default='', comment="批次包含的股票代码，逗号分隔"),
+        Column('attempts', Integer, nullable=False, default=0, comment="已执行次数"),
+        Column('error', String, nullable=False, default='', comment="最近一次失败的错误信息"),
+        Column('updated', String(20), nullable=False, comment="更新时间"),
+        sqlite_with_rowid=False,
+    )
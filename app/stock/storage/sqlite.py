@@ -4,14 +4,122 @@ from datetime import datetime, timedelta
 from functools import lru_cache
 import asyncio
 import sqlite3
+import zlib
+import numpy as np
 from sqlalchemy import select, delete, func, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker
 from app.lofig import Config, logger
-from app.stock.storage.models import create_kline_table, create_fflow_table, create_transaction_table
+from app.db import set_sqlite_pragmas
+from app.stock.storage.models import (
+    create_kline_table, create_kline_partition_table, create_fflow_table, create_transaction_table,
+    create_transaction_block_table, create_watermark_table, create_update_journal_table)
+from app.stock.storage.h5 import TimeConverter
 import stockrt as srt
 
 
+class SQLiteWriter:
+    """
+    单写入者批量提交队列
+
+    每个数据库文件一个写入协程，写操作按提交顺序执行。队列中已有的多个写操作合并到一个事务中提交，
+    事务中的记录数达到max_rows时提交；max_delay大于0时，队列为空后最多再等待max_delay秒以合并更多写操作。
+    合并提交失败时逐个重新提交，只有出错的写操作失败。
+    """
+    writers = {}
+    max_rows = 50000
+    max_delay = 0.0
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.loop = None
+        self.queue = None
+        self.task = None
+
+    @classmethod
+    def of(cls, storage) -> 'SQLiteWriter':
+        """获取数据库文件对应的写入队列，同一数据库的多个存储实例共用"""
+        if storage.db_path not in cls.writers:
+            cls.writers[storage.db_path] = cls(storage)
+        return cls.writers[storage.db_path]
+
+    def _ensure_task(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.task is None or self.task.done():
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            self.task = loop.create_task(self._run())
+
+    def submit(self, op, nrows: int = 1) -> asyncio.Future:
+        """
+        提交写操作
+
+        Args:
+            op: 以session为参数的协程函数，在写入事务中执行，返回值作为结果
+            nrows: 写入的记录数，用于控制事务大小
+
+        Returns:
+            事务提交后完成的Future，结果为op的返回值
+        """
+        self._ensure_task()
+        fut = self.loop.create_future()
+        self.queue.put_nowait((op, nrows, fut))
+        return fut
+
+    async def flush(self):
+        """等待已提交的写操作全部提交到数据库"""
+        if self.queue is not None and self.loop is asyncio.get_running_loop():
+            await self.queue.join()
+
+    async def _next_batch(self) -> list:
+        batch = [await self.queue.get()]
+        nrows = batch[0][1]
+        deadline = self.loop.time() + self.max_delay
+        while nrows < self.max_rows:
+            if self.queue.empty():
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                item = self.queue.get_nowait()
+            batch.append(item)
+            nrows += item[1]
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._commit(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _commit(self, batch: list):
+        try:
+            async with self.storage.get_session() as session:
+                results = [await op(session) for op, _, _ in batch]
+                await session.commit()
+        except Exception as e:
+            if len(batch) > 1:
+                for item in batch:
+                    await self._commit([item])
+                return
+            logger.error(f"{self.storage.db_name} 写入失败: {e}")
+            fut = batch[0][2]
+            if not fut.done():
+                fut.set_exception(e)
+            return
+
+        for (_, _, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
+
+
 class SQLiteStorage:
     """SQLite存储基类"""
 
@@ -26,6 +134,9 @@ class SQLiteStorage:
         self._db_path = None
         self._engine = None
         self._session_maker = None
+        self._watermarks_ready = False
+        self._watermarks_lock = None
+        self._unflushed = []
         self.create_table_func = None
 
     @property
@@ -43,14 +154,14 @@ class SQLiteStorage:
             # 确保目录存在
             os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
             database_url = f"sqlite+aiosqlite:///{self.db_path}"
-            self._engine = create_async_engine(
+            self._engine = set_sqlite_pragmas(create_async_engine(
                 database_url, 
                 echo=False,
                 connect_args={
                     "check_same_thread": False,
                     "timeout": 20
                 }
-            )
+            ))
         return self._engine
 
     @property
@@ -59,14 +170,14 @@ class SQLiteStorage:
         if not hasattr(self, '_sync_engine'):
             database_url = f"sqlite:///{self.db_path}"
             from sqlalchemy import create_engine
-            self._sync_engine = create_engine(
+            self._sync_engine = set_sqlite_pragmas(create_engine(
                 database_url,
                 echo=False,
                 connect_args={
                     "check_same_thread": False,
                     "timeout": 20
                 }
-            )
+            ))
         return self._sync_engine
 
     @property
@@ -84,14 +195,58 @@ class SQLiteStorage:
         """获取异步数据库会话"""
         return self.session_maker()
 
+    @property
+    def writer(self) -> SQLiteWriter:
+        return SQLiteWriter.of(self)
+
+    async def write(self, op, nrows: int = 1, wait: bool = True, key: Any = None):
+        """
+        通过写入队列执行写操作
+
+        Args:
+            op: 以session为参数的协程函数
+            nrows: 写入的记录数
+            wait: 是否等待事务提交；为False时立即返回None，需调用flush()等待并获取失败的写操作
+            key: 不等待时用于标识写操作的值(如股票代码)，由flush()返回
+
+        Returns:
+            op的返回值
+        """
+        fut = self.writer.submit(op, nrows)
+        if wait:
+            return await fut
+        # 错误已由写入队列记录，flush()时返回给调用者
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._unflushed.append((key, fut))
+        return None
+
+    async def flush(self) -> List[tuple]:
+        """
+        等待通过写入队列提交的数据全部写入数据库
+
+        Returns:
+            上次flush()之后不等待提交(wait=False)且写入失败的[(key, 异常)]列表
+        """
+        await self.writer.flush()
+        pending, self._unflushed = self._unflushed, []
+        if pending:
+            await asyncio.gather(*[fut for _, fut in pending], return_exceptions=True)
+        return [(key, fut.exception()) for key, fut in pending if not fut.cancelled() and fut.exception() is not None]
+
     async def create_table(self, table_name: str):
         """创建表（如果不存在）"""
         if callable(self.create_table_func):
             table = self.create_table_func(table_name)
             table.create(self.sync_engine, checkfirst=True)
 
+    async def create_table_in(self, session, table_name: str):
+        """在写入事务中创建表（如果不存在），避免同步引擎等待写入队列持有的锁"""
+        if callable(self.create_table_func):
+            table = self.create_table_func(table_name)
+            await session.run_sync(lambda s: table.create(s.connection(), checkfirst=True))
+
     async def insert_data(self, fcode: str, kline_type: int=101, data: List[Dict[str, Any]]=None,
-                         conflict_strategy: str = "REPLACE") -> int:
+                         conflict_strategy: str = "REPLACE", wait: bool = True) -> int:
         """
         插入数据到表中
 
@@ -99,17 +254,17 @@ class SQLiteStorage:
             table_name: 表名
             data: 数据列表，每个元素是字典
             conflict_strategy: 冲突处理策略（REPLACE或IGNORE）
+            wait: 是否等待写入队列提交
 
         Returns:
-            插入的记录数
+            插入的记录数，不等待时返回提交的记录数
         """
         if not data:
             return 0
 
         table_name = self.get_table_name(fcode, kline_type)
-        # 确保表存在
-        if not await self.table_exists(table_name):
-            await self.create_table(table_name)
+        # 表不存在时在写入事务中创建
+        missing = not await self.table_exists(table_name)
 
         columns = list(data[0].keys())
         placeholders = ", ".join([f":{col}" for col in columns])
@@ -117,11 +272,137 @@ class SQLiteStorage:
 
         sql = f"INSERT OR {conflict_strategy} INTO {table_name} ({columns_str}) VALUES ({placeholders})"
 
-        async with self.get_session() as session:
+        async def op(session):
+            if missing:
+                await self.create_table_in(session, table_name)
             result = await session.execute(text(sql), data)
-            await session.commit()
+            await self.update_watermark(session, fcode, kline_type, data)
             return result.rowcount
 
+        await self.ensure_watermarks()
+        count = await self.write(op, len(data), wait, fcode)
+        return len(data) if count is None else count
+
+    async def insert_data_many(self, datasets: Dict[str, List[Dict[str, Any]]], kline_type: int = 101,
+                               conflict_strategy: str = "REPLACE") -> int:
+        """
+        在一个事务中插入多只股票的数据
+
+        Args:
+            datasets: 股票代码到数据列表的映射
+            kline_type: K线类型
+            conflict_strategy: 冲突处理策略（REPLACE或IGNORE）
+
+        Returns:
+            插入的记录数
+        """
+        datasets = {c: d for c, d in datasets.items() if d}
+        if not datasets:
+            return 0
+
+        tables = set(await self.all_tables())
+
+        async def op(session):
+            count = 0
+            for fcode, data in datasets.items():
+                if self.get_table_name(fcode, kline_type) not in tables:
+                    await self.create_table_in(session, self.get_table_name(fcode, kline_type))
+                columns = list(data[0].keys())
+                sql = f"""INSERT OR {conflict_strategy} INTO {self.get_table_name(fcode, kline_type)}
+                    ({', '.join(columns)}) VALUES ({', '.join(f':{col}' for col in columns)})"""
+                result = await session.execute(text(sql), data)
+                await self.update_watermark(session, fcode, kline_type, data)
+                count += result.rowcount
+            return count
+
+        await self.ensure_watermarks()
+        return await self.write(op, sum(len(d) for d in datasets.values()))
+
+    async def ensure_watermarks(self):
+        """创建水位表，首次创建时由已有数据重建"""
+        if self._watermarks_ready:
+            return
+        if self._watermarks_lock is None:
+            self._watermarks_lock = asyncio.Lock()
+        async with self._watermarks_lock:
+            if self._watermarks_ready:
+                return
+            table = create_watermark_table()
+            if not await self.table_exists(table.name):
+                await self.write(lambda session: session.run_sync(lambda s: table.create(s.connection(), checkfirst=True)))
+                count = await self.rebuild_watermarks()
+                if count > 0:
+                    logger.info(f"{self.db_name} 水位表已由 {count} 张数据表重建")
+            self._watermarks_ready = True
+
+    async def update_watermark(self, session, fcode: str, kline_type: int, data: List[Dict[str, Any]]):
+        """在写入数据的同一事务中更新水位"""
+        sql = """INSERT INTO watermarks (code, kltype, time) VALUES (:code, :kltype, :time)
+            ON CONFLICT(code, kltype) DO UPDATE SET time = MAX(time, excluded.time)"""
+        mxtime = max(row['time'] for row in data)
+        await session.execute(text(sql), {"code": fcode, "kltype": kline_type, "time": mxtime})
+
+    async def drop_watermark(self, session, fcode: str, kline_type: int = 101):
+        """删除全部数据时同步删除水位"""
+        await session.execute(text("DELETE FROM watermarks WHERE code = :code AND kltype = :kltype"),
+                              {"code": fcode, "kltype": kline_type})
+
+    async def rebuild_watermarks(self) -> int:
+        """
+        由各数据表的最大时间重建水位表
+
+        Returns:
+            参与重建的数据表数量
+        """
+        targets = []
+        for tbl in await self.all_tables():
+            parsed = self.parse_table_name(tbl)
+            if parsed is not None:
+                targets.append((tbl, *parsed))
+
+        async def op(session):
+            await session.execute(text("DELETE FROM watermarks"))
+            # SQLite复合查询最多500个SELECT，分批UNION ALL
+            for i in range(0, len(targets), 400):
+                params = {}
+                selects = []
+                for j, (tbl, code, kltype) in enumerate(targets[i: i + 400]):
+                    params[f"c{j}"] = code
+                    selects.append(f"SELECT :c{j} AS code, {kltype} AS kltype, MAX(time) AS time FROM {tbl}")
+                sql = f"""INSERT OR REPLACE INTO watermarks (code, kltype, time)
+                    SELECT code, kltype, time FROM ({' UNION ALL '.join(selects)}) WHERE time IS NOT NULL"""
+                await session.execute(text(sql), params)
+
+        await self.write(op)
+        return len(targets)
+
+    async def latest_times(self, codes: List[str] = None, kline_type: int = 101) -> Dict[str, str]:
+        """
+        批量获取最新时间（读取水位表，一次查询）
+
+        Args:
+            codes: 股票代码列表，None表示全部
+            kline_type: K线类型
+
+        Returns:
+            {股票代码: 最新时间}，没有数据的股票不包含在内
+        """
+        await self.ensure_watermarks()
+        sql = "SELECT code, time FROM watermarks WHERE kltype = :kltype"
+        latest = {}
+        async with self.get_session() as session:
+            if codes is None:
+                result = await session.execute(text(sql), {"kltype": kline_type})
+                return dict(result.fetchall())
+            for i in range(0, len(codes), 500):
+                chunk = codes[i: i + 500]
+                params = {"kltype": kline_type}
+                params.update({f"c{j}": c for j, c in enumerate(chunk)})
+                placeholders = ', '.join(f":c{j}" for j in range(len(chunk)))
+                result = await session.execute(text(f"{sql} AND code IN ({placeholders})"), params)
+                latest.update(dict(result.fetchall()))
+        return latest
+
     async def query_data(self, table_name: str, where_clause: str = None,
                         params: dict = None, order_by: str = None,
                         limit: int = None) -> List[Dict[str, Any]]:
@@ -158,6 +439,90 @@ class SQLiteStorage:
                 return [dict(row._mapping) for row in reversed(rows)]
             return [dict(row._mapping) for row in rows]
 
+    @property
+    def numpy_dtype(self) -> np.dtype:
+        """根据saved_dtype生成结构化数组的dtype"""
+        type_map = {'str': 'U20', 'float': 'float64', 'int': 'int64'}
+        return np.dtype([(col, type_map[t]) for col, t in self.saved_dtype.items()])
+
+    def select_columns(self) -> str:
+        """按saved_dtype顺序生成查询列，数值列的NULL按0读取"""
+        columns = [col if t == 'str' else f"IFNULL({col}, 0) AS {col}" for col, t in self.saved_dtype.items()]
+        return ', '.join(columns)
+
+    @staticmethod
+    def rows_to_array(rows, dtype: np.dtype) -> np.ndarray:
+        """将查询结果按列填充为结构化数组，不为每行构造dict"""
+        arr = np.empty(len(rows), dtype=dtype)
+        if len(rows) == 0:
+            return arr
+        for name, col in zip(dtype.names, zip(*rows)):
+            arr[name] = col
+        return arr
+
+    @staticmethod
+    def array_to_dicts(arr: np.ndarray) -> List[Dict[str, Any]]:
+        """结构化数组转为dict列表（兼容旧的按行接口）"""
+        names = arr.dtype.names
+        return [dict(zip(names, row)) for row in arr.tolist()]
+
+    async def query_array(self, table_name: str, where_clause: str = None,
+                          params: dict = None, limit: int = None) -> np.ndarray:
+        """
+        按列查询数据，返回按time升序的结构化数组
+
+        Args:
+            table_name: 表名
+            where_clause: WHERE条件
+            params: 参数字典
+            limit: 限制数量（取最新的limit条）
+
+        Returns:
+            numpy结构化数组，字段与saved_dtype一致
+        """
+        sql = f"SELECT {self.select_columns()} FROM {table_name}"
+
+        if where_clause:
+            sql += f" WHERE {where_clause}"
+
+        sql += " ORDER BY time DESC"
+
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+
+        async with self.get_session() as session:
+            result = await session.execute(text(sql), params or {})
+            rows = result.fetchall()
+        return self.rows_to_array(rows[::-1], self.numpy_dtype)
+
+    async def read_arrays_since(self, starts: Dict[str, Optional[str]], kline_type: int = 101) -> Dict[str, np.ndarray]:
+        """
+        在一个会话中读取多只股票开始时间(含)之后的数据
+
+        Args:
+            starts: 股票代码到开始时间的映射，None表示全部
+            kline_type: K线类型
+
+        Returns:
+            股票代码到按time升序的结构化数组的映射，没有表的股票不包含在内
+        """
+        tables = set(await self.all_tables())
+        columns = self.select_columns()
+        result = {}
+        async with self.get_session() as session:
+            for fcode, start in starts.items():
+                table_name = self.get_table_name(fcode, kline_type)
+                if table_name not in tables:
+                    continue
+                sql = f"SELECT {columns} FROM {table_name}"
+                params = {}
+                if start:
+                    sql += " WHERE time >= :start"
+                    params["start"] = start
+                rows = (await session.execute(text(sql + " ORDER BY time"), params)).fetchall()
+                result[fcode] = self.rows_to_array(rows, self.numpy_dtype)
+        return result
+
     async def get_latest_time(self, fcode, kline_type=101, time_column: str = "time") -> Optional[str]:
         """获取表中最新的时间"""
         table_name = self.get_table_name(fcode, kline_type)
@@ -196,11 +561,13 @@ class SQLiteStorage:
             return 0
 
         sql = f"DELETE FROM {table_name} WHERE {time_column} :cutoff_time"
-        async with self.get_session() as session:
+
+        async def op(session):
             result = await session.execute(text(sql), {"cutoff_time": cutoff_time})
-            await session.commit()
             return result.rowcount
 
+        return await self.write(op)
+
     async def count_records(self, table_name: str, where_clause: str = None,
                            params: dict = None) -> int:
         """统计记录数"""
@@ -233,6 +600,22 @@ class SQLiteStorage:
         """生成表名的抽象方法，由子类实现"""
         raise NotImplementedError("子类必须实现 get_table_name 方法")
 
+    def parse_table_name(self, table_name: str) -> Optional[tuple]:
+        """由表名解析(股票代码, K线类型)，不是数据表时返回None"""
+        parts = table_name.split('_')
+        if len(parts) == 2 and self.get_table_name(parts[1]) == table_name:
+            return parts[1], 101
+        return None
+
+    async def saved_codes(self) -> List[tuple]:
+        """所有已保存数据的(股票代码, K线类型)"""
+        saved = []
+        for tbl in await self.all_tables():
+            parsed = self.parse_table_name(tbl)
+            if parsed is not None:
+                saved.append(parsed)
+        return saved
+
     async def cleanup_old_data_by_days(self, fcode: str, kline_type: int = 101, max_days: int=100,
                                      keep_ratio: float = 0.5) -> int:
         """
@@ -249,7 +632,8 @@ class SQLiteStorage:
         table_name = self.get_table_name(fcode, kline_type)
         max_days = int(max_days * keep_ratio)
         sql = f"SELECT time FROM {table_name}"
-        async with self.get_session() as session:
+
+        async def op(session):
             result = await session.execute(text(sql))
             rows = result.fetchall()
             if not rows:
@@ -263,12 +647,13 @@ class SQLiteStorage:
                 oldest_keep_time = dates[-max_days]
                 delete_sql = f"DELETE FROM {table_name} WHERE time < :oldest_keep_time"
                 delete_result = await session.execute(text(delete_sql), {"oldest_keep_time": oldest_keep_time})
-                await session.commit()
                 logger.warning(f"清理表 {table_name}: 删除了 {delete_result.rowcount} 条记录，保留 {len(rows) - delete_result.rowcount} 条旧记录")
                 return delete_result.rowcount
 
             return 0
 
+        return await self.write(op)
+
     async def vacuum(self) -> bool:
         """
         Run SQLite VACUUM to rebuild and compact the database file.
@@ -320,7 +705,8 @@ class KLineSQLiteStorage(SQLiteStorage):
         """生成K线数据表名"""
         return f"klines_{fcode}_{kline_type}"
 
-    async def save_kline_data(self, fcode: str, data: List[Dict[str, Any]], kline_type: int = 101) -> int:
+    async def save_kline_data(self, fcode: str, data: List[Dict[str, Any]], kline_type: int = 101,
+                              wait: bool = True) -> int:
         """
         保存K线数据
 
@@ -328,6 +714,7 @@ class KLineSQLiteStorage(SQLiteStorage):
             fcode: 股票代码
             data: K线数据列表
             kline_type: K线类型
+            wait: 是否等待写入提交，为False时与其他股票的写入合并提交，需要时调用flush()
 
         Returns:
             保存的记录数
@@ -340,6 +727,28 @@ class KLineSQLiteStorage(SQLiteStorage):
         if not data:
             return 0
 
+        return await self.insert_data(fcode, kline_type, self.prepare_rows(data), wait=wait)
+
+    async def save_kline_data_many(self, datasets: Dict[str, List[Dict[str, Any]]], kline_type: int = 101) -> int:
+        """
+        在一个事务中保存多只股票的K线数据
+
+        Args:
+            datasets: 股票代码到K线数据列表的映射
+            kline_type: K线类型
+
+        Returns:
+            保存的记录数
+        """
+        kline_type = srt.to_int_kltype(kline_type)
+        if kline_type not in self.saved_kline_types:
+            logger.error(f'不支持的K线类型 {kline_type}')
+            return 0
+
+        return await self.insert_data_many({c: self.prepare_rows(d) for c, d in datasets.items() if d}, kline_type)
+
+    def prepare_rows(self, data: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """按saved_dtype整理K线数据，缺失的列使用默认值"""
         prepared_data = []
 
         for item in data:
@@ -356,8 +765,7 @@ class KLineSQLiteStorage(SQLiteStorage):
                     else:
                         row[col_name] = None
             prepared_data.append(row)
-
-        return await self.insert_data(fcode, kline_type, prepared_data)
+        return prepared_data
 
     async def read_kline_data(self, fcode: str, kline_type: int = 101, length: int = 0) -> List[Dict[str, Any]]:
         """
@@ -371,20 +779,50 @@ class KLineSQLiteStorage(SQLiteStorage):
         Returns:
             K线数据列表
         """
+        kldata = await self.read_kline_array(fcode, kline_type, length)
+        if kldata is None:
+            return []
+        return self.array_to_dicts(kldata)
+
+    async def read_kline_array(self, fcode: str, kline_type: int = 101, length: int = 0,
+                               start: str = None, end: str = None) -> Optional[np.ndarray]:
+        """
+        按列读取K线数据，起止时间和长度都在SQL中完成过滤
+
+        Args:
+            fcode: 股票代码
+            kline_type: K线类型
+            length: 读取长度（最新的length条），0表示全部
+            start: 开始时间（包含）
+            end: 结束时间（包含）
+
+        Returns:
+            按time升序的结构化数组，表不存在时返回None
+        """
         kline_type = srt.to_int_kltype(kline_type)
         if kline_type not in self.saved_kline_types:
             logger.error(f'不支持的K线类型 {kline_type}')
-            return []
+            return None
 
         table_name = self.get_table_name(fcode, kline_type)
-
         if not await self.table_exists(table_name):
-            return []
+            return None
 
-        if length > 0:
-            return await self.query_data(table_name, limit=length)
-        else:
-            return await self.query_data(table_name)
+        return await self._query_kline_array(table_name, [], {}, length, start, end)
+
+    async def _query_kline_array(self, table_name: str, conditions: List[str], params: dict,
+                                 length: int = 0, start: str = None, end: str = None) -> np.ndarray:
+        """在conditions基础上追加起止时间条件后按列查询"""
+        conditions = list(conditions)
+        params = dict(params)
+        if start:
+            conditions.append("time >= :start")
+            params["start"] = start
+        if end:
+            conditions.append("time <= :end")
+            params["end"] = end
+
+        return await self.query_array(table_name, " AND ".join(conditions), params, limit=length)
 
     async def read_kline_data_by_date_range(
             self, fcode: str, kline_type: int = 101,
@@ -401,40 +839,321 @@ class KLineSQLiteStorage(SQLiteStorage):
         Returns:
             K线数据列表
         """
+        kldata = await self.read_kline_array(fcode, kline_type, 0, start_date, end_date)
+        if kldata is None:
+            return []
+        return self.array_to_dicts(kldata)
+
+    async def delete_kline_data(self, fcode: str, kline_type: int = 101) -> int:
+        """删除K线数据"""
         kline_type = srt.to_int_kltype(kline_type)
         table_name = self.get_table_name(fcode, kline_type)
+        await self.ensure_watermarks()
 
-        if not await self.table_exists(table_name):
-            return []
+        async def op(session):
+            result = await session.execute(text(f"DELETE FROM {table_name}"))
+            await self.drop_watermark(session, fcode, kline_type)
+            return result.rowcount
 
-        where_clause = ""
-        params = {}
+        return await self.write(op)
 
-        if start_date:
-            where_clause += "time >= :start_date"
-            params["start_date"] = start_date
+    def parse_table_name(self, table_name: str) -> Optional[tuple]:
+        """由表名klines_{fcode}_{kline_type}解析(股票代码, K线类型)"""
+        parts = table_name.split('_')
+        if len(parts) == 3 and parts[0] == 'klines' and parts[2].isdigit():
+            return parts[1], int(parts[2])
+        return None
 
-        if end_date:
-            if where_clause:
-                where_clause += " AND time <= :end_date"
-            else:
-                where_clause += "time <= :end_date"
-            params["end_date"] = end_date
+    @property
+    def cross_section_dtype(self) -> np.dtype:
+        """截面数据的dtype，在K线字段前增加code"""
+        return np.dtype([('code', 'U20')] + self.numpy_dtype.descr)
+
+    @staticmethod
+    def cross_section_range(start: str, end: str = None):
+        """截面查询的时间范围，end为None时取start当天"""
+        if end is None:
+            end = start if ' ' in start else f'{start} 23:59:59'
+        return start, end
+
+    async def read_cross_section(self, start: str, end: str = None, kline_type: int = 101,
+                                 codes: List[str] = None) -> np.ndarray:
+        """
+        读取多只股票在某日（或某时间段）的K线截面数据
 
-        if where_clause:
-            return await self.query_data(table_name, where_clause, params)
-        else:
-            return await self.query_data(table_name)
+        Args:
+            start: 开始时间（包含）
+            end: 结束时间（包含），None表示只取start当天
+            kline_type: K线类型
+            codes: 股票代码列表，None表示全部已保存的股票
+
+        Returns:
+            含code字段的结构化数组，按(time, code)排序
+        """
+        kline_type = srt.to_int_kltype(kline_type)
+        start, end = self.cross_section_range(start, end)
+        tables = set(await self.all_tables())
+        if codes is None:
+            codes = [c for c, t in await self.saved_codes() if t == kline_type]
+        targets = [c for c in codes if self.get_table_name(c, kline_type) in tables]
+
+        rows = []
+        columns = self.select_columns()
+        async with self.get_session() as session:
+            # SQLite复合查询最多500个SELECT，分批UNION ALL
+            for i in range(0, len(targets), 400):
+                chunk = targets[i: i + 400]
+                params = {'start': start, 'end': end}
+                selects = []
+                for j, c in enumerate(chunk):
+                    params[f'c{j}'] = c
+                    selects.append(
+                        f"SELECT :c{j} AS code, {columns} FROM {self.get_table_name(c, kline_type)} "
+                        "WHERE time >= :start AND time <= :end")
+                result = await session.execute(text(" UNION ALL ".join(selects)), params)
+                rows += result.fetchall()
+
+        kldata = self.rows_to_array(rows, self.cross_section_dtype)
+        kldata.sort(order=['time', 'code'])
+        return kldata
+
+
+class KLinePartitionedStorage(KLineSQLiteStorage):
+    """
+    K线数据SQLite分区存储类
+
+    每种K线类型一张WITHOUT ROWID表，以(code, time)为聚簇主键，所有股票共用。
+    按代码读写不再需要逐表检查/建表，按日期的全市场查询走time索引。
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.db_name = "klines_part"
+        self.create_table_func = create_kline_partition_table
+        self._tables_created = False
+
+    def get_table_name(self, fcode: str = None, kline_type: int = 101) -> str:
+        """生成K线数据表名，与股票代码无关"""
+        return f"klines_{kline_type}"
+
+    def ensure_tables(self):
+        """创建所有K线类型的分区表（只执行一次）"""
+        if self._tables_created:
+            return
+        for kline_type in self.saved_kline_types:
+            self.create_table_func(kline_type).create(self.sync_engine, checkfirst=True)
+        self._tables_created = True
+
+    async def table_exists(self, table_name: str) -> bool:
+        if table_name in {self.get_table_name(None, klt) for klt in self.saved_kline_types}:
+            self.ensure_tables()
+            return True
+        return await super().table_exists(table_name)
+
+    async def insert_data(self, fcode: str, kline_type: int = 101, data: List[Dict[str, Any]] = None,
+                          conflict_strategy: str = "REPLACE", wait: bool = True) -> int:
+        if not data:
+            return 0
+
+        self.ensure_tables()
+        table_name = self.get_table_name(fcode, kline_type)
+        rows = [{'code': fcode, **row} for row in data]
+
+        columns = list(rows[0].keys())
+        placeholders = ", ".join([f":{col}" for col in columns])
+        columns_str = ", ".join(columns)
+
+        sql = f"INSERT OR {conflict_strategy} INTO {table_name} ({columns_str}) VALUES ({placeholders})"
+
+        async def op(session):
+            result = await session.execute(text(sql), rows)
+            await self.update_watermark(session, fcode, kline_type, data)
+            return result.rowcount
+
+        await self.ensure_watermarks()
+        count = await self.write(op, len(rows), wait, fcode)
+        return len(rows) if count is None else count
+
+    async def insert_data_many(self, datasets: Dict[str, List[Dict[str, Any]]], kline_type: int = 101,
+                               conflict_strategy: str = "REPLACE") -> int:
+        """所有股票的数据在同一张分区表中，一条SQL写入"""
+        datasets = {c: d for c, d in datasets.items() if d}
+        if not datasets:
+            return 0
+
+        self.ensure_tables()
+        rows = [{'code': fcode, **row} for fcode, data in datasets.items() for row in data]
+        columns = list(rows[0].keys())
+        sql = f"""INSERT OR {conflict_strategy} INTO {self.get_table_name(None, kline_type)}
+            ({', '.join(columns)}) VALUES ({', '.join(f':{col}' for col in columns)})"""
+
+        async def op(session):
+            result = await session.execute(text(sql), rows)
+            for fcode, data in datasets.items():
+                await self.update_watermark(session, fcode, kline_type, data)
+            return result.rowcount
+
+        await self.ensure_watermarks()
+        return await self.write(op, len(rows))
+
+    async def rebuild_watermarks(self) -> int:
+        """由各分区表按代码分组的最大时间重建水位表"""
+        self.ensure_tables()
+
+        async def op(session):
+            await session.execute(text("DELETE FROM watermarks"))
+            for kline_type in self.saved_kline_types:
+                await session.execute(text(f"""INSERT OR REPLACE INTO watermarks (code, kltype, time)
+                    SELECT code, {kline_type}, MAX(time) FROM {self.get_table_name(None, kline_type)} GROUP BY code"""))
+
+        await self.write(op)
+        return len(self.saved_kline_types)
+
+    async def _code_time(self, fcode: str, kline_type: int, agg: str) -> Optional[str]:
+        self.ensure_tables()
+        table_name = self.get_table_name(fcode, kline_type)
+        sql = f"SELECT {agg}(time) FROM {table_name} WHERE code = :code"
+        async with self.get_session() as session:
+            result = await session.execute(text(sql), {"code": fcode})
+            row = result.fetchone()
+            return row[0] if row and row[0] else None
+
+    async def get_latest_time(self, fcode, kline_type=101, time_column: str = "time") -> Optional[str]:
+        """获取该股票最新的K线时间"""
+        return await self._code_time(fcode, kline_type, "MAX")
+
+    async def get_earliest_time(self, fcode, kline_type=101, time_column: str = "time") -> Optional[str]:
+        """获取该股票最早的K线时间"""
+        return await self._code_time(fcode, kline_type, "MIN")
+
+    async def read_kline_array(self, fcode: str, kline_type: int = 101, length: int = 0,
+                               start: str = None, end: str = None) -> Optional[np.ndarray]:
+        kline_type = srt.to_int_kltype(kline_type)
+        if kline_type not in self.saved_kline_types:
+            logger.error(f'不支持的K线类型 {kline_type}')
+            return None
+
+        self.ensure_tables()
+        table_name = self.get_table_name(fcode, kline_type)
+        kldata = await self._query_kline_array(table_name, ["code = :code"], {"code": fcode}, length, start, end)
+        if len(kldata) == 0 and await self.get_latest_time(fcode, kline_type) is None:
+            return None
+        return kldata
 
     async def delete_kline_data(self, fcode: str, kline_type: int = 101) -> int:
         """删除K线数据"""
         kline_type = srt.to_int_kltype(kline_type)
+        self.ensure_tables()
         table_name = self.get_table_name(fcode, kline_type)
-        async with self.get_session() as session:
-            result = await session.execute(text(f"DELETE FROM {table_name}"))
-            await session.commit()
+        await self.ensure_watermarks()
+
+        async def op(session):
+            result = await session.execute(text(f"DELETE FROM {table_name} WHERE code = :code"), {"code": fcode})
+            await self.drop_watermark(session, fcode, kline_type)
             return result.rowcount
 
+        return await self.write(op)
+
+    async def cleanup_old_data_by_days(self, fcode: str, kline_type: int = 101, max_days: int = 100,
+                                       keep_ratio: float = 0.5) -> int:
+        """按天数清理该股票的旧数据，保留最新max_days * keep_ratio天"""
+        max_days = int(max_days * keep_ratio)
+        if max_days <= 0:
+            return 0
+
+        self.ensure_tables()
+        table_name = self.get_table_name(fcode, kline_type)
+        sql = f"""SELECT DISTINCT substr(time, 1, 10) AS d FROM {table_name} WHERE code = :code
+            ORDER BY d DESC LIMIT 1 OFFSET :offset"""
+
+        async def op(session):
+            result = await session.execute(text(sql), {"code": fcode, "offset": max_days - 1})
+            row = result.fetchone()
+            if row is None:
+                return 0
+
+            delete_sql = f"DELETE FROM {table_name} WHERE code = :code AND time < :oldest_keep_time"
+            delete_result = await session.execute(text(delete_sql), {"code": fcode, "oldest_keep_time": row[0]})
+            if delete_result.rowcount > 0:
+                logger.warning(f"清理 {table_name} {fcode}: 删除了 {delete_result.rowcount} 条记录")
+            return delete_result.rowcount
+
+        return await self.write(op)
+
+    async def saved_codes(self) -> List[tuple]:
+        """所有已保存K线的(股票代码, K线类型)"""
+        self.ensure_tables()
+        saved = []
+        async with self.get_session() as session:
+            for kline_type in self.saved_kline_types:
+                result = await session.execute(text(f"SELECT DISTINCT code FROM {self.get_table_name(None, kline_type)}"))
+                saved += [(c, kline_type) for c, in result.fetchall()]
+        return saved
+
+    async def read_arrays_since(self, starts: Dict[str, Optional[str]], kline_type: int = 101) -> Dict[str, np.ndarray]:
+        """按代码分块查询分区表，每块一条SQL"""
+        self.ensure_tables()
+        sql = f"SELECT code, {self.select_columns()} FROM {self.get_table_name(None, kline_type)}"
+        codes = list(starts.keys())
+        result = {}
+        async with self.get_session() as session:
+            for i in range(0, len(codes), 500):
+                chunk = codes[i: i + 500]
+                params = {f'c{j}': c for j, c in enumerate(chunk)}
+                where = f"code IN ({', '.join(f':c{j}' for j in range(len(chunk)))})"
+                chunk_starts = [starts[c] for c in chunk]
+                if all(chunk_starts):
+                    where += " AND time >= :start"
+                    params['start'] = min(chunk_starts)
+                rows = (await session.execute(text(f"{sql} WHERE {where} ORDER BY code, time"), params)).fetchall()
+                kldata = self.rows_to_array(rows, self.cross_section_dtype)
+                names = list(self.numpy_dtype.names)
+                bounds = np.flatnonzero(kldata['code'][1:] != kldata['code'][:-1]) + 1
+                for part in np.split(kldata, bounds) if len(kldata) else []:
+                    code = part['code'][0]
+                    if starts[code]:
+                        part = part[part['time'] >= starts[code]]
+                    result[code] = part[names].astype(self.numpy_dtype)
+        return result
+
+    async def read_cross_section(self, start: str, end: str = None, kline_type: int = 101,
+                                 codes: List[str] = None) -> np.ndarray:
+        """
+        读取多只股票在某日（或某时间段）的K线截面数据，全市场查询走time索引
+
+        Args:
+            start: 开始时间（包含）
+            end: 结束时间（包含），None表示只取start当天
+            kline_type: K线类型
+            codes: 股票代码列表，None表示全市场
+
+        Returns:
+            含code字段的结构化数组，按(time, code)排序
+        """
+        kline_type = srt.to_int_kltype(kline_type)
+        start, end = self.cross_section_range(start, end)
+        self.ensure_tables()
+        sql = f"""SELECT code, {self.select_columns()} FROM {self.get_table_name(None, kline_type)}
+            WHERE time >= :start AND time <= :end"""
+
+        rows = []
+        async with self.get_session() as session:
+            if codes is None:
+                result = await session.execute(text(sql), {'start': start, 'end': end})
+                rows = result.fetchall()
+            else:
+                for i in range(0, len(codes), 500):
+                    chunk = codes[i: i + 500]
+                    params = {'start': start, 'end': end}
+                    params.update({f'c{j}': c for j, c in enumerate(chunk)})
+                    placeholders = ', '.join(f':c{j}' for j in range(len(chunk)))
+                    result = await session.execute(text(f"{sql} AND code IN ({placeholders})"), params)
+                    rows += result.fetchall()
+
+        kldata = self.rows_to_array(rows, self.cross_section_dtype)
+        kldata.sort(order=['time', 'code'])
+        return kldata
+
 
 class FflowSQLiteStorage(SQLiteStorage):
     """资金流数据SQLite存储类"""
@@ -465,13 +1184,14 @@ class FflowSQLiteStorage(SQLiteStorage):
         """生成资金流数据表名"""
         return f"fflow_{fcode}"
 
-    async def save_fflow(self, fcode: str, data: List[Dict[str, Any]]) -> int:
+    async def save_fflow(self, fcode: str, data: List[Dict[str, Any]], wait: bool = True) -> int:
         """
         保存资金流数据
 
         Args:
             fcode: 股票代码
             data: 资金流数据列表
+            wait: 是否等待写入提交，为False时与其他股票的写入合并提交，需要时调用flush()
 
         Returns:
             保存的记录数
@@ -504,7 +1224,7 @@ class FflowSQLiteStorage(SQLiteStorage):
                         row[col_name] = None
             prepared_data.append(row)
 
-        return await self.insert_data(fcode, data=prepared_data)
+        return await self.insert_data(fcode, data=prepared_data, wait=wait)
 
     async def read_fflow(self, fcode: str, start_date: str = None,
                              end_date: str = None) -> List[Dict[str, Any]]:
@@ -546,11 +1266,15 @@ class FflowSQLiteStorage(SQLiteStorage):
     async def delete_fflow_data(self, fcode: str) -> int:
         """删除资金流数据"""
         table_name = self.get_table_name(fcode)
-        async with self.get_session() as session:
+        await self.ensure_watermarks()
+
+        async def op(session):
             result = await session.execute(text(f"DELETE FROM {table_name}"))
-            await session.commit()
+            await self.drop_watermark(session, fcode)
             return result.rowcount
 
+        return await self.write(op)
+
 
 class TransactionSQLiteStorage(SQLiteStorage):
     """交易数据SQLite存储类"""
@@ -572,13 +1296,14 @@ class TransactionSQLiteStorage(SQLiteStorage):
         """生成交易数据表名（使用完整股票代码）"""
         return f"trans_{fcode}"
 
-    async def save_transaction(self, fcode: str, data: List[Dict[str, Any]]) -> int:
+    async def save_transaction(self, fcode: str, data: List[Dict[str, Any]], wait: bool = True) -> int:
         """
         保存交易数据
 
         Args:
             fcode: 股票代码
             data: 交易数据列表
+            wait: 是否等待写入提交，为False时与其他股票的写入合并提交，需要时调用flush()
 
         Returns:
             保存的记录数
@@ -604,7 +1329,7 @@ class TransactionSQLiteStorage(SQLiteStorage):
             prepared_data.append(row)
 
         # 交易数据使用INSERT IGNORE策略，避免重复
-        return await self.insert_data(fcode, data=prepared_data, conflict_strategy="IGNORE")
+        return await self.insert_data(fcode, data=prepared_data, conflict_strategy="IGNORE", wait=wait)
 
     async def read_transaction(self, fcode: str, start_time: str = None,
                                  end_time: str = None, limit: int = None) -> List[Dict[str, Any]]:
@@ -647,11 +1372,15 @@ class TransactionSQLiteStorage(SQLiteStorage):
     async def delete_transaction_data(self, fcode: str) -> int:
         """删除交易数据"""
         table_name = self.get_table_name(fcode)
-        async with self.get_session() as session:
+        await self.ensure_watermarks()
+
+        async def op(session):
             result = await session.execute(text(f"DELETE FROM {table_name}"))
-            await session.commit()
+            await self.drop_watermark(session, fcode)
             return result.rowcount
 
+        return await self.write(op)
+
     async def get_transaction_count(self, fcode: str, start_time: str = None,
                                  end_time: str = None) -> int:
         """统计交易记录数"""
@@ -677,6 +1406,493 @@ class TransactionSQLiteStorage(SQLiteStorage):
         return await self.count_records(table_name, where_clause, params)
 
 
-kls = KLineSQLiteStorage()
+class TransactionBlockStorage(TransactionSQLiteStorage):
+    """
+    交易数据SQLite分块存储类
+
+    每只股票每个交易日的成交压缩为一个列式数据块，存于(code, date)为聚簇主键的WITHOUT ROWID表。
+    块内各列依次为: 秒数差分、价格(0.001元)差分、成交量、成交笔数、买卖方向，整体zlib压缩。
+    按时间范围读取时只解压涉及的交易日。
+    """
+    block_columns = [('secs', 'int32'), ('price', 'int32'), ('volume', 'int64'), ('num', 'int32'), ('bs', 'int8')]
+    price_scale = 1000
+    compress_level = 6
+    time_converter = TimeConverter()
+
+    def __init__(self):
+        super().__init__()
+        self.db_name = "trans_blocks"
+        self.create_table_func = None
+        self._tables_created = False
+
+    def get_table_name(self, fcode: str = None, *args) -> str:
+        """所有股票共用一张表"""
+        return "trans_blocks"
+
+    def ensure_tables(self):
+        if self._tables_created:
+            return
+        create_transaction_block_table().create(self.sync_engine, checkfirst=True)
+        self._tables_created = True
+
+    async def table_exists(self, table_name: str) -> bool:
+        if table_name == self.get_table_name():
+            self.ensure_tables()
+            return True
+        return await super().table_exists(table_name)
+
+    @classmethod
+    def encode_block(cls, secs: np.ndarray, price: np.ndarray, volume: np.ndarray, num: np.ndarray,
+                     bs: np.ndarray) -> bytes:
+        """
+        将一个交易日的成交编码为压缩数据块
+
+        Args:
+            secs: 当日秒数，升序
+            price, volume, num, bs: 与secs等长的各列
+
+        Returns:
+            压缩后的数据块
+        """
+        ticks = np.rint(np.asarray(price, dtype=np.float64) * cls.price_scale).astype(np.int64)
+        columns = {
+            'secs': np.diff(np.asarray(secs, dtype=np.int64), prepend=0),
+            'price': np.diff(ticks, prepend=0),
+            'volume': volume, 'num': num, 'bs': bs}
+        raw = b''.join(np.ascontiguousarray(columns[c], dtype=t).tobytes() for c, t in cls.block_columns)
+        return zlib.compress(raw, cls.compress_level)
+
+    @classmethod
+    def decode_block(cls, blob: bytes, count: int) -> Dict[str, np.ndarray]:
+        """解压数据块，返回各列数组，secs和price已还原"""
+        raw = zlib.decompress(blob)
+        columns = {}
+        offset = 0
+        for c, t in cls.block_columns:
+            columns[c] = np.frombuffer(raw, dtype=t, count=count, offset=offset)
+            offset += count * np.dtype(t).itemsize
+        columns['secs'] = np.cumsum(columns['secs'], dtype=np.int64)
+        columns['price'] = np.cumsum(columns['price'], dtype=np.int64) / cls.price_scale
+        return columns
+
+    def block_to_array(self, date: str, blob: bytes, count: int) -> np.ndarray:
+        """将一个交易日的数据块还原为与saved_dtype一致的结构化数组"""
+        columns = self.decode_block(blob, count)
+        secs = columns.pop('secs')
+        day = int(date.replace('-', '')) * 1000000
+        ints = day + secs // 3600 * 10000 + secs % 3600 // 60 * 100 + secs % 60
+        arr = np.empty(count, dtype=self.numpy_dtype)
+        arr['time'] = self.time_converter.int_to_time(ints)
+        for c, v in columns.items():
+            arr[c] = v
+        return arr
+
+    def dicts_to_array(self, data: List[Dict[str, Any]]) -> np.ndarray:
+        """将成交dict列表转为结构化数组，缺失的数值列按0处理"""
+        arr = np.zeros(len(data), dtype=self.numpy_dtype)
+        for col in self.saved_dtype:
+            if col == 'time':
+                arr[col] = [item['time'] for item in data]
+            else:
+                arr[col] = [item.get(col) or 0 for item in data]
+        return arr
+
+    async def save_transaction(self, fcode: str, data: List[Dict[str, Any]], wait: bool = True) -> int:
+        """
+        保存交易数据，按交易日合并到数据块
+
+        Args:
+            fcode: 股票代码
+            data: 交易数据列表
+            wait: 是否等待写入提交
+
+        Returns:
+            保存的记录数
+        """
+        if not data:
+            return 0
+        return await self.save_transaction_array(fcode, self.dicts_to_array(data), wait)
+
+    async def save_transaction_array(self, fcode: str, arr: np.ndarray, wait: bool = True) -> int:
+        """
+        保存结构化数组形式的交易数据
+
+        同一交易日已有数据时，新数据覆盖其时间范围内(含首尾秒)的已有成交，范围外的已有成交保留
+
+        Args:
+            fcode: 股票代码
+            arr: 字段与saved_dtype一致的结构化数组
+            wait: 是否等待写入提交
+
+        Returns:
+            保存的记录数
+        """
+        if len(arr) == 0:
+            return 0
+
+        self.ensure_tables()
+        ints = self.time_converter.time_to_int(arr['time'])
+        days = ints // 1000000
+        hms = ints % 1000000
+        secs = hms // 10000 * 3600 + hms % 10000 // 100 * 60 + hms % 100
+        table_name = self.get_table_name()
+        select_sql = f"SELECT count, data FROM {table_name} WHERE code = :code AND date = :date"
+        upsert_sql = f"""INSERT OR REPLACE INTO {table_name} (code, date, first_time, last_time, count, data)
+            VALUES (:code, :date, :first_time, :last_time, :count, :data)"""
+
+        async def op(session):
+            for day in np.unique(days).tolist():
+                date = f"{day // 10000:04d}-{day // 100 % 100:02d}-{day % 100:02d}"
+                idx = np.flatnonzero(days == day)
+                idx = idx[np.argsort(secs[idx], kind='stable')]
+                new = {c: arr[c][idx] for c in ('price', 'volume', 'num', 'bs')}
+                new['secs'] = secs[idx]
+                row = (await session.execute(text(select_sql), {"code": fcode, "date": date})).fetchone()
+                if row is not None:
+                    old = self.decode_block(row[1], row[0])
+                    before = old['secs'] < new['secs'][0]
+                    after = old['secs'] > new['secs'][-1]
+                    new = {c: np.concatenate([old[c][before], new[c], old[c][after]]) for c in new}
+
+                last_time = self.block_time(date, new['secs'][-1])
+                await session.execute(text(upsert_sql), {
+                    "code": fcode, "date": date, "first_time": self.block_time(date, new['secs'][0]),
+                    "last_time": last_time, "count": len(new['secs']),
+                    "data": self.encode_block(new['secs'], new['price'], new['volume'], new['num'], new['bs'])})
+            await self.update_watermark(session, fcode, 101, [{'time': last_time}])
+
+        await self.ensure_watermarks()
+        await self.write(op, len(arr), wait, fcode)
+        return len(arr)
+
+    @staticmethod
+    def block_time(date: str, secs: int) -> str:
+        secs = int(secs)
+        return f"{date} {secs // 3600:02d}:{secs % 3600 // 60:02d}:{secs % 60:02d}"
+
+    @staticmethod
+    def block_range(start_time: str = None, end_time: str = None) -> tuple:
+        """时间范围对应的交易日条件"""
+        conditions = []
+        params = {}
+        if start_time:
+            conditions.append("date >= :start_date")
+            params["start_date"] = start_time[:10]
+        if end_time:
+            conditions.append("date <= :end_date")
+            params["end_date"] = end_time[:10]
+        return conditions, params
+
+    @staticmethod
+    def filter_time(arr: np.ndarray, start_time: str = None, end_time: str = None) -> np.ndarray:
+        if start_time:
+            arr = arr[arr['time'] >= start_time]
+        if end_time:
+            arr = arr[arr['time'] <= end_time]
+        return arr
+
+    async def read_transaction_array(self, fcode: str, start_time: str = None,
+                                     end_time: str = None, limit: int = None) -> np.ndarray:
+        """
+        读取交易数据，只解压时间范围涉及的交易日
+
+        Args:
+            fcode: 股票代码
+            start_time: 开始时间
+            end_time: 结束时间
+            limit: 限制数量（取最新的limit条）
+
+        Returns:
+            按time升序的结构化数组
+        """
+        self.ensure_tables()
+        table_name = self.get_table_name()
+        conditions, params = self.block_range(start_time, end_time)
+        where = ' AND '.join(["code = :code"] + conditions)
+        params["code"] = fcode
+        sql = f"SELECT date, count, data FROM {table_name} WHERE {where}"
+        parts = []
+        async with self.get_session() as session:
+            if not limit:
+                rows = (await session.execute(text(f"{sql} ORDER BY date"), params)).fetchall()
+                parts = [self.filter_time(self.block_to_array(date, blob, count), start_time, end_time)
+                         for date, count, blob in rows]
+            else:
+                limit = int(limit)
+                days = (await session.execute(text(
+                    f"SELECT date, count FROM {table_name} WHERE {where} ORDER BY date DESC"), params)).fetchall()
+                # 按块的记录数确定需要解压的交易日，边界日按时间过滤后不足limit条时继续向前读取
+                total = 0
+                i = 0
+                while i < len(days) and total < limit:
+                    j = i
+                    nrows = 0
+                    while j < len(days) and nrows < limit - total:
+                        nrows += days[j][1]
+                        j += 1
+                    rows = (await session.execute(
+                        text(f"{sql} AND date >= :first_date AND date <= :last_date ORDER BY date"),
+                        {**params, "first_date": days[j - 1][0], "last_date": days[i][0]})).fetchall()
+                    batch = [self.filter_time(self.block_to_array(date, blob, count), start_time, end_time)
+                             for date, count, blob in rows]
+                    parts = batch + parts
+                    total += sum(len(a) for a in batch)
+                    i = j
+
+        arr = np.concatenate(parts) if parts else np.empty(0, dtype=self.numpy_dtype)
+        if limit:
+            arr = arr[-limit:]
+        return arr
+
+    async def read_transaction(self, fcode: str, start_time: str = None,
+                               end_time: str = None, limit: int = None) -> List[Dict[str, Any]]:
+        """
+        读取交易数据
+
+        Args:
+            fcode: 股票代码
+            start_time: 开始时间
+            end_time: 结束时间
+            limit: 限制数量
+
+        Returns:
+            交易数据列表
+        """
+        return self.array_to_dicts(await self.read_transaction_array(fcode, start_time, end_time, limit))
+
+    async def read_arrays_since(self, starts: Dict[str, Optional[str]], kline_type: int = 101) -> Dict[str, np.ndarray]:
+        """按代码分块查询，每块一条SQL，只解压开始时间之后的交易日"""
+        self.ensure_tables()
+        sql = f"SELECT code, date, count, data FROM {self.get_table_name()}"
+        codes = list(starts.keys())
+        result = {}
+        async with self.get_session() as session:
+            for i in range(0, len(codes), 500):
+                chunk = codes[i: i + 500]
+                params = {f'c{j}': c for j, c in enumerate(chunk)}
+                where = f"code IN ({', '.join(f':c{j}' for j in range(len(chunk)))})"
+                chunk_starts = [starts[c] for c in chunk]
+                if all(chunk_starts):
+                    where += " AND date >= :start_date"
+                    params['start_date'] = min(chunk_starts)[:10]
+                rows = (await session.execute(text(f"{sql} WHERE {where} ORDER BY code, date"), params)).fetchall()
+                parts = {}
+                for code, date, count, blob in rows:
+                    if starts[code] and date < starts[code][:10]:
+                        continue
+                    parts.setdefault(code, []).append(self.block_to_array(date, blob, count))
+                for code, arrs in parts.items():
+                    result[code] = self.filter_time(np.concatenate(arrs), starts[code])
+        return result
+
+    async def rebuild_watermarks(self) -> int:
+        """由数据块的末笔成交时间重建水位表"""
+        self.ensure_tables()
+
+        async def op(session):
+            await session.execute(text("DELETE FROM watermarks"))
+            result = await session.execute(text(f"""INSERT OR REPLACE INTO watermarks (code, kltype, time)
+                SELECT code, 101, MAX(last_time) FROM {self.get_table_name()} GROUP BY code"""))
+            return result.rowcount
+
+        return await self.write(op)
+
+    async def _code_time(self, fcode: str, sql: str) -> Optional[str]:
+        self.ensure_tables()
+        async with self.get_session() as session:
+            row = (await session.execute(text(sql), {"code": fcode})).fetchone()
+            return row[0] if row and row[0] else None
+
+    async def get_latest_time(self, fcode, kline_type=101, time_column: str = "time") -> Optional[str]:
+        """获取该股票最新的成交时间"""
+        return await self._code_time(fcode, f"SELECT MAX(last_time) FROM {self.get_table_name()} WHERE code = :code")
+
+    async def get_earliest_time(self, fcode, kline_type=101, time_column: str = "time") -> Optional[str]:
+        """获取该股票最早的成交时间"""
+        return await self._code_time(fcode, f"SELECT MIN(first_time) FROM {self.get_table_name()} WHERE code = :code")
+
+    async def saved_codes(self) -> List[tuple]:
+        """所有已保存交易数据的(股票代码, 101)"""
+        self.ensure_tables()
+        async with self.get_session() as session:
+            result = await session.execute(text(f"SELECT DISTINCT code FROM {self.get_table_name()}"))
+            return [(c, 101) for c, in result.fetchall()]
+
+    async def cleanup_old_data_by_days(self, fcode: str, kline_type: int = 101, max_days: int = 100,
+                                       keep_ratio: float = 0.5) -> int:
+        """按天数清理该股票的旧数据块，保留最新max_days * keep_ratio个交易日，返回删除的记录数"""
+        max_days = int(max_days * keep_ratio)
+        if max_days <= 0:
+            return 0
+
+        self.ensure_tables()
+        table_name = self.get_table_name()
+        sql = f"SELECT date FROM {table_name} WHERE code = :code ORDER BY date DESC LIMIT 1 OFFSET :offset"
+
+        async def op(session):
+            row = (await session.execute(text(sql), {"code": fcode, "offset": max_days - 1})).fetchone()
+            if row is None:
+                return 0
+
+            params = {"code": fcode, "oldest_keep_date": row[0]}
+            where = "code = :code AND date < :oldest_keep_date"
+            count = (await session.execute(text(f"SELECT IFNULL(SUM(count), 0) FROM {table_name} WHERE {where}"),
+                                           params)).scalar()
+            await session.execute(text(f"DELETE FROM {table_name} WHERE {where}"), params)
+            if count > 0:
+                logger.warning(f"清理 {table_name} {fcode}: 删除了 {count} 条记录")
+            return count
+
+        return await self.write(op)
+
+    async def delete_transaction_data(self, fcode: str) -> int:
+        """删除交易数据，返回删除的记录数"""
+        self.ensure_tables()
+        table_name = self.get_table_name()
+        await self.ensure_watermarks()
+
+        async def op(session):
+            count = (await session.execute(text(f"SELECT IFNULL(SUM(count), 0) FROM {table_name} WHERE code = :code"),
+                                           {"code": fcode})).scalar()
+            await session.execute(text(f"DELETE FROM {table_name} WHERE code = :code"), {"code": fcode})
+            await self.drop_watermark(session, fcode)
+            return count
+
+        return await self.write(op)
+
+    async def get_transaction_count(self, fcode: str, start_time: str = None,
+                                    end_time: str = None) -> int:
+        """统计交易记录数，完全落在时间范围内的交易日直接使用块的记录数"""
+        self.ensure_tables()
+        conditions, params = self.block_range(start_time, end_time)
+        params["code"] = fcode
+        sql = f"""SELECT date, first_time, last_time, count, data FROM {self.get_table_name()}
+            WHERE {' AND '.join(["code = :code"] + conditions)}"""
+        async with self.get_session() as session:
+            rows = (await session.execute(text(sql), params)).fetchall()
+
+        total = 0
+        for date, first_time, last_time, count, blob in rows:
+            if (not start_time or first_time >= start_time) and (not end_time or last_time <= end_time):
+                total += count
+            else:
+                total += len(self.filter_time(self.block_to_array(date, blob, count), start_time, end_time))
+        return total
+
+    async def import_from(self, source: TransactionSQLiteStorage, codes: List[str] = None,
+                          batch_size: int = 100) -> int:
+        """
+        从按股票分表的交易数据存储导入
+
+        Args:
+            source: TransactionSQLiteStorage
+            codes: 股票代码列表，默认为源库中所有股票
+            batch_size: 每批读取的股票数
+
+        Returns:
+            导入的记录数
+        """
+        if codes is None:
+            codes = [c for c, _ in await source.saved_codes()]
+        total = 0
+        for i in range(0, len(codes), batch_size):
+            arrays = await source.read_arrays_since({c: None for c in codes[i: i + batch_size]})
+            for code, arr in arrays.items():
+                total += await self.save_transaction_array(code, arr, wait=False)
+            failed = await self.flush()
+            if failed:
+                for code, e in failed:
+                    logger.error(f"导入交易数据失败 {code}: {e}")
+                raise RuntimeError(f"{len(failed)} 只股票的交易数据导入失败: {[c for c, _ in failed]}")
+            logger.info(f"导入交易数据 {i + len(arrays)}/{len(codes)} 只股票, {total} 条记录")
+        return total
+
+
+class UpdateJournalStorage(SQLiteStorage):
+    """更新日志SQLite存储，记录夜间更新任务每个交易日各步骤和批次的执行状态"""
+    columns = ['date', 'task', 'step', 'batch', 'status', 'codes', 'attempts', 'error', 'updated']
+
+    def __init__(self):
+        super().__init__("update_journal")
+        self._tables_created = False
+
+    def ensure_tables(self):
+        if self._tables_created:
+            return
+        create_update_journal_table().create(self.sync_engine, checkfirst=True)
+        self._tables_created = True
+
+    async def read_journal(self, date: str, task: str, step: str = None) -> List[Dict[str, Any]]:
+        """
+        读取一个交易日某任务的日志记录
+
+        Args:
+            date: 交易日
+            task: 任务名称
+            step: 步骤名称，默认为全部步骤
+
+        Returns:
+            按步骤和批次排序的记录列表
+        """
+        self.ensure_tables()
+        sql = f"SELECT {', '.join(self.columns)} FROM update_journal WHERE date = :date AND task = :task"
+        params = {"date": date, "task": task}
+        if step is not None:
+            sql += " AND step = :step"
+            params["step"] = step
+        async with self.get_session() as session:
+            result = await session.execute(text(sql + " ORDER BY step, batch"), params)
+            return [dict(row._mapping) for row in result.fetchall()]
+
+    async def save_journal(self, rows: List[Dict[str, Any]]) -> int:
+        """
+        写入日志记录，主键相同的记录被覆盖
+
+        Args:
+            rows: 记录列表，需包含date, task, step, batch, status
+
+        Returns:
+            写入的记录数
+        """
+        if not rows:
+            return 0
+        self.ensure_tables()
+        updated = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        rows = [{'codes': '', 'attempts': 0, 'error': '', **r, 'updated': updated} for r in rows]
+        sql = f"""INSERT OR REPLACE INTO update_journal ({', '.join(self.columns)})
+            VALUES ({', '.join(':' + c for c in self.columns)})"""
+
+        async def op(session):
+            await session.execute(text(sql), rows)
+            return len(rows)
+
+        return await self.write(op, len(rows))
+
+    async def cleanup_journal(self, before: str) -> int:
+        """删除交易日早于before的日志记录"""
+        self.ensure_tables()
+
+        async def op(session):
+            result = await session.execute(text("DELETE FROM update_journal WHERE date < :date"), {"date": before})
+            return result.rowcount
+
+        return await self.write(op)
+
+
+def create_kline_storage() -> KLineSQLiteStorage:
+    """按配置创建K线SQLite存储"""
+    if Config.kline_storage() == 'partitioned':
+        return KLinePartitionedStorage()
+    return KLineSQLiteStorage()
+
+
+def create_transaction_storage() -> TransactionSQLiteStorage:
+    """按配置创建交易数据SQLite存储"""
+    if Config.transaction_storage() == 'blocks':
+        return TransactionBlockStorage()
+    return TransactionSQLiteStorage()
+
+
+kls = create_kline_storage()
 fls = FflowSQLiteStorage()
-tss = TransactionSQLiteStorage()
+tss = create_transaction_storage()
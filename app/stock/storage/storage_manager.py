@@ -16,22 +16,25 @@ if importlib.util.find_spec("h5py") is None:
             return method
 
 else:
+    import os
     from traceback import format_exc
-    from typing import List, Dict, Any, Optional, Union
+    from typing import List, Dict, Any, Optional, Union, Callable
     from datetime import datetime, timedelta
-    from .sqlite import KLineSQLiteStorage, FflowSQLiteStorage, TransactionSQLiteStorage
+    from .sqlite import create_kline_storage, create_transaction_storage, FflowSQLiteStorage
     from .h5 import KLineStorage, FflowStorage, TransactionStorage
     import stockrt as srt
 
 
     class DataSyncManager:
         """数据同步管理器，用于H5和SQLite之间的数据同步"""
+        # 批量同步时每组的股票数上限
+        sync_chunk_size = 500
 
         def __init__(self):
             # 创建适配器实例
-            self.sqlite_kline = KLineSQLiteStorage()
+            self.sqlite_kline = create_kline_storage()
             self.sqlite_fflow = FflowSQLiteStorage()
-            self.sqlite_trans = TransactionSQLiteStorage()
+            self.sqlite_trans = create_transaction_storage()
 
             # 创建H5存储实例用于读取
             self.h5_kline = KLineStorage()
@@ -361,41 +364,80 @@ else:
 
             return results
 
-        async def sync_sqlite_to_h5(self) -> Dict[str, Dict[str, int]]:
+        async def sync_to_h5_batch(self, sqlite_storage, h5_storage, items: List[tuple],
+                                   limit_of: Callable[[int], int], key: str) -> Dict[str, Dict[str, int]]:
             """
-            同步多个股票的数据
+            批量将SQLite中多只股票的新数据同步到H5，并清理旧数据
+
+            按(K线类型, H5文件)分组，每组最多sync_chunk_size只股票：一次读出H5中各股票的最新时间，
+            在一个SQLite会话中读出新数据，在一次打开中写入H5，内存中只保留一组的数据
 
             Args:
-                fcodes: 股票代码列表
+                sqlite_storage: SQLite存储
+                h5_storage: H5存储
+                items: (股票代码, K线类型)列表
+                limit_of: K线类型对应的SQLite保留天数
+                key: 结果中的数据名称，可包含K线类型占位符，如'klines_{}'
 
             Returns:
-                同步结果统计
+                {股票代码: {数据名称: 同步记录数}}
             """
+            groups = {}
+            for c, t in items:
+                groups.setdefault((t, h5_storage.h5_saved_path(c, t)), []).append(c)
+
             results = {}
+            for (t, path), fcodes in groups.items():
+                name = key.format(t)
+                for i in range(0, len(fcodes), self.sync_chunk_size):
+                    codes = fcodes[i: i + self.sync_chunk_size]
+                    try:
+                        latest = h5_storage.max_dates(codes, t)
+                        arrays = await sqlite_storage.read_arrays_since({c: latest.get(c) for c in codes}, t)
+                        new_data = {}
+                        for c, arr in arrays.items():
+                            if c in latest:
+                                arr = arr[arr['time'] > latest[c]]
+                            if len(arr) > 0:
+                                new_data[c] = arr
+                        del arrays
+                        for st in h5_storage.save_datasets(new_data, t):
+                            logger.info(f"SQLite→H5 {os.path.basename(st['file'])} {name}: {st['codes']}只股票 {st['rows']}条记录, "
+                                        f"耗时 {st['seconds']:.2f}s, {st['rows'] / max(st['seconds'], 1e-6):.0f}条/秒")
+                    except Exception as e:
+                        logger.error(f"SQLite→H5 批量同步失败 {os.path.basename(path)} {name}: {str(e)}")
+                        logger.debug(format_exc())
+                        continue
+
+                    for c in codes:
+                        cnt = len(new_data.get(c, ()))
+                        if cnt > 0:
+                            await sqlite_storage.cleanup_old_data_by_days(c, t, max_days=limit_of(t))
+                        results.setdefault(c, {})[name] = cnt
+            return results
 
-            alltbls = await self.sqlite_kline.all_tables()
-            for tbl in alltbls:
-                _, c, t = tbl.split('_')
-                kcnt = await self.sqlite_to_h5_klines(c, int(t), 100 if int(t) == 101 else 10)
-                if c not in results:
-                    results[c] = {}
-                results[c].update({f'klines_{t}': kcnt})
-
-            alltbls = await self.sqlite_fflow.all_tables()
-            for tbl in alltbls:
-                _, c = tbl.split('_')
-                cnt = await self.sqlite_to_h5_fflow(c, 100)
-                if c not in results:
-                    results[c] = {}
-                results[c].update({'fflow': cnt})
-
-            alltbls = await self.sqlite_trans.all_tables()
-            for tbl in alltbls:
-                _, c = tbl.split('_')
-                cnt = await self.sqlite_to_h5_transactions(c, 10)
-                if c not in results:
-                    results[c] = {}
-                results[c].update({'transactions': cnt})
+        async def sync_sqlite_to_h5(self) -> Dict[str, Dict[str, int]]:
+            """
+            同步所有股票的数据
+
+            Returns:
+                同步结果统计
+            """
+            results = {}
+            batches = [
+                (self.sqlite_kline, self.h5_kline, lambda t: 100 if t == 101 else 10, 'klines_{}'),
+                (self.sqlite_fflow, self.h5_fflow, lambda t: 100, 'fflow'),
+                (self.sqlite_trans, self.h5_trans, lambda t: 10, 'transactions'),
+            ]
+            try:
+                for sqlite_storage, h5_storage, limit_of, key in batches:
+                    items = await sqlite_storage.saved_codes()
+                    for c, res in (await self.sync_to_h5_batch(sqlite_storage, h5_storage, items, limit_of, key)).items():
+                        results.setdefault(c, {}).update(res)
+            finally:
+                # 释放H5文件，其他进程(归档构建、迁移工具等)才能打开
+                for _, h5_storage, _, _ in batches:
+                    h5_storage.handles.close()
 
             return results
 
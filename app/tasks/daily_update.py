@@ -16,6 +16,8 @@ from app.stock.manager import AllStocks, AllBlocks
 from app.stock.history import Khistory as khis
 from app.stock.history import StockShareBonus, StockChanges, StockZtConcepts, StockDtInfo
 from app.selectors import SelectorsFactory as sfac
+from app.selectors.stock_base_selector import StockBaseSelector
+from app.tasks.journal import UpdateJournal
 
 logger = logging.getLogger(f'{Config.app_name}.{__package__}')
 
@@ -23,38 +25,68 @@ logger = logging.getLogger(f'{Config.app_name}.{__package__}')
 class DailyUpdater():
     """for daily update"""
     @classmethod
-    async def update_all(cls):
+    async def update_all(cls) -> bool:
+        """
+        每日更新，按交易日记录已完成的步骤和批次，中断后再次执行时只更新剩余部分
+
+        Returns:
+            所有步骤是否都已完成
+        """
         logger.info(f"START UPDATING....")
         datetoday = datetime.now()
         if TradingDate.is_holiday():
             logger.info(f"Today is holiday, no data to update.")
-            return
+            return True
 
         morningOnetime = False
         if datetoday.hour < 12:
             morningOnetime = True
             logger.info(f"update in the morning at {datetoday.hour}")
 
-        await cls.download_all_index_history()
-        await cls.update_new_stocks()
+        finished = True
+        if morningOnetime:
+            # 前一交易日晚上的更新未完成时先补完剩余部分
+            evening = UpdateJournal('daily_evening', TradingDate.prev_trading_date(TradingDate.max_trading_date()))
+            if await evening.unfinished():
+                logger.info(f'continue unfinished evening update of {evening.date}')
+                try:
+                    await cls.update_evening(evening)
+                except Exception as e:
+                    # 补完失败记录在前一交易日的日志中，不影响今天的更新
+                    logger.error(f'evening update of {evening.date} failed: {e}')
+                    logger.debug(traceback.format_exc())
+                    if not evening.failed_steps:
+                        evening.failed_steps.append('update_evening')
+                finished = await evening.finish()
+
+        journal = UpdateJournal('daily_morning' if morningOnetime else 'daily_evening')
+        await journal.start()
+        await journal.run_step('index_history', cls.download_all_index_history)
+        await journal.run_step('new_stocks', cls.update_new_stocks)
         if morningOnetime:
             # 只在早上执行的任务
             logger.info("update in the morning...")
             # 分红派息，每天更新一次即可
-            await cls.download_newly_noticed_bonuses()
+            await journal.run_step('bonuses', cls.download_newly_noticed_bonuses)
         else:
             # 只在晚上执行的任务
             logger.info("update in the afternoon")
-            # 更新所有股票都日k数据
-            await cls.download_all_stocks_khistory()
-            # 涨跌停数据，可以间隔，早晚都合适
-            await cls.fetch_zdt_stocks()
-            # 盘口异动数据, 每个交易日收盘后更新, 错过无法补录
-            await cls.update_stock_changes()
-            #
-            await cls.update_selectors()
+            await cls.update_evening(journal)
         # 早上也执行的任务，以防前一晚上没执行
-        await cls.update_twice_selectors()
+        await journal.run_step('twice_selectors', cls.update_twice_selectors)
+        return await journal.finish() and finished
+
+    @classmethod
+    async def update_evening(cls, journal: UpdateJournal):
+        """只在晚上执行的任务"""
+        # 更新所有股票都日k数据
+        await cls.download_all_stocks_khistory(journal)
+        # 涨跌停数据，可以间隔，早晚都合适
+        await journal.run_step('zdt_stocks', cls.fetch_zdt_stocks)
+        # 盘口异动数据, 每个交易日收盘后更新, 错过无法补录
+        await journal.run_step('stock_changes', cls.update_stock_changes)
+        #
+        await journal.run_step('selectors', cls.update_selectors)
 
     @classmethod
     async def download_all_index_history(cls):
@@ -63,8 +95,13 @@ class DailyUpdater():
         logger.info('index history updated!')
 
     @classmethod
-    async def download_all_stocks_khistory(cls):
-        logger.info('start download_all_stocks_khistory')
+    async def watching_codes(cls):
+        """
+        用户关注的股票和基金代码，同时清理已退市的关注
+
+        Returns:
+            (股票代码列表, 基金代码列表)
+        """
         all_users = await admin_user_list(None)
         stkcodes = []
         fundcodes = []
@@ -83,10 +120,43 @@ class DailyUpdater():
                     fundcodes.append(c)
                 elif stkrec.typekind == 'ABStock' or stkrec.typekind == 'BJStock':
                     stkcodes.append(c)
+        return list(set(stkcodes)), list(dict.fromkeys(fundcodes))
 
-        stkcodes = list(set(stkcodes))
-        await AllStocks.update_klines_by_code(stkcodes, 'd')
+    @classmethod
+    async def download_all_stocks_khistory(cls, journal: UpdateJournal = None):
+        logger.info('start download_all_stocks_khistory')
+        if journal is None:
+            journal = UpdateJournal('daily_evening')
+        # 关注列表只在步骤首次执行时读取，之后按日志中记录的批次继续
+        watching = []
+        async def codes(i):
+            if not watching:
+                watching.extend(await cls.watching_codes())
+            return watching[i]
+
+        async def check_quit():
+            await cls.check_stocks_quit(await codes(0))
+
+        await journal.run_batches('stocks_khistory', lambda: codes(0), lambda c: AllStocks.update_klines_by_code(c, 'd'))
+        await journal.run_step('stocks_quit_check', check_quit)
+        logger.info('download all stocks khistory done!')
+
+        await journal.run_batches('funds_khistory', lambda: codes(1), lambda c: AllStocks.update_klines_by_code(c, 'd'))
+        logger.info('funds history updated!')
+        for k in (15, 5, 1):
+            if await SystemSettings.get(f'daily_{k}min', '0') == '1':
+                logger.info(f'update fund {k}min history')
+                await journal.run_batches(f'funds_{k}min', lambda: codes(1),
+                                          lambda c, k=k: AllStocks.update_klines_by_code(c, k))
+        if await SystemSettings.get('daily_trans', '0') == '1':
+            logger.info('update daily transactions')
+            await journal.run_batches('funds_trans', lambda: codes(1), AllStocks.update_transactions_by_code)
+
+        logger.info('download all funds khistory done!')
 
+    @classmethod
+    async def check_stocks_quit(cls, stkcodes):
+        """超过20个交易日没有数据的股票检查是否已退市"""
         upfailed = []
         for c in stkcodes:
             date = await khis.max_date(c, 'd')
@@ -96,25 +166,6 @@ class DailyUpdater():
             logger.info(f'stocks update failed: {upfailed}')
             await AllStocks.check_stock_quit(upfailed)
 
-        logger.info('download all stocks khistory done! %d' % len(stkcodes))
-
-        await AllStocks.update_klines_by_code(fundcodes, 'd')
-        logger.info('funds history updated!')
-        if await SystemSettings.get('daily_15min', '0') == '1':
-            logger.info('update fund 15min history')
-            await AllStocks.update_klines_by_code(fundcodes, 15)
-        if await SystemSettings.get('daily_5min', '0') == '1':
-            logger.info('update fund 5min history')
-            await AllStocks.update_klines_by_code(fundcodes, 5)
-        if await SystemSettings.get('daily_1min', '0') == '1':
-            logger.info('update fund 1min history')
-            await AllStocks.update_klines_by_code(fundcodes, 1)
-        if await SystemSettings.get('daily_trans', '0') == '1':
-            logger.info('update daily transactions')
-            await AllStocks.update_transactions_by_code(fundcodes)
-
-        logger.info('download all funds khistory done! %d' % len(fundcodes))
-
     @classmethod
     async def update_new_stocks(cls):
         # 新股信息，可以间隔几天更新一次
@@ -170,14 +221,16 @@ class DailyUpdater():
         #     'StockEndVolumeSelector'
         ]
 
-        for s in selectors:
-            sel = sfac.get(s)
-            logger.info(f'update {s}')
-            try:
-                await sel.update_pickups()
-            except Exception as e:
-                logger.info(e)
-                logger.debug(traceback.format_exc())
+        with StockBaseSelector.kline_cache_scope() as kcache:
+            for s in selectors:
+                sel = sfac.get(s)
+                logger.info(f'update {s}')
+                try:
+                    await sel.update_pickups()
+                except Exception as e:
+                    logger.info(e)
+                    logger.debug(traceback.format_exc())
+                logger.info(f'kline cache after {s}: {kcache.stats()}')
 
     @classmethod
     async def update_twice_selectors(cls):
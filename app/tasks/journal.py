@@ -0,0 +1,217 @@
+# Python 3
+# -*- coding:utf-8 -*-
+import asyncio
+import inspect
+from traceback import format_exc
+from typing import Callable, List, Optional, Tuple, Union
+from app.lofig import Config, logging
+from app.stock.date import TradingDate
+from app.stock.storage.sqlite import UpdateJournalStorage
+
+
+logger = logging.getLogger(f'{Config.app_name}.{__package__}')
+
+
+class UpdateJournal:
+    """
+    更新任务日志
+
+    按(交易日, 任务)记录各步骤和批次的执行状态。任务中断后再次执行时跳过已完成的步骤，
+    按股票分批的步骤只执行未完成的批次，失败的批次单独重试。
+    步骤记录的batch为0；step为空的记录表示整个任务。
+    """
+    storage = UpdateJournalStorage()
+    max_attempts = 3
+    retry_delay = 10
+    keep_days = 30
+
+    def __init__(self, task: str, date: str = None):
+        """
+        Args:
+            task: 任务名称
+            date: 交易日，默认为TradingDate.max_trading_date()
+        """
+        self.task = task
+        self.date = date or TradingDate.max_trading_date()
+        self.failed_steps = []
+
+    @staticmethod
+    def default_batch_size() -> int:
+        """每批股票数，默认足够K线下载流水线的各并发批次同时执行"""
+        cfg = Config.kline_fetch_config()
+        return cfg['batch_size'] * cfg['concurrency']
+
+    def _row(self, step: str, batch: int, status: str, **kwargs) -> dict:
+        return {'date': self.date, 'task': self.task, 'step': step, 'batch': batch, 'status': status, **kwargs}
+
+    @staticmethod
+    def _codes(row: dict) -> List[str]:
+        return row['codes'].split(',') if row['codes'] else []
+
+    async def _step_record(self, step: str) -> Tuple[Optional[dict], List[dict]]:
+        rows = await self.storage.read_journal(self.date, self.task, step)
+        record = next((r for r in rows if r['batch'] == 0), None)
+        return record, [r for r in rows if r['batch'] > 0]
+
+    async def start(self):
+        """开始执行任务，同时清理过期的日志"""
+        record, _ = await self._step_record('')
+        if record is None or record['status'] != 'done':
+            await self.storage.save_journal([self._row('', 0, 'pending')])
+        await self.storage.cleanup_journal(TradingDate.prev_trading_date(self.date, self.keep_days))
+
+    async def finish(self) -> bool:
+        """
+        结束任务
+
+        Returns:
+            所有步骤是否都已完成
+        """
+        status = 'failed' if self.failed_steps else 'done'
+        await self.storage.save_journal([self._row('', 0, status, error=','.join(self.failed_steps))])
+        return not self.failed_steps
+
+    async def unfinished(self) -> bool:
+        """任务已开始但未全部完成"""
+        record, _ = await self._step_record('')
+        return record is not None and record['status'] != 'done'
+
+    async def step_status(self, step: str) -> Optional[str]:
+        record, _ = await self._step_record(step)
+        return record['status'] if record else None
+
+    async def run_step(self, step: str, func: Callable, *args, **kwargs) -> bool:
+        """
+        执行一个步骤，已完成的步骤直接跳过；执行失败时记录错误并重新抛出异常
+
+        Args:
+            step: 步骤名称
+            func: 同步或异步函数
+            args, kwargs: func的参数
+
+        Returns:
+            True
+        """
+        record, _ = await self._step_record(step)
+        if record is not None and record['status'] == 'done':
+            logger.info(f'{self.task} {self.date} {step} already done')
+            return True
+        attempts = record['attempts'] + 1 if record else 1
+        await self.storage.save_journal([self._row(step, 0, 'pending', attempts=attempts)])
+        try:
+            result = func(*args, **kwargs)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            self.failed_steps.append(step)
+            await self.storage.save_journal([self._row(step, 0, 'failed', attempts=attempts, error=str(e))])
+            raise
+        await self.storage.save_journal([self._row(step, 0, 'done', attempts=attempts)])
+        return True
+
+    async def _plan(self, step: str, codes: Union[List[str], Callable], batch_size: int) -> List[dict]:
+        """首次执行步骤时记录全部批次"""
+        if callable(codes):
+            codes = codes()
+            if inspect.isawaitable(codes):
+                codes = await codes
+        codes = list(codes or [])
+        batch_size = batch_size or self.default_batch_size()
+        batches = [self._row(step, i // batch_size + 1, 'pending', codes=','.join(codes[i: i + batch_size]),
+                             attempts=0, error='') for i in range(0, len(codes), batch_size)]
+        # 步骤记录与批次记录在同一事务中写入
+        await self.storage.save_journal([self._row(step, 0, 'pending')] + batches)
+        logger.info(f'{self.task} {self.date} {step}: {len(codes)} codes in {len(batches)} batches')
+        return batches
+
+    async def _run_batch(self, step: str, row: dict, func: Callable, next_batch: int) -> List[dict]:
+        """
+        执行一个批次，部分失败时成功的代码留在原批次，失败的代码记为新的批次
+
+        Returns:
+            失败的批次记录列表
+        """
+        codes = self._codes(row)
+        attempts = row['attempts'] + 1
+        error = ''
+        try:
+            failed = set(await func(codes) or [])
+            if failed:
+                error = f'{len(failed)} codes failed'
+        except Exception as e:
+            logger.error(f'{self.task} {self.date} {step} batch {row["batch"]} failed: {e}')
+            logger.debug(format_exc())
+            failed = set(codes)
+            error = str(e)
+
+        done = [c for c in codes if c not in failed]
+        left = [c for c in codes if c in failed]
+        if not left:
+            rows = [self._row(step, row['batch'], 'done', codes=row['codes'], attempts=attempts)]
+            failed_rows = []
+        elif not done:
+            rows = failed_rows = [self._row(step, row['batch'], 'failed', codes=row['codes'], attempts=attempts,
+                                            error=error)]
+        else:
+            failed_rows = [self._row(step, next_batch, 'failed', codes=','.join(left), attempts=attempts,
+                                     error=error)]
+            rows = [self._row(step, row['batch'], 'done', codes=','.join(done), attempts=attempts)] + failed_rows
+        await self.storage.save_journal(rows)
+        return failed_rows
+
+    async def run_batches(self, step: str, codes: Union[List[str], Callable], func: Callable,
+                          batch_size: int = None) -> List[str]:
+        """
+        按股票分批执行一个步骤，只执行未完成的批次，失败的批次单独重试max_attempts轮
+
+        Args:
+            step: 步骤名称
+            codes: 股票代码列表，或返回代码列表的函数；只在首次执行该步骤时使用，之后按日志中的批次继续
+            func: 异步函数func(codes)，返回失败的股票代码列表
+            batch_size: 每批股票数，默认为default_batch_size()
+
+        Returns:
+            重试后仍然失败的股票代码列表
+        """
+        record, batches = await self._step_record(step)
+        if record is not None and record['status'] == 'done':
+            logger.info(f'{self.task} {self.date} {step} already done')
+            return []
+        if not batches:
+            try:
+                batches = await self._plan(step, codes, batch_size)
+            except Exception as e:
+                logger.error(f'{self.task} {self.date} {step} failed: {e}')
+                logger.debug(format_exc())
+                self.failed_steps.append(step)
+                await self.storage.save_journal([self._row(step, 0, 'failed', error=str(e))])
+                return []
+        attempts = record['attempts'] + 1 if record else 1
+
+        pending = [r for r in batches if r['status'] != 'done']
+        if len(pending) < len(batches):
+            logger.info(f'{self.task} {self.date} {step}: {len(batches) - len(pending)} batches done, '
+                        f'{len(pending)} remaining')
+        next_batch = max(r['batch'] for r in batches) + 1 if batches else 1
+        for i in range(self.max_attempts):
+            if not pending:
+                break
+            if i > 0:
+                logger.info(f'{self.task} {self.date} {step}: retry {len(pending)} failed batches')
+                if self.retry_delay > 0:
+                    await asyncio.sleep(self.retry_delay)
+            failed_rows = []
+            for row in pending:
+                failed = await self._run_batch(step, row, func, next_batch)
+                if failed and failed[0]['batch'] == next_batch:
+                    next_batch += 1
+                failed_rows += failed
+            pending = failed_rows
+
+        left = [c for r in pending for c in self._codes(r)]
+        if left:
+            self.failed_steps.append(step)
+            logger.error(f'{self.task} {self.date} {step}: {len(left)} codes failed after {self.max_attempts} attempts')
+        await self.storage.save_journal([self._row(step, 0, 'failed' if left else 'done', attempts=attempts,
+                                                   error=f'{len(left)} codes failed' if left else '')])
+        return left
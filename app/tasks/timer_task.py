@@ -258,8 +258,9 @@ class Timers:
         try:
             lastdaily_run_at = await SystemSettings.get('lastdaily_run_at', '')
             if cls.daily_should_run(lastdaily_run_at, dnow):
-                await du.update_all()
-                await SystemSettings.set('lastdaily_run_at', dnow.strftime(f"%Y-%m-%d %H:%M"))
+                # 有未完成的步骤时不记录运行时间，再次执行时按更新日志只补完剩余部分
+                if await du.update_all():
+                    await SystemSettings.set('lastdaily_run_at', dnow.strftime(f"%Y-%m-%d %H:%M"))
 
             lastweekly_run_at = await SystemSettings.get('lastweekly_run_at', '')
             if cls.weekly_should_run(lastweekly_run_at, dnow):
@@ -14,6 +14,7 @@ from app.stock.manager import AllStocks, AllBlocks
 from app.admin.router import admin_user_list
 from app.admin.system_settings import SystemSettings
 from app.users.usmanager import UserStockManager as usm
+from app.tasks.journal import UpdateJournal
 
 
 logger = logging.getLogger(f'{Config.app_name}.{__package__}')
@@ -48,26 +49,27 @@ async def update_stock_transactions():
         logger.debug(format_exc())
 
 async def update_daily_trade_closed_history():
+    # 按交易日记录已完成的步骤和批次，进程重启后再次执行时只更新剩余部分
+    journal = UpdateJournal('trade_closed')
     try:
-        await AllStocks.update_kline_data('d', sectype='Index')
+        await journal.start()
+        await journal.run_step('index_history', AllStocks.update_kline_data, 'd', sectype='Index')
         logger.info('index history updated!')
         TradingDate.clear_cache()
-        await AllStocks.update_kline_data('d')
+        await journal.run_batches('stock_history', lambda: AllStocks.kline_targets('d'),
+                                  lambda codes: AllStocks.update_klines_by_code(codes, 'd'))
         logger.info('stock history updated!')
-        if await SystemSettings.get('daily_15min', '0') == '1':
-            logger.info('update 15min history')
-            await AllStocks.update_kline_data(15)
-        if await SystemSettings.get('daily_5min', '0') == '1':
-            logger.info('update 5min history')
-            await AllStocks.update_kline_data(5)
-        if await SystemSettings.get('daily_1min', '0') == '1':
-            logger.info('update 1min history')
-            await AllStocks.update_kline_data(1)
+        # 各分钟K线的下载批次在同一个流水线中执行，网络与写入时间重叠
+        kltypes = [k for k in (15, 5, 1) if await SystemSettings.get(f'daily_{k}min', '0') == '1']
+        if kltypes:
+            logger.info(f'update {kltypes} min history')
+            await journal.run_batches(f'minute_history_{"_".join(map(str, kltypes))}', AllStocks.listed_stock_codes,
+                                      lambda codes: AllStocks.update_minute_klines(kltypes, codes))
+        await journal.finish()
     except Exception as e:
         logger.error(f'Error updating daily history data: {e}')
         logger.debug(format_exc())
 
-
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
     loop.run_until_complete(update_daily_trade_closed_history())
@@ -1,4 +1,5 @@
 import json
+import asyncio
 from typing import Union
 from app.users.models import UserArchivedDeals, UserStockBuy, UserStockSell
 from app.lofig import logger
@@ -849,7 +850,8 @@ class UserStockManager():
             if cost_hold != 0 or portion_hold != 0:
                 uss[c] = {'cost': cost_hold, 'ptn': portion_hold}
 
-        quotes = qot.get_quotes(list(uss.keys()))
+        # 行情请求和BatchSingleFlight的等待都是阻塞的，放到线程中执行
+        quotes = await asyncio.to_thread(qot.get_quotes, list(uss.keys()))
         if len(quotes) < len(uss):
             logger.warning(f'update_earning get latest prices error: fetch {len(uss)}, actual {len(quotes)}')
             for c, qt in quotes.items():
@@ -7,8 +7,10 @@ Provides common setup, teardown, and utility functions for all tests.
 import unittest
 import sys
 import os
+import shutil
+import tempfile
 from typing import Optional, List, Dict, Any
-from unittest.mock import AsyncMock, Mock
+from unittest.mock import AsyncMock, Mock, patch
 
 # Add project root to Python path (done once here)
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -162,6 +164,48 @@ class MockTestCaseMixin:
         return session
 
 
+class HistoryDirMixin:
+    """Mixin giving storage tests a temporary history directory for H5 files and SQLite databases."""
+
+    def setup_history_dir(self, h5_pool: bool = False) -> str:
+        """
+        Point Config.h5_history_dir to a new temporary directory.
+
+        Args:
+            h5_pool: also give KLineStorage a fresh H5HandlePool and clear its read cache
+        """
+        self.tmpdir = tempfile.mkdtemp()
+        self._history_patchers = [patch('app.lofig.Config.h5_history_dir', return_value=self.tmpdir)]
+        self.h5_pool = None
+        if h5_pool:
+            from app.stock.storage.h5 import KLineStorage, H5HandlePool
+            self.h5_pool = H5HandlePool()
+            self._history_patchers.append(patch.object(KLineStorage, 'handles', self.h5_pool))
+            KLineStorage._read_cache.clear()
+        for p in self._history_patchers:
+            p.start()
+        return self.tmpdir
+
+    def cleanup_history_dir(self):
+        """Close pooled H5 handles, stop the patches and remove the temporary directory."""
+        if self.h5_pool is not None:
+            self.h5_pool.close()
+        for p in reversed(self._history_patchers):
+            p.stop()
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    async def dispose_storages(self, *storages):
+        """Drop the shared writers and dispose the engines of SQLite storages."""
+        from app.stock.storage.sqlite import SQLiteWriter
+        for storage in storages:
+            if storage is None:
+                continue
+            SQLiteWriter.writers.pop(storage.db_path, None)
+            if storage._engine is not None:
+                await storage._engine.dispose()
+            storage.sync_engine.dispose()
+
+
 # Utility functions
 def assert_lists_equal_ignore_order(list1: List[Any], list2: List[Any], msg: Optional[str] = None):
     """Assert that two lists contain the same elements regardless of order."""
@@ -63,6 +63,31 @@ class DatabaseMock:
         return result
 
 
+def make_klines(dates: List[str], close: float = 10.0, step: float = 0.0) -> List[Dict[str, Any]]:
+    """
+    Create K-line dicts with every KNode field.
+
+    Args:
+        dates: K-line times
+        close: price of the first K-line
+        step: close increment per K-line, all prices equal close when 0
+    """
+    klines = []
+    for i, d in enumerate(dates):
+        c = close + i * step
+        klines.append({'time': d, 'open': close, 'close': c, 'high': c, 'low': close, 'volume': 100,
+                       'amount': c * 100, 'change': 0.0, 'change_px': 0.0, 'amplitude': 0.0, 'turnover': 0.0})
+    return klines
+
+
+def make_kline_array(dates: List[str], close: float = 10.0, step: float = 0.0):
+    """make_klines() as a structured array with time/open/close/high/low/volume, the H5 input format."""
+    import numpy as np
+    dtype = [('time', 'U20'), ('open', 'float64'), ('close', 'float64'), ('high', 'float64'),
+             ('low', 'float64'), ('volume', 'int64')]
+    return np.array([tuple(k[name] for name, _ in dtype) for k in make_klines(dates, close, step)], dtype=dtype)
+
+
 class StockDataMock:
     """Mock stock data provider for testing."""
 
@@ -120,18 +120,16 @@ class TestStocks(unittest.IsolatedAsyncioTestCase):
             ]
         }
 
-        # Mock khis.max_date - 第三只股票数据不连续
-        def mock_max_date(code, period):
-            if code == '000002':
-                return '2024-11-30'  # 数据不连续
-            return '2024-12-03'
-
-        mock_khis.max_date.side_effect = mock_max_date
-        mock_khis.save_kline = Mock()
-
-        # Mock fhis.max_date
-        mock_fhis.max_date.side_effect = lambda code: '2024-12-03'
-        mock_fhis.save_fflow = Mock()
+        # Mock khis.max_dates - 第三只股票数据不连续
+        def mock_max_dates(codes, period):
+            return {code: '2024-11-30' if code == '000002' else '2024-12-03' for code in codes}
+
+        mock_khis.max_dates = AsyncMock(side_effect=mock_max_dates)
+        mock_khis.save_kline = AsyncMock()
+
+        # Mock fhis.max_dates
+        mock_fhis.max_dates = AsyncMock(side_effect=lambda codes: {code: '2024-12-03' for code in codes})
+        mock_fhis.save_fflow = AsyncMock()
 
         # 执行测试
         unconfirmed = await AllStocks.update_stock_daily_kline_and_fflow()
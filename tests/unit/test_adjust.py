@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Unit tests for price adjustment factors.
+"""
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from types import SimpleNamespace
+import numpy as np
+from base import BaseTestCase
+from app.stock.adjust import AdjustFactors
+
+
+def bonus(date, total_bonus, cash_dividend):
+    return SimpleNamespace(ex_dividend_date=date, total_bonus=total_bonus, cash_dividend=cash_dividend)
+
+
+class TestAdjustFactors(BaseTestCase):
+    """Test forward/backward price adjustment."""
+
+    def _setup_test_data(self):
+        self.bndata = [
+            bonus('2024-06-10', 0, 5),
+            bonus('2024-01-10', 10, 2),
+            bonus('2024-09-10', 0, 0),
+        ]
+        self.times = ['2024-01-09', '2024-01-10', '2024-06-07', '2024-06-10', '2024-06-11']
+        self.closes = [20.0, 9.0, 10.0, 9.5, 9.6]
+
+    def _klines(self):
+        return [{'time': t, 'open': c, 'close': c, 'high': c, 'low': c, 'volume': 100}
+                for t, c in zip(self.times, self.closes)]
+
+    def test_pre_adjust(self):
+        result = AdjustFactors(self.bndata).apply(self._klines(), 1)
+        # 2024-01-09: (20 - 0.2) / 2 - 0.5
+        self.assertAlmostEqual(result[0]['close'], 9.4)
+        self.assertAlmostEqual(result[1]['close'], 8.5)
+        self.assertAlmostEqual(result[2]['close'], 9.5)
+        self.assertAlmostEqual(result[3]['close'], 9.5)
+        self.assertAlmostEqual(result[4]['close'], 9.6)
+
+    def test_pre_adjust_ignores_later_dividends(self):
+        klines = self._klines()[:3]
+        result = AdjustFactors(self.bndata).apply(klines, 1)
+        self.assertAlmostEqual(result[0]['close'], 9.9)
+        self.assertAlmostEqual(result[2]['close'], 10.0)
+
+    def test_post_adjust(self):
+        result = AdjustFactors(self.bndata).apply(self._klines(), 2)
+        self.assertAlmostEqual(result[0]['close'], 20.0)
+        # 2024-01-10: 9 * 2 + 0.2
+        self.assertAlmostEqual(result[1]['close'], 18.2)
+        self.assertAlmostEqual(result[2]['close'], 20.2)
+        # 2024-06-10: 派息不再乘送转比例, 9.5 * 2 + 0.2 + 0.5
+        self.assertAlmostEqual(result[3]['close'], 19.7)
+
+    def test_array_and_tuple_inputs(self):
+        dtype = np.dtype([('time', 'U20'), ('open', 'f8'), ('close', 'f8'), ('high', 'f8'), ('low', 'f8'), ('volume', 'i8')])
+        arr = np.array([(t, c, c, c, c, 100) for t, c in zip(self.times, self.closes)], dtype=dtype)
+        factors = AdjustFactors(self.bndata)
+        fixed = factors.apply(arr, 1)
+        self.assertAlmostEqual(arr['close'][0], 20.0)
+        self.assertEqual(fixed['close'].tolist(), [9.4, 8.5, 9.5, 9.5, 9.6])
+
+        rows = factors.apply(arr.tolist(), 1)
+        self.assertEqual([r[2] for r in rows], [9.4, 8.5, 9.5, 9.5, 9.6])
+        self.assertEqual(rows[0][5], 100)
+
+    def test_no_bonus(self):
+        klines = self._klines()
+        self.assertIs(AdjustFactors([]).apply(klines, 1), klines)
+        self.assertEqual(klines[0]['close'], 20.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Unit tests for multi-code K-line cross-section reads.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from unittest.mock import patch
+from base import BaseAsyncTestCase, HistoryDirMixin
+from mocks import make_klines
+
+
+DATES = ['2025-01-02', '2025-01-03', '2025-01-06', '2025-01-07']
+
+
+class TestReadCrossSection(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that cross-section reads match per-code reads in both table layouts."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import KLineSQLiteStorage, KLinePartitionedStorage
+        self.setup_history_dir()
+        self.storages = [KLineSQLiteStorage(), KLinePartitionedStorage()]
+
+    async def _seed(self, n):
+        self.codes = [f'sh{600000 + i}' for i in range(n // 2)] + [f'sz{i:06d}' for i in range(n - n // 2)]
+        self.datasets = {}
+        for i, c in enumerate(self.codes):
+            # 部分股票缺少某些交易日
+            dates = [d for j, d in enumerate(DATES) if (i + j) % 5 != 0]
+            self.datasets[c] = make_klines(dates, 10.0 + i % 50, step=1.0)
+        for storage in self.storages:
+            await storage.save_kline_data_many(self.datasets, 101)
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(*self.storages)
+        self.cleanup_history_dir()
+
+    async def _check_matches_per_code(self, storage, cs, codes, start, end):
+        self.assertEqual(cs[['time', 'code']].tolist(), sorted(cs[['time', 'code']].tolist()))
+        counts = {c: sum(start <= k['time'] <= end for k in self.datasets.get(c, [])) for c in codes}
+        self.assertEqual(len(cs), sum(counts.values()))
+        names = list(storage.numpy_dtype.names)
+        # 逐只读取较慢，抽样比较
+        for c in codes[::25] + codes[-1:]:
+            kd = await storage.read_kline_array(c, 101, start=start, end=end)
+            part = cs[cs['code'] == c]
+            self.assertEqual(len(part), counts[c], c)
+            if kd is not None:
+                self.assertEqual(part[names].tolist(), kd[names].tolist(), c)
+
+    async def test_cross_section_matches_per_code(self):
+        # 超过500只股票，分表存储时需分批UNION ALL，分区存储的代码过滤需分批IN
+        await self._seed(520)
+        codes = self.codes[3:515] + ['sz999999']
+        for storage in self.storages:
+            cs = await storage.read_cross_section('2025-01-03')
+            self.assertEqual(set(cs['time'].tolist()), {'2025-01-03'})
+            self.assertGreater(len(cs), 400)
+            await self._check_matches_per_code(storage, cs, self.codes, '2025-01-03', '2025-01-03 23:59:59')
+
+            cs = await storage.read_cross_section('2025-01-03', '2025-01-06', 101, codes)
+            self.assertEqual(set(cs['time'].tolist()), {'2025-01-03', '2025-01-06'})
+            self.assertEqual(set(cs['code'].tolist()), set(self.codes[3:515]))
+            await self._check_matches_per_code(storage, cs, codes, '2025-01-03', '2025-01-06')
+
+    async def test_get_kd_data_batch(self):
+        from app.stock.history import Khistory
+        from app.selectors.stock_base_selector import StockBaseSelector
+        await self._seed(30)
+        starts = {c: DATES[i % 3] for i, c in enumerate(self.codes)}
+        for storage in self.storages:
+            with patch('app.stock.history.kls', storage):
+                batch = await StockBaseSelector().get_kd_data_batch(starts, '2025-01-06')
+                for c, start in starts.items():
+                    kd = await Khistory.read_kline(c, 'd', start=start)
+                    expected = StockBaseSelector.to_knodes([k for k in kd if k['time'] <= '2025-01-06'])
+                    if expected:
+                        self.assertEqual(batch[c], expected, c)
+                    else:
+                        self.assertNotIn(c, batch)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Unit tests for bulk insert/upsert helpers in app.db.
+"""
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+import tempfile
+from unittest.mock import patch
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from base import BaseAsyncTestCase
+from app.db import Base, insert_many, upsert_many, upsert_many_bulk, query_values
+from app.stock.models import MdlStockShare, MdlStockBkMap
+
+
+class TestBulkUpsert(BaseAsyncTestCase):
+    """Test chunked bulk upsert against a temporary sqlite database."""
+
+    async def _setup_test_data(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.engine = create_async_engine(f"sqlite+aiosqlite:///{self.tmpdir.name}/test.db")
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[MdlStockShare.__table__, MdlStockBkMap.__table__])
+        maker = sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.patcher = patch('app.db.async_session_maker', maker)
+        self.patcher.start()
+
+    async def _cleanup_test_data(self):
+        self.patcher.stop()
+        await self.engine.dispose()
+        self.tmpdir.cleanup()
+
+    def _bonus(self, i, cash=1.0):
+        return {'code': f'{600000 + i}', 'report_date': '2024-12-31', 'cash_dividend': cash, 'total_bonus': 0}
+
+    async def test_upsert_counts(self):
+        rows = [self._bonus(i) for i in range(1200)]
+        self.assertEqual(await upsert_many(MdlStockShare, rows, ['code', 'report_date']), (1200, 0))
+
+        rows[5] = self._bonus(5, 2.5)
+        rows[1100] = self._bonus(1100, 3.0)
+        rows.append(self._bonus(2000))
+        self.assertEqual(await upsert_many(MdlStockShare, rows, ['code', 'report_date']), (1, 2))
+        self.assertEqual(await upsert_many(MdlStockShare, rows, ['code', 'report_date']), (0, 0))
+
+        values = dict(await query_values(MdlStockShare, ['code', 'cash_dividend']))
+        self.assertEqual(len(values), 1201)
+        self.assertEqual(values['600005'], 2.5)
+        self.assertEqual(values['601100'], 3.0)
+
+    async def test_upsert_without_matching_constraint(self):
+        await upsert_many_bulk(MdlStockShare, [self._bonus(1), self._bonus(2)], ['code', 'report_date'])
+        # 唯一字段与主键不一致时使用普通的insert/update
+        result = await upsert_many_bulk(MdlStockShare, [self._bonus(1, 5.0), self._bonus(3)], ['code'], chunk_size=1)
+        self.assertEqual(result, (1, 1))
+        values = dict(await query_values(MdlStockShare, ['code', 'cash_dividend']))
+        self.assertEqual(values, {'600001': 5.0, '600002': 1.0, '600003': 1.0})
+
+    async def test_insert_many_skips_existing(self):
+        self.assertEqual(await insert_many(MdlStockBkMap, [{'bk': 'BK01', 'stock': 's1'}]), 1)
+        rows = [{'bk': 'BK01', 'stock': f's{i}'} for i in range(5)] + [{'bk': 'BK01', 'stock': 's4'}]
+        self.assertEqual(await insert_many(MdlStockBkMap, rows, ['bk', 'stock'], chunk_size=2), 4)
+        self.assertEqual(len(await query_values(MdlStockBkMap)), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
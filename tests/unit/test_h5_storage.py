@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Unit tests for HDF5 storage handle pooling and read cache invalidation.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from base import BaseTestCase, HistoryDirMixin
+from mocks import make_kline_array
+
+
+class TestH5HandlePool(HistoryDirMixin, BaseTestCase):
+    """Test that pooled reads see every write."""
+
+    def _setup_test_data(self):
+        from app.stock.storage.h5 import KLineStorage
+        self.setup_history_dir(h5_pool=True)
+        self.kls = KLineStorage
+        self.pool = self.h5_pool
+
+    def _cleanup_test_data(self):
+        self.cleanup_history_dir()
+
+    def test_reads_are_cached_until_write(self):
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02', '2025-01-03']))
+        first = self.kls.read_saved_data('sh600000')
+        self.assertEqual(first['time'].tolist(), ['2025-01-02', '2025-01-03'])
+        self.assertIs(self.kls.read_saved_data('sh600000'), first)
+        self.assertEqual(len(self.pool.files), 1)
+
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-03', '2025-01-06'], 11.0))
+        second = self.kls.read_saved_data('sh600000')
+        self.assertEqual(second['time'].tolist(), ['2025-01-02', '2025-01-03', '2025-01-06'])
+        self.assertEqual(second['close'].tolist(), [10.0, 11.0, 11.0])
+        self.assertEqual(self.kls.max_date('sh600000'), '2025-01-06')
+
+        self.kls.delete_dataset('sh600000')
+        self.assertIsNone(self.kls.read_saved_data('sh600000'))
+        self.assertEqual(self.kls.max_date('sh600000'), '')
+
+    def test_other_datasets_stay_cached(self):
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02']))
+        self.kls.save_dataset('sh600001', make_kline_array(['2025-01-02']))
+        data = self.kls.read_saved_data('sh600001')
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-03']))
+        self.assertIs(self.kls.read_saved_data('sh600001'), data)
+
+    def test_external_change_reopens(self):
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02']))
+        data = self.kls.read_saved_data('sh600000')
+        path = self.kls.h5_saved_path('sh600000')
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+        self.assertIsNot(self.kls.read_saved_data('sh600000'), data)
+        self.assertIsNone(self.kls.read_saved_data('sz000001'))
+
+    def _open_in_subprocess(self, path):
+        import subprocess
+        script = 'import sys, h5py\nwith h5py.File(sys.argv[1], "a") as f:\n    f.require_group("probe")'
+        return subprocess.run([sys.executable, '-c', script, path], capture_output=True, text=True)
+
+    def test_other_process_can_open_after_write(self):
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02']))
+        self.kls.save_datasets({'sh600000': make_kline_array(['2025-01-03']), 'sh600001': make_kline_array(['2025-01-03'])})
+        path = self.kls.h5_saved_path('sh600000')
+        self.assertEqual(len(self.pool.files), 0)
+        result = self._open_in_subprocess(path)
+        self.assertEqual(result.returncode, 0, result.stderr)
+
+        self.assertEqual(self.kls.read_saved_data('sh600000')['time'].tolist(), ['2025-01-02', '2025-01-03'])
+        self.pool.close()
+        result = self._open_in_subprocess(path)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(self.kls.read_saved_data('sh600001')['time'].tolist(), ['2025-01-03'])
+
+    def test_dataset_profiles(self):
+        import h5py
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02']))
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02 09:31', '2025-01-02 09:32']), 1)
+        self.pool.close()
+        with h5py.File(self.kls.h5_saved_path('sh600000'), 'r') as f:
+            dset = f['data']['sh600000']
+            self.assertEqual((dset.compression, dset.compression_opts, dset.shuffle, dset.chunks),
+                             ('gzip', 4, True, (256,)))
+        with h5py.File(self.kls.h5_saved_path('sh600000', 1), 'r') as f:
+            dset = f['data']['sh600000']
+            self.assertEqual((dset.compression, dset.compression_opts, dset.chunks), ('gzip', 1, (1024,)))
+            self.assertEqual(len(dset), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
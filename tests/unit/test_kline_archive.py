@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the memmap columnar K-line archive.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from unittest.mock import patch
+import numpy as np
+from base import BaseTestCase, HistoryDirMixin
+from mocks import make_kline_array
+
+
+class TestKLineArchive(HistoryDirMixin, BaseTestCase):
+    """Test incremental builds and zero-copy reads."""
+
+    def _setup_test_data(self):
+        from app.stock.storage.h5 import KLineStorage
+        from app.stock.storage.archive import KLineArchive
+        self.setup_history_dir(h5_pool=True)
+        self.kls = KLineStorage
+        self.archive = KLineArchive(101)
+
+    def _cleanup_test_data(self):
+        self.cleanup_history_dir()
+
+    def test_build_from_h5_incrementally(self):
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-02', '2025-01-03']))
+        self.kls.save_dataset('sz000001', make_kline_array(['2025-01-02']))
+        self.assertEqual(self.archive.build_from_h5(), 3)
+        self.assertEqual(self.archive.build_from_h5(), 0)
+
+        cols = self.archive.read('sh600000', ['time', 'close'])
+        self.assertIsInstance(cols['close'], np.memmap)
+        self.assertEqual(cols['time'].tolist(), [20250102000000, 20250103000000])
+
+        self.kls.save_dataset('sh600000', make_kline_array(['2025-01-06'], 11.0))
+        self.assertEqual(self.archive.build_from_h5(), 1)
+        self.assertEqual(len(self.archive.index), 3)
+        klines = self.archive.read_kline_array('sh600000')
+        saved = self.kls.read_saved_data('sh600000')
+        for col in saved.dtype.names:
+            np.testing.assert_array_equal(klines[col], saved[col])
+        self.assertEqual(self.archive.read_kline_array('sh600000', 1)['time'].tolist(), ['2025-01-06'])
+
+        self.assertEqual(self.archive.compact(), 2)
+        self.assertEqual(len(self.archive.index), 2)
+        self.assertIsInstance(self.archive.read('sh600000')['time'], np.memmap)
+        np.testing.assert_array_equal(self.archive.read_kline_array('sh600000'), klines)
+        self.assertEqual(self.archive.last_times(), {'sh600000': 20250106000000, 'sz000001': 20250102000000})
+
+    def test_build_appends_per_chunk(self):
+        codes = ['sh600000', 'sh600001', 'sh600002', 'sz000001']
+        for c in codes:
+            self.kls.save_dataset(c, make_kline_array(['2025-01-02', '2025-01-03']))
+        self.archive.build_chunk_size = 2
+        append = self.archive.append
+        batches = []
+
+        def record(datasets):
+            batches.append(sorted(datasets))
+            return append(datasets)
+        with patch.object(self.archive, 'append', side_effect=record):
+            self.assertEqual(self.archive.build_from_h5(), 8)
+        self.assertEqual(sorted(batches), [['sh600000', 'sh600001'], ['sh600002'], ['sz000001']])
+        self.assertEqual(sorted(self.archive.codes()), codes)
+        for c in codes:
+            self.assertEqual(self.archive.read_kline_array(c)['time'].tolist(), ['2025-01-02', '2025-01-03'])
+
+    def test_uncommitted_rows_are_discarded(self):
+        data = self.kls.prepare_data(make_kline_array(['2025-01-02']))
+        self.archive.append({'sh600000': self.archive._complete(data)})
+        with open(self.archive.column_path('time'), 'ab') as f:
+            f.write(b'\0' * 64)
+        self.archive.append({'sz000001': self.archive._complete(data)})
+        self.assertEqual(self.archive.nrows, 2)
+        self.assertEqual(os.path.getsize(self.archive.column_path('time')), 16)
+        self.assertEqual(self.archive.read('sz000001')['time'].tolist(), [20250102000000])
+
+
+if __name__ == '__main__':
+    unittest.main()
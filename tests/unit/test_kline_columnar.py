@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Unit tests comparing columnar K-line reads with the dict path.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
+import numpy as np
+from base import BaseAsyncTestCase, HistoryDirMixin
+
+
+def bonus(date, total_bonus, cash_dividend):
+    return SimpleNamespace(ex_dividend_date=date, total_bonus=total_bonus, cash_dividend=cash_dividend)
+
+
+class TestColumnarKline(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that read_kline(columnar=True) matches the list-of-dict results."""
+
+    async def _setup_test_data(self):
+        from app.stock.adjust import AdjustFactors
+        from app.stock.storage.sqlite import KLineSQLiteStorage
+        self.setup_history_dir()
+        self.storage = KLineSQLiteStorage()
+        self.factors = AdjustFactors([bonus('2024-06-10', 0, 5), bonus('2024-01-10', 10, 2)])
+        self.patchers = [
+            patch('app.stock.history.kls', self.storage),
+            patch('app.stock.history.Khistory.adjust_factors', AsyncMock(return_value=self.factors)),
+        ]
+        for p in self.patchers:
+            p.start()
+        self.times = ['2024-01-09', '2024-01-10', '2024-06-07', '2024-06-10', '2024-06-11']
+        closes = [20.0, 9.0, 10.0, 9.5, 9.6]
+        self.klines = [{'time': t, 'open': c, 'close': c, 'high': c + 0.5, 'low': c - 0.5, 'volume': 100 * (i + 1),
+                        'amount': c * 100, 'change': 0.01, 'change_px': 0.1, 'amplitude': 0.02, 'turnover': 0.5}
+                       for i, (t, c) in enumerate(zip(self.times, closes))]
+        await self.storage.save_kline_data('sh600000', self.klines, 101)
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(self.storage)
+        for p in reversed(self.patchers):
+            p.stop()
+        self.cleanup_history_dir()
+
+    async def test_dtype(self):
+        from app.stock.history import Khistory
+        kd = await Khistory.read_kline('sh600000', 'd', columnar=True)
+        self.assertIsInstance(kd, np.ndarray)
+        self.assertEqual(kd.dtype, self.storage.numpy_dtype)
+        self.assertEqual(kd.dtype['time'].kind, 'U')
+        self.assertEqual(kd.dtype['volume'].kind, 'i')
+        self.assertEqual(kd.dtype['close'], np.float64)
+        self.assertEqual(kd['time'].tolist(), self.times)
+        self.assertEqual(kd['volume'].tolist(), [100, 200, 300, 400, 500])
+
+    async def test_matches_dict_path(self):
+        from app.stock.history import Khistory
+        for fqt in (0, 1, 2):
+            for length, start in [(None, None), (2, None), (10, None), (2, '2024-06-07'), (None, '2024-06-08')]:
+                kd = await Khistory.read_kline('sh600000', 'd', fqt, length, start, columnar=True)
+                dicts = await Khistory.read_kline('sh600000', 'd', fqt, length, start)
+                self.assertEqual(self.storage.array_to_dicts(kd), dicts, (fqt, length, start))
+
+                # 按行读取后对dict列表复权的结果
+                if start is not None:
+                    rows = await self.storage.read_kline_data_by_date_range('sh600000', 101, start)
+                else:
+                    rows = await self.storage.read_kline_data('sh600000', 101, length or 0)
+                rows = self.factors.apply(rows, fqt)
+                self.assertEqual(len(kd), len(rows))
+                for col in ('time', 'open', 'close', 'high', 'low', 'volume'):
+                    self.assertEqual(kd[col].tolist(), [r[col] for r in rows], (fqt, length, start, col))
+
+    async def test_slicing_and_adjustment(self):
+        from app.stock.history import Khistory
+        kd = await Khistory.read_kline('sh600000', 'd', length=2, columnar=True)
+        self.assertEqual(kd['time'].tolist(), self.times[-2:])
+        # 指定start时忽略length
+        kd = await Khistory.read_kline('sh600000', 'd', length=1, start='2024-01-10', columnar=True)
+        self.assertEqual(kd['time'].tolist(), self.times[1:])
+
+        pre = await Khistory.read_kline('sh600000', 'd', 1, columnar=True)
+        self.assertEqual(pre['close'].tolist(), [9.4, 8.5, 9.5, 9.5, 9.6])
+        post = await Khistory.read_kline('sh600000', 'd', 2, columnar=True)
+        self.assertEqual(post['close'].tolist()[:4], [20.0, 18.2, 20.2, 19.7])
+        self.assertEqual(post['volume'].tolist(), [100, 200, 300, 400, 500])
+        # 复权不修改未复权的读取结果
+        raw = await Khistory.read_kline('sh600000', 'd', columnar=True)
+        self.assertEqual(raw['close'].tolist(), [20.0, 9.0, 10.0, 9.5, 9.6])
+
+        self.assertIsNone(await Khistory.read_kline('sz000001', 'd', columnar=True))
+        self.assertIsNone(await Khistory.read_kline('sz000001', 'd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
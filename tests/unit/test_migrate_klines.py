@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Unit tests for migrating per-code K-line tables to the partitioned store.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import asyncio
+import unittest
+from base import BaseAsyncTestCase, HistoryDirMixin
+from mocks import make_klines
+
+
+class TestMigrateKlines(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that migrated K-lines and watermarks match the legacy tables."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import KLineSQLiteStorage
+        self.setup_history_dir()
+        self.src = KLineSQLiteStorage()
+        self.dst = None
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(self.src, self.dst)
+        self.cleanup_history_dir()
+
+    async def _migrate(self, kline_types):
+        from app.stock.storage.sqlite import SQLiteWriter, KLinePartitionedStorage
+        from tools.migrate_klines import migrate
+        await self.dispose_storages(self.dst)
+        # migrate()内部用asyncio.run重建水位表，在单独的线程中执行
+        total = await asyncio.to_thread(migrate, kline_types, 2)
+        # 丢弃迁移线程中创建的写入队列，之后由本测试的存储实例重新创建
+        writer = SQLiteWriter.writers.pop(os.path.join(self.tmpdir, 'klines_part.db'), None)
+        if writer is not None:
+            writer.storage.sync_engine.dispose()
+        self.dst = KLinePartitionedStorage()
+        return total
+
+    async def test_migrate_and_read_back(self):
+        await self.src.save_kline_data('sh600000', make_klines(['2025-01-02', '2025-01-03', '2025-01-06'], step=1.0), 101)
+        await self.src.save_kline_data('sz000001', make_klines(['2025-01-02', '2025-01-03'], 20.0, step=1.0), 101)
+        await self.src.save_kline_data('sh600000', make_klines(['2025-01-03'], 11.0, step=1.0), 102)
+        await self.src.save_kline_data('sz000001', make_klines(['2025-01-03 09:31', '2025-01-03 09:32'], step=1.0), 1)
+
+        self.assertEqual(await self._migrate([101, 102]), 6)
+        for code, kltype in [('sh600000', 101), ('sz000001', 101), ('sh600000', 102)]:
+            expected = await self.src.read_kline_array(code, kltype)
+            migrated = await self.dst.read_kline_array(code, kltype)
+            self.assertEqual(migrated.tolist(), expected.tolist())
+            self.assertEqual(migrated.dtype, expected.dtype)
+        self.assertEqual((await self.dst.read_kline_array('sh600000', 101, length=2))['time'].tolist(),
+                         ['2025-01-03', '2025-01-06'])
+        self.assertEqual((await self.dst.read_kline_array('sh600000', 101, start='2025-01-03'))['close'].tolist(),
+                         [11.0, 12.0])
+        self.assertIsNone(await self.dst.read_kline_array('sz000001', 1))
+
+        # 迁移后由分区表重建的水位
+        self.assertEqual(await self.dst.latest_times(kline_type=101),
+                         {'sh600000': '2025-01-06', 'sz000001': '2025-01-03'})
+        self.assertEqual(await self.dst.latest_times(kline_type=102), {'sh600000': '2025-01-03'})
+        self.assertEqual(await self.dst.latest_times(kline_type=1), {})
+
+        # 再次迁移覆盖已迁移的数据，不产生重复记录
+        self.assertEqual(await self._migrate(None), 8)
+        self.assertEqual(len(await self.dst.read_kline_array('sh600000', 101)), 3)
+        self.assertEqual(await self.dst.latest_times(kline_type=1), {'sz000001': '2025-01-03 09:32'})
+        await self.dst.save_kline_data('sz000001', make_klines(['2025-01-06'], 21.0, step=1.0), 101)
+        self.assertEqual(await self.dst.latest_times(['sz000001']), {'sz000001': '2025-01-06'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the pooled network client.
+"""
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import time
+import json
+import asyncio
+import threading
+import unittest
+import http.server
+import socketserver
+from base import BaseAsyncTestCase
+from app.hu.network import Network, EmDataCenterRequest, FetchPipeline, RateLimiter
+
+
+class SlowHandler(http.server.BaseHTTPRequestHandler):
+    failures = 0
+
+    def do_GET(self):
+        if self.path == '/flaky' and SlowHandler.failures > 0:
+            SlowHandler.failures -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        time.sleep(0.2)
+        self.send_response(200)
+        self.end_headers()
+        if self.path.startswith('/dc?page='):
+            page = int(self.path.split('=')[1])
+            body = {'success': True, 'result': {'pages': 5, 'data': [{'page': page}]}}
+            self.wfile.write(json.dumps(body).encode())
+            return
+        self.wfile.write(self.path.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+class PagedRequest(EmDataCenterRequest):
+    def __init__(self, base):
+        super().__init__()
+        self.base = base
+        self.saved = []
+
+    def getUrl(self):
+        return f'{self.base}/dc?page={self.page}'
+
+    async def saveFecthed(self):
+        self.saved.append([d['page'] for d in self.fecthed])
+
+
+class TestNetwork(BaseAsyncTestCase):
+    """Test async fetching through the shared connection pool."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SlowHandler)
+        cls.base = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    async def test_concurrent_fetch_does_not_block_loop(self):
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        tk = asyncio.create_task(ticker())
+        start = time.time()
+        texts = await asyncio.gather(*[Network.fetch_url_async(f'{self.base}/p{i}') for i in range(6)])
+        elapsed = time.time() - start
+        tk.cancel()
+        self.assertEqual(texts, [f'/p{i}' for i in range(6)])
+        self.assertLess(elapsed, 1.0)
+        self.assertGreater(ticks, 5)
+
+    async def test_async_retry(self):
+        SlowHandler.failures = 1
+        self.assertEqual(await Network.fetch_url_async(f'{self.base}/flaky'), '/flaky')
+
+    async def test_datacenter_pages_fetched_concurrently(self):
+        req = PagedRequest(self.base)
+        start = time.time()
+        await req.getNext()
+        elapsed = time.time() - start
+        self.assertEqual(req.saved[0], [1])
+        self.assertEqual(sorted(p for pg in req.saved for p in pg), [1, 2, 3, 4, 5])
+        self.assertEqual(req.fecthed, [])
+        # 第一页之后的4页并发请求
+        self.assertLess(elapsed, 0.8)
+
+    def test_sync_fetch(self):
+        self.assertEqual(Network.fetch_url(f'{self.base}/sync', params={'a': 1}), '/sync?a=1')
+
+
+class TestFetchPipeline(BaseAsyncTestCase):
+    """Test threaded fetching with a separate writer stage."""
+
+    async def test_fetch_overlaps_save(self):
+        def fetch(i):
+            time.sleep(0.1)
+            return [i]
+
+        saved = []
+        async def save(result):
+            await asyncio.sleep(0.1)
+            saved.extend(result)
+
+        pipeline = FetchPipeline(concurrency=4)
+        start = time.time()
+        stats = await pipeline.run([('src', fetch, (i,)) for i in range(8)], save)
+        elapsed = time.time() - start
+        self.assertEqual(sorted(saved), list(range(8)))
+        self.assertEqual(stats['failed'], [])
+        # 串行需要1.6s，下载并发且与写入重叠
+        self.assertLess(elapsed, 1.2)
+        self.assertGreater(stats['fetch_seconds'], elapsed)
+
+    async def test_failures_and_rate_limit(self):
+        def fetch(i):
+            if i == 2:
+                raise RuntimeError('upstream down')
+            return [i]
+
+        async def save(result):
+            if result == [3]:
+                raise RuntimeError('disk full')
+
+        pipeline = FetchPipeline(concurrency=4, rates={'slow': 20})
+        start = time.time()
+        stats = await pipeline.run([('slow', fetch, (i,)) for i in range(5)] + [('fast', fetch, (9,))], save)
+        self.assertGreaterEqual(time.time() - start, 0.19)
+        self.assertEqual(sorted(job[2][0] for job, e in stats['failed']), [2, 3])
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(50)
+        start = time.time()
+        threads = [threading.Thread(target=limiter.wait) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertGreaterEqual(time.time() - start, 0.099)
+
+
+if __name__ == '__main__':
+    unittest.main()
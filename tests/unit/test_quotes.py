@@ -87,5 +87,187 @@ class TestQuotes(BaseTestCase):
         self.assertEqual(result, '10:05')
 
 
+class TestBatchSingleFlight(BaseTestCase):
+    """Test coalescing of concurrent upstream requests."""
+
+    def _run_concurrently(self, flight, requests):
+        import threading
+        results = [None] * len(requests)
+        def _get(i, codes):
+            results[i] = flight.get(codes)
+        threads = [threading.Thread(target=_get, args=(i, r)) for i, r in enumerate(requests)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_concurrent_misses_share_one_call(self):
+        import time
+        from app.stock.quotes import BatchSingleFlight
+        calls = []
+        def fetch(codes):
+            calls.append(sorted(codes))
+            time.sleep(0.05)
+            return {c: c.upper() for c in codes if c != 'none'}
+        flight = BatchSingleFlight(fetch, window=0.05)
+        results = self._run_concurrently(flight, [['a', 'b'], ['b', 'c'], ['c', 'none'], ['a']])
+        self.assertEqual(calls, [['a', 'b', 'c', 'none']])
+        self.assertEqual(results, [{'a': 'A', 'b': 'B'}, {'b': 'B', 'c': 'C'}, {'c': 'C'}, {'a': 'A'}])
+        self.assertEqual(flight.inflight, {})
+
+    def test_errors_reach_all_waiters(self):
+        from app.stock.quotes import BatchSingleFlight
+        def fetch(codes):
+            raise RuntimeError('upstream down')
+        flight = BatchSingleFlight(fetch, window=0)
+        with self.assertRaises(RuntimeError):
+            flight.get(['a'])
+        self.assertEqual(flight.inflight, {})
+
+
+class TestIntradayBarBuilder(BaseTestCase):
+    """Test incremental bar building from cached ticks."""
+
+    def _ticks(self, n, date='2025-12-19'):
+        import random
+        rnd = random.Random(7)
+        ticks = [[f'{date} 09:25:00', 10.0, 500, 8]]
+        sec = 9 * 3600 + 30 * 60
+        price = 10.0
+        for i in range(n):
+            sec += rnd.choice([0, 1, 3, 20])
+            if 11 * 3600 + 30 * 60 < sec < 13 * 3600:
+                sec = 13 * 3600
+            price = round(price + rnd.choice([-0.01, 0, 0.01]), 2)
+            t = f'{date} {sec // 3600:02d}:{sec % 3600 // 60:02d}:{sec % 60:02d}'
+            ticks.append([t, price, rnd.randint(1, 50), rnd.choice([1, 2])])
+        return ticks
+
+    def test_simple_bars(self):
+        from app.stock.quotes import Quotes
+        ticks = [['09:25:00', 9.9, 100, 8], ['09:30:01', 10.0, 10, 1], ['09:30:30', 10.2, 5, 2],
+                 ['09:31:02', 10.1, 1, 1]]
+        self.assertEqual(Quotes._transactions_to_klines(ticks, 1), [
+            ['09:31', 10.0, 10.2, 10.2, 10.0, 15, 10.0 * 10 + 10.2 * 5],
+            ['09:32', 10.1, 10.1, 10.1, 10.1, 1, 10.1]])
+        tlines = Quotes._transactions_to_tlines(ticks)
+        self.assertEqual([r[:3] for r in tlines], [['09:31', 10.2, 15], ['09:32', 10.1, 1]])
+        self.assertAlmostEqual(tlines[0][4], (10.0 * 10 + 10.2 * 5) / 15)
+
+    def test_incremental_matches_rebuild(self):
+        from app.stock.quotes import Quotes, IntradayBarBuilder, IntradayTlineBuilder
+        ticks = self._ticks(3000)
+        builders = {kt: IntradayBarBuilder(kt) for kt in (1, 5, 15)}
+        tbuilder = IntradayTlineBuilder()
+        for n in range(1, len(ticks) + 1, 97):
+            cached = ticks[:n]
+            for kt, b in builders.items():
+                self.assertEqual(b.update(cached), Quotes._transactions_to_klines(cached, kt))
+            self.assertEqual(tbuilder.update(cached), Quotes._transactions_to_tlines(cached))
+        self.assertEqual(builders[1].update(ticks), Quotes._transactions_to_klines(ticks, 1))
+
+    def test_replaced_tail_and_new_day(self):
+        from app.stock.quotes import Quotes, IntradayBarBuilder
+        ticks = self._ticks(500)
+        builder = IntradayBarBuilder(1)
+        builder.update(ticks)
+        # 缓存合并时最后一秒的成交会被重新拉取的数据替换
+        last = ticks[-1][0]
+        merged = [t for t in ticks if t[0] != last] + [[last, 99.0, 7, 1], [last, 98.0, 3, 2]]
+        self.assertEqual(builder.update(merged), Quotes._transactions_to_klines(merged, 1))
+        nextday = self._ticks(100, '2025-12-22')
+        self.assertEqual(builder.update(nextday), Quotes._transactions_to_klines(nextday, 1))
+        self.assertEqual(builder.update([]), [])
+
+
+class TestTickBuffer(BaseTestCase):
+    """Test the array-backed per-code tick cache."""
+
+    def _list_merge(self, olddata, v):
+        """原列表缓存的合并方式"""
+        if not olddata:
+            return v
+        last = olddata[-1][0]
+        return [t for t in olddata if t[0] < last] + [t for t in v if t[0] >= last]
+
+    def test_merge_matches_list_cache(self):
+        from app.stock.quotes import TickBuffer
+        ticks = TestIntradayBarBuilder()._ticks(2000)
+        ticks = [[t, p, v, round(p * v, 2), bs] for t, p, v, bs in ticks]
+        buf = TickBuffer()
+        expected = []
+        pos = 0
+        while pos < len(ticks):
+            # 上游从最后一笔的时间开始返回，包含已缓存的最后一秒
+            last = expected[-1][0] if expected else ''
+            new = [t for t in ticks[:pos + 150] if t[0] >= last]
+            pos += 150
+            date = new[0][0].split(' ')[0]
+            buf.merge(date, new)
+            expected = self._list_merge(expected, new)
+            self.assertEqual(len(buf), len(expected))
+        self.assertEqual([buf[i] for i in range(len(buf))], [[t, p, v, bs] for t, p, v, a, bs in expected])
+        self.assertEqual(buf.last_time(), expected[-1][0].split(' ')[1])
+        self.assertLess(len(buf.secs), 2 * len(buf) + 1)
+
+    def test_new_day_and_snapshot(self):
+        from app.stock.quotes import TickBuffer
+        buf = TickBuffer()
+        buf.merge('2025-12-19', [['2025-12-19 09:30:00', 10.01, 5, 1], ['2025-12-19 09:30:03', 10.02, 6, 2]])
+        snap = buf.snapshot()
+        buf.merge('2025-12-22', [['2025-12-22 09:30:00', 11.0, 1, 1]])
+        self.assertEqual(len(snap), 2)
+        self.assertEqual(snap[0], ['2025-12-19 09:30:00', 10.01, 5, 1])
+        self.assertEqual(snap[-1], ['2025-12-19 09:30:03', 10.02, 6, 2])
+        self.assertEqual(len(buf), 1)
+        self.assertEqual(buf[0], ['2025-12-22 09:30:00', 11.0, 1, 1])
+
+    def test_snapshot_unchanged_by_replaced_tail(self):
+        from app.stock.quotes import TickBuffer
+        buf = TickBuffer()
+        buf.merge('2025-12-19', [['2025-12-19 09:30:00', 10.01, 5, 1], ['2025-12-19 09:30:03', 10.02, 6, 2]])
+        snap = buf.snapshot()
+        before = [snap[i] for i in range(len(snap))]
+        # 最后一秒的成交被替换，已发出的快照不变
+        buf.merge('2025-12-19', [['2025-12-19 09:30:03', 10.05, 7, 1], ['2025-12-19 09:30:03', 10.06, 8, 2],
+                                 ['2025-12-19 09:30:06', 10.07, 9, 1]])
+        self.assertEqual([snap[i] for i in range(len(snap))], before)
+        self.assertEqual(buf[1], ['2025-12-19 09:30:03', 10.05, 7, 1])
+        self.assertEqual(len(buf), 4)
+
+        # 没有发出快照时原地追加，不复制数组
+        secs = buf.secs
+        buf.merge('2025-12-19', [['2025-12-19 09:30:06', 10.07, 9, 1], ['2025-12-19 09:30:09', 10.08, 1, 2]])
+        self.assertIs(buf.secs, secs)
+        snap = buf.snapshot()
+        buf.merge('2025-12-19', [['2025-12-19 09:30:09', 10.09, 2, 1]])
+        self.assertIsNot(buf.secs, secs)
+        self.assertEqual(snap[-1], ['2025-12-19 09:30:09', 10.08, 1, 2])
+        self.assertEqual(buf[-1], ['2025-12-19 09:30:09', 10.09, 2, 1])
+
+    def test_store_memory_budget(self):
+        from app.stock.quotes import TickStore
+        store = TickStore(max_bytes=3 * 256 * 17)
+        for code in ('a', 'b', 'c', 'd'):
+            store.merge(code, '2025-12-19', [['2025-12-19 09:30:00', 10.0, 1, 1]])
+        store.get('b')
+        store.merge('e', '2025-12-19', [['2025-12-19 09:30:00', 10.0, 1, 1]])
+        self.assertEqual(list(store.buffers.keys()), ['d', 'b', 'e'])
+        self.assertLessEqual(store.nbytes, store.max_bytes)
+        self.assertIsNone(store.get('a'))
+        self.assertEqual(store.last_time('e'), '09:30:00')
+
+    def test_bars_from_buffer(self):
+        from app.stock.quotes import Quotes, TickBuffer, IntradayBarBuilder
+        ticks = TestIntradayBarBuilder()._ticks(1000)
+        buf = TickBuffer()
+        builder = IntradayBarBuilder(5)
+        for pos in range(0, len(ticks), 200):
+            last = buf.last_time()
+            buf.merge('2025-12-19', [t for t in ticks[:pos + 200] if t[0].split(' ')[1] >= last])
+            self.assertEqual(builder.update(buf.snapshot()), Quotes._transactions_to_klines(ticks[:pos + 200], 5))
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
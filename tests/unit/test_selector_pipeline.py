@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the two-stage selector pipeline.
+"""
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+import numpy as np
+from base import BaseAsyncTestCase
+
+
+KD_DTYPE = np.dtype([('time', 'U20'), ('open', 'f8'), ('close', 'f8'), ('high', 'f8'), ('low', 'f8'), ('volume', 'i8')])
+
+
+def make_kd(code):
+    n = int(code[-1])
+    return np.array([(f'2025-01-0{i + 1}', 1.0, 1.0 + i, 2.0, 0.5, 100) for i in range(n)], dtype=KD_DTYPE)
+
+
+def close_sum(item, kd):
+    from app.selectors.stock_base_selector import to_krows
+    if item == 'sz000003':
+        raise ValueError('bad data')
+    return sum(k.close for k in to_krows(kd))
+
+
+def make_selector_class():
+    from app.selectors.stock_base_selector import StockBaseSelector
+
+    class CloseSumSelector(StockBaseSelector):
+        cpu_batch_size = 2
+
+        def kline_request(self, item):
+            return None if item == 'sz000000' else (item, '2025-01-01', 0)
+
+        async def get_kd_array(self, code, start, fqt=0):
+            return make_kd(code)
+
+        task_compute = staticmethod(close_sum)
+
+        async def task_merge(self, item, result):
+            self.wkselected.append((item, result))
+
+    return CloseSumSelector
+
+
+class TestSelectorPipeline(BaseAsyncTestCase):
+    """Test I/O stage + CPU stage + merge."""
+
+    async def _setup_test_data(self):
+        self.items = ['sz000001', 'sz000000', 'sz000002', 'sz000003', 'sz000004']
+        self.expected = [('sz000001', 1.0), ('sz000002', 3.0), ('sz000004', 10.0)]
+
+    async def _run(self, workers):
+        sel = make_selector_class()()
+        sel.cpu_workers = workers
+        sel.wkstocks = list(self.items)
+        await sel.run_pipeline()
+        return sel.wkselected
+
+    async def test_inline(self):
+        self.assertEqual(await self._run(1), self.expected)
+
+    async def test_process_pool(self):
+        self.assertEqual(await self._run(2), self.expected)
+
+    async def test_process_pool_shared_in_scope(self):
+        from app.selectors.stock_base_selector import StockBaseSelector
+        with StockBaseSelector.kline_cache_scope():
+            self.assertEqual(await self._run(2), self.expected)
+            pool = StockBaseSelector.process_pool
+            self.assertIsNotNone(pool)
+            self.assertNotEqual(pool._mp_context.get_start_method(), 'fork')
+            self.assertEqual(await self._run(2), self.expected)
+            self.assertIs(StockBaseSelector.process_pool, pool)
+        self.assertIsNone(StockBaseSelector.process_pool)
+
+    async def test_task_processing_single_item(self):
+        sel = make_selector_class()()
+        await sel.task_processing('sz000002')
+        self.assertEqual(sel.wkselected, [('sz000002', 3.0)])
+
+    def test_to_krows_fills_missing_fields(self):
+        from app.selectors.stock_base_selector import to_krows
+        rows = to_krows(make_kd('sz000002'))
+        self.assertEqual(rows[1].close, 2.0)
+        self.assertEqual(rows[1].turnover, 0)
+
+
+class TestZtDailyCheckpoint(BaseAsyncTestCase):
+    """Test limit-up streak state carried across runs."""
+
+    async def _setup_test_data(self):
+        closes = [10.0, 11.0, 12.1, 12.0, 13.2, 13.0, 12.9, 12.8, 12.7, 13.97]
+        rows = []
+        for i, c in enumerate(closes):
+            lc = closes[i - 1] if i > 0 else c
+            rows.append((f'2025-03-{i + 10:02d}', c, c, c, c, 100, c - lc, (c - lc) / lc))
+        dtype = np.dtype([('time', 'U20'), ('open', 'f8'), ('close', 'f8'), ('high', 'f8'), ('low', 'f8'),
+                          ('volume', 'i8'), ('change_px', 'f8'), ('change', 'f8')])
+        self.kd = np.array(rows, dtype=dtype)
+
+    def _compute(self, kd, ckpt=None):
+        from app.selectors.stock_ztlead_selector import StockZtDaily
+        return StockZtDaily.task_compute(('sh600001', '', ''), kd, 10, ckpt)
+
+    def test_streak(self):
+        selected, (ptime, state) = self._compute(self.kd)
+        self.assertEqual([(s[1], s[4], s[5]) for s in selected],
+                         [('2025-03-11', 1, 1), ('2025-03-12', 2, 2), ('2025-03-14', 3, 4), ('2025-03-19', 1, 1)])
+        self.assertEqual(ptime, '2025-03-19')
+        self.assertEqual(state['lbc'], 1)
+
+    def test_resume_from_checkpoint(self):
+        full, fckpt = self._compute(self.kd)
+        first, ckpt = self._compute(self.kd[:5])
+        # 只传入进度之后的K线(含进度当日)
+        second, sckpt = self._compute(self.kd[4:], ckpt)
+        self.assertEqual(first + second, full)
+        self.assertEqual(sckpt, fckpt)
+
+
+    async def test_prepare_ignores_checkpoint_after_start(self):
+        from types import SimpleNamespace
+        from unittest.mock import patch, AsyncMock
+        from app.selectors.stock_ztlead_selector import StockZtDaily
+        sel = StockZtDaily()
+        ckpts = {'sh600001': ('2025-03-12', {'lbc': 1}), 'sh600002': ('2025-03-14', {'lbc': 2})}
+
+        async def load_checkpoints():
+            sel.checkpoints = dict(ckpts)
+            return sel.checkpoints
+        nodata = SimpleNamespace(getNext=lambda date: [])
+        with patch('app.selectors.stock_ztlead_selector.query_values',
+                   AsyncMock(return_value=[('sh600001',), ('sh600002',), ('sh600003',)])), \
+             patch('app.selectors.stock_ztlead_selector.query_group_max',
+                   AsyncMock(return_value={'sh600002': '2025-03-10'})), \
+             patch('app.selectors.stock_ztlead_selector.TradingDate.next_trading_date', return_value='2025-03-13'), \
+             patch('app.selectors.stock_ztlead_selector.TradingDate.max_trading_date', return_value='2025-03-13'), \
+             patch('app.selectors.stock_ztlead_selector.TradingDate.prev_trading_date', return_value='2025-03-07'), \
+             patch.object(StockZtDaily, 'ztinfo', nodata), patch.object(StockZtDaily, 'jqkinfo', nodata), \
+             patch.object(sel, 'load_checkpoints', load_checkpoints):
+            await sel.task_prepare('2025-03-12')
+        # 进度晚于开始日期时从最近的首板之前重算，不使用该进度
+        self.assertEqual(sel.wkstocks, [['sh600001', '2025-03-13', '2025-03-12'],
+                                        ['sh600002', '2025-03-13', '2025-03-07'],
+                                        ['sh600003', '2025-03-13', '']])
+        self.assertEqual(list(sel.checkpoints), ['sh600001'])
+
+
+class TestKlineCache(BaseAsyncTestCase):
+    """Test the run-scoped K-line cache."""
+
+    def test_slice_and_lru(self):
+        from app.selectors.stock_base_selector import KlineCache
+        kd = make_kd('sz000005')
+        cache = KlineCache(max_bytes=kd.nbytes * 2)
+        cache.put('sz000005', '2025-01-01', 0, kd)
+        self.assertEqual(cache.get('sz000005', '2024-12-01', 0), (False, None))
+        hit, part = cache.get('sz000005', '2025-01-03', 0)
+        self.assertTrue(hit)
+        self.assertEqual(part['time'].tolist(), ['2025-01-03', '2025-01-04', '2025-01-05'])
+        self.assertFalse(part.flags.writeable)
+        self.assertEqual(cache.get('sz000005', '2025-01-06', 0), (True, None))
+
+        cache.put('sz000001', '2025-01-01', 0, None)
+        cache.put('sz000006', '2025-01-01', 0, make_kd('sz000006'))
+        self.assertFalse(cache.get('sz000005', '2025-01-01', 0)[0])
+        self.assertEqual(cache.get('sz000001', '2025-01-01', 0), (True, None))
+        self.assertEqual(cache.evictions, 1)
+
+    async def test_shared_across_selectors(self):
+        from unittest.mock import patch, AsyncMock
+        from app.selectors.stock_base_selector import StockBaseSelector
+        read = AsyncMock(side_effect=lambda code, kltype, start, fqt, columnar: make_kd(code))
+        with patch('app.selectors.stock_base_selector.Khistory.read_kline', read), \
+             patch('app.selectors.stock_base_selector.TradingDate.is_trading_date', return_value=True):
+            with StockBaseSelector.kline_cache_scope() as cache:
+                kd1 = await StockBaseSelector().get_kd_array('sz000004', '2025-01-01')
+                kd2 = await StockBaseSelector().get_kd_array('sz000004', '2025-01-02')
+                self.assertEqual(len(kd1), 4)
+                self.assertEqual(len(kd2), 3)
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertIsNone(StockBaseSelector.kline_cache)
+            await StockBaseSelector().get_kd_array('sz000004', '2025-01-02')
+        self.assertEqual(read.await_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the single-writer SQLite batching queue.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import asyncio
+import unittest
+from unittest.mock import patch
+from base import BaseAsyncTestCase, HistoryDirMixin
+from mocks import make_klines
+
+
+class TestSQLiteWriter(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that concurrent saves are grouped into few transactions."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import KLineSQLiteStorage, SQLiteWriter
+        self.setup_history_dir()
+        self.storage = KLineSQLiteStorage()
+        self.commits = []
+        commit = SQLiteWriter._commit
+
+        async def counted(writer, batch):
+            self.commits.append(len(batch))
+            await commit(writer, batch)
+        self.commit_patcher = patch.object(SQLiteWriter, '_commit', counted)
+        self.commit_patcher.start()
+
+    async def _cleanup_test_data(self):
+        self.commit_patcher.stop()
+        await self.dispose_storages(self.storage)
+        self.cleanup_history_dir()
+
+    def _codes(self, n):
+        return [f'sz{i:06d}' for i in range(n)]
+
+    async def test_concurrent_saves_grouped(self):
+        codes = self._codes(40)
+        await self.storage.ensure_watermarks()
+        self.commits.clear()
+        counts = await asyncio.gather(*[self.storage.save_kline_data(c, make_klines(['2025-01-02', '2025-01-03']))
+                                        for c in codes])
+        self.assertEqual(counts, [2] * len(codes))
+        self.assertEqual(sum(self.commits), len(codes))
+        self.assertLess(len(self.commits), len(codes) // 2)
+        self.assertEqual(await self.storage.latest_times(codes), {c: '2025-01-03' for c in codes})
+
+    async def test_no_wait_and_flush(self):
+        codes = self._codes(30)
+        for c in codes:
+            self.assertEqual(await self.storage.save_kline_data(c, make_klines(['2025-01-02']), wait=False), 1)
+        await self.storage.flush()
+        self.assertLess(len(self.commits), len(codes))
+        self.assertEqual(await self.storage.latest_times(codes), {c: '2025-01-02' for c in codes})
+        data = await self.storage.read_kline_array(codes[-1], 101)
+        self.assertEqual(data['time'].tolist(), ['2025-01-02'])
+
+    async def test_failure_isolated(self):
+        codes = self._codes(5)
+        for c in codes:
+            await self.storage.create_table(self.storage.get_table_name(c, 101))
+        saves = [self.storage.insert_data(c, 101, self.storage.prepare_rows(make_klines(['2025-01-02']))) for c in codes]
+        saves.insert(2, self.storage.insert_data(codes[0], 101, [{'time': '2025-01-02', 'bogus': 1}]))
+        results = await asyncio.gather(*saves, return_exceptions=True)
+        self.assertIsInstance(results[2], Exception)
+        self.assertEqual(results[:2] + results[3:], [1] * len(codes))
+        self.assertEqual(await self.storage.latest_times(codes), {c: '2025-01-02' for c in codes})
+
+    async def test_no_wait_failure_reported_by_flush(self):
+        codes = self._codes(4)
+        for c in codes:
+            await self.storage.create_table(self.storage.get_table_name(c, 101))
+        for c in codes:
+            await self.storage.insert_data(c, 101, self.storage.prepare_rows(make_klines(['2025-01-02'])), wait=False)
+        await self.storage.insert_data(codes[1], 101, [{'time': '2025-01-03', 'bogus': 1}], wait=False)
+        failed = await self.storage.flush()
+        self.assertEqual([c for c, _ in failed], [codes[1]])
+        self.assertIsInstance(failed[0][1], Exception)
+        self.assertEqual(await self.storage.latest_times(codes), {c: '2025-01-02' for c in codes})
+        # 已返回的失败不再重复返回
+        self.assertEqual(await self.storage.flush(), [])
+
+
+class TestSQLitePragmas(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that the connection profile is applied to storage engines."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import KLineSQLiteStorage
+        self.setup_history_dir()
+        self.storage = KLineSQLiteStorage()
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(self.storage)
+        self.cleanup_history_dir()
+
+    async def _pragma(self, name):
+        from sqlalchemy import text
+        async with self.storage.get_session() as session:
+            return (await session.execute(text(f'PRAGMA {name}'))).scalar()
+
+    async def test_default_profile(self):
+        self.assertEqual(await self._pragma('journal_mode'), 'wal')
+        self.assertEqual(await self._pragma('synchronous'), 1)
+        self.assertEqual(await self._pragma('temp_store'), 2)
+        self.assertEqual(await self._pragma('busy_timeout'), 20000)
+        with self.storage.sync_engine.connect() as conn:
+            self.assertEqual(conn.exec_driver_sql('PRAGMA synchronous').scalar(), 1)
+
+    async def test_client_config_override(self):
+        from app.lofig import Config
+        with patch.object(Config, 'client_config', return_value={'sqlite_pragmas': {'synchronous': 'FULL',
+                                                                                     'mmap_size': None}}):
+            self.assertEqual(await self._pragma('synchronous'), 2)
+            self.assertEqual(await self._pragma('mmap_size'), 0)
+            self.assertEqual(await self._pragma('cache_size'), -65536)
+
+
+if __name__ == '__main__':
+    unittest.main()
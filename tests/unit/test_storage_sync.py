@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Unit tests for batched SQLite to HDF5 synchronization.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from unittest.mock import patch
+from base import BaseAsyncTestCase, HistoryDirMixin
+from mocks import make_klines
+
+
+class TestSyncToH5Batch(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that the batched sync writes the same rows as the per-code sync."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.storage_manager import DataSyncManager
+        self.setup_history_dir(h5_pool=True)
+        self.dsm = DataSyncManager()
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(self.dsm.sqlite_kline, self.dsm.sqlite_fflow, self.dsm.sqlite_trans)
+        self.cleanup_history_dir()
+
+    async def test_batch_sync_klines(self):
+        await self._check_batch_sync_klines()
+
+    async def test_batch_sync_partitioned_klines(self):
+        from app.stock.storage.sqlite import KLinePartitionedStorage
+        await self.dispose_storages(self.dsm.sqlite_kline)
+        self.dsm.sqlite_kline = KLinePartitionedStorage()
+        await self._check_batch_sync_klines()
+
+    async def _check_batch_sync_klines(self):
+        dsm = self.dsm
+        codes = ['sh600000', 'sh600001', 'sz000001']
+        for c in codes:
+            await dsm.sqlite_kline.save_kline_data(c, make_klines(['2025-01-02', '2025-01-03']), 101)
+        dsm.h5_kline.save_dataset('sh600001', make_klines(['2025-01-02']), 101)
+
+        items = await dsm.sqlite_kline.saved_codes()
+        results = await dsm.sync_to_h5_batch(dsm.sqlite_kline, dsm.h5_kline, items, lambda t: 100, 'klines_{}')
+        self.assertEqual(results, {'sh600000': {'klines_101': 2}, 'sh600001': {'klines_101': 1},
+                                   'sz000001': {'klines_101': 2}})
+        for c in codes:
+            self.assertEqual(dsm.h5_kline.read_saved_data(c)['time'].tolist(), ['2025-01-02', '2025-01-03'])
+        self.assertEqual(dsm.h5_kline.max_dates(codes + ['sz000002']),
+                         {c: '2025-01-03' for c in codes})
+
+        await dsm.sqlite_kline.save_kline_data('sz000001', make_klines(['2025-01-06'], 11.0), 101)
+        results = await dsm.sync_to_h5_batch(dsm.sqlite_kline, dsm.h5_kline, items, lambda t: 100, 'klines_{}')
+        self.assertEqual(results['sz000001'], {'klines_101': 1})
+        self.assertEqual(results['sh600000'], {'klines_101': 0})
+        data = dsm.h5_kline.read_saved_data('sz000001')
+        self.assertEqual(data['time'].tolist(), ['2025-01-02', '2025-01-03', '2025-01-06'])
+        self.assertEqual(data['close'].tolist(), [10.0, 10.0, 11.0])
+
+    async def test_batch_sync_groups_by_file(self):
+        dsm = self.dsm
+        dsm.sync_chunk_size = 2
+        codes = ['sh600000', 'sz000001', 'sh600001', 'sh600002']
+        for c in codes:
+            await dsm.sqlite_kline.save_kline_data(c, make_klines(['2025-01-02', '2025-01-03']), 101)
+
+        saved = []
+        save_datasets = dsm.h5_kline.save_datasets
+
+        def record(datasets, kline_type=101):
+            saved.append(sorted(datasets))
+            return save_datasets(datasets, kline_type)
+        items = await dsm.sqlite_kline.saved_codes()
+        with patch.object(dsm.h5_kline, 'save_datasets', side_effect=record):
+            results = await dsm.sync_to_h5_batch(dsm.sqlite_kline, dsm.h5_kline, items, lambda t: 100, 'klines_{}')
+        # 每次写入只包含同一文件的最多sync_chunk_size只股票
+        self.assertEqual(sorted(saved), [['sh600000', 'sh600001'], ['sh600002'], ['sz000001']])
+        self.assertEqual(results, {c: {'klines_101': 2} for c in codes})
+        for c in codes:
+            self.assertEqual(dsm.h5_kline.read_saved_data(c)['time'].tolist(), ['2025-01-02', '2025-01-03'])
+
+    async def test_save_kline_data_many(self):
+        from app.stock.storage.sqlite import KLinePartitionedStorage
+        for storage in (self.dsm.sqlite_kline, KLinePartitionedStorage()):
+            datasets = {'sh600000': make_klines(['2025-01-02', '2025-01-03']), 'sz000001': make_klines(['2025-01-03'])}
+            self.assertEqual(await storage.save_kline_data_many(datasets, 101), 3)
+            await storage.save_kline_data_many({'sz000001': make_klines(['2025-01-03', '2025-01-06'], 11.0)}, 101)
+            self.assertEqual(await storage.latest_times(['sh600000', 'sz000001']),
+                             {'sh600000': '2025-01-03', 'sz000001': '2025-01-06'})
+            data = await storage.read_kline_array('sz000001', 101)
+            self.assertEqual(data['close'].tolist(), [11.0, 11.0])
+            if storage is not self.dsm.sqlite_kline:
+                await self.dispose_storages(storage)
+
+
+if __name__ == '__main__':
+    unittest.main()
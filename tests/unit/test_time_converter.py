@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Unit tests for vectorized time conversion in h5 storage.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+import numpy as np
+from base import BaseTestCase
+
+
+class TestTimeConverter(BaseTestCase):
+    """Test TimeConverter against the per-element datetime conversion."""
+
+    def setUp(self):
+        super().setUp()
+        from app.stock.storage.h5 import TimeConverter
+        self.TimeConverter = TimeConverter
+        self.strs = np.array(['2023-10-01', '2023-10-02 15:00', '2023-10-04 11:30:30', '1999-12-31 23:59:59'])
+        self.ints = np.array([20231001000000, 20231002150000, 20231004113030, 19991231235959])
+
+    def test_matches_datetime_conversion(self):
+        for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M'):
+            conv = self.TimeConverter(fmt)
+            np.testing.assert_array_equal(conv.time_to_int(self.strs), conv._time_to_int_slow(self.strs))
+            np.testing.assert_array_equal(conv.int_to_time(self.ints), conv._int_to_time_slow(self.ints))
+            np.testing.assert_array_equal(conv.int_to_date(self.ints), conv._int_to_time_slow(self.ints, True))
+
+    def test_str_int_roundtrip(self):
+        conv = self.TimeConverter()
+        np.testing.assert_array_equal(conv.time_to_int(self.strs), self.ints)
+        self.assertEqual(conv.int_to_time(self.ints)[2], '2023-10-04 11:30:30')
+        self.assertEqual(conv.int_to_time(20240102093000).tolist(), ['2024-01-02 09:30:00'])
+        self.assertEqual(conv.time_to_int('2024-01-02').tolist(), [20240102000000])
+        self.assertEqual(len(conv.int_to_time(np.array([], dtype=np.int64))), 0)
+        np.testing.assert_array_equal(conv.date_part(self.strs), ['2023-10-01', '2023-10-02', '2023-10-04', '1999-12-31'])
+
+    def test_datetime64(self):
+        conv = self.TimeConverter()
+        dts = conv.int_to_datetime64(self.ints)
+        np.testing.assert_array_equal(dts, self.strs.astype('datetime64[s]'))
+        np.testing.assert_array_equal(conv.datetime64_to_int(dts), self.ints)
+        np.testing.assert_array_equal(conv.time_to_int(dts), self.ints)
+
+    def test_invalid_string(self):
+        with self.assertRaises(ValueError):
+            self.TimeConverter().time_to_int(np.array(['2024-0a-02']))
+
+
+if __name__ == '__main__':
+    unittest.main()
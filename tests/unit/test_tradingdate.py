@@ -47,6 +47,19 @@ class TestTradingDateWithRealModule(BaseTestCase):
         self.assertEqual(TradingDate.next_trading_date('2025-12-12'), '2025-12-15')
         self.assertEqual(TradingDate.next_trading_date('2025-12-11'), '2025-12-12')
 
+    def test_multi_day_offsets(self):
+        self.assertEqual(TradingDate.prev_trading_date('2025-05-06', 3), '2025-04-28')
+        self.assertEqual(TradingDate.next_trading_date('2025-04-28', 2), '2025-04-30')
+        self.assertEqual(TradingDate.next_trading_date('2025-04-29', 2), '2025-05-06')
+        self.assertEqual(TradingDate.prev_trading_date('1990-12-20', 5), TradingDate.min_traded_date())
+
+    def test_holidays_change_rebuilds_calendar(self):
+        self.assertFalse(TradingDate.is_trading_date('2025-05-05'))
+        TradingDate.holidays = ['2025-12-15']
+        self.assertTrue(TradingDate.is_trading_date('2025-05-05'))
+        self.assertFalse(TradingDate.is_trading_date('2025-12-15'))
+        self.assertEqual(TradingDate.next_trading_date('2025-12-12'), '2025-12-16')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
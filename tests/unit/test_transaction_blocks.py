@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the per-day compressed transaction block storage.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import random
+import unittest
+from base import BaseAsyncTestCase, HistoryDirMixin
+
+
+class TestTransactionBlockStorage(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that the block storage reads back what the per-tick tables store."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import TransactionBlockStorage, TransactionSQLiteStorage
+        self.setup_history_dir()
+        self.blocks = TransactionBlockStorage()
+        self.tables = TransactionSQLiteStorage()
+
+    async def _cleanup_test_data(self):
+        await self.dispose_storages(self.blocks, self.tables)
+        self.cleanup_history_dir()
+
+    def _ticks(self, date, n=500, seed=3):
+        rnd = random.Random(seed)
+        rows = [{'time': f'{date} 09:25:00', 'price': 10.0, 'volume': 500, 'num': 20, 'bs': 8}]
+        sec = 9 * 3600 + 30 * 60
+        price = 10.0
+        for i in range(n):
+            sec += rnd.choice([0, 1, 3])
+            price = round(price + rnd.choice([-0.01, 0, 0.01]), 3)
+            rows.append({'time': f'{date} {sec // 3600:02d}:{sec % 3600 // 60:02d}:{sec % 60:02d}',
+                         'price': price, 'volume': rnd.randint(1, 5000), 'num': rnd.randint(1, 9),
+                         'bs': rnd.choice([0, 1, 2])})
+        return rows
+
+    async def _read_tables(self, *args, **kwargs):
+        rows = await self.tables.read_transaction('sh600000', *args, **kwargs)
+        return [{k: v for k, v in r.items() if k != 'id'} for r in rows]
+
+    async def test_same_reads_as_tables(self):
+        for i, date in enumerate(['2025-01-02', '2025-01-03', '2025-01-06']):
+            ticks = self._ticks(date, seed=i)
+            self.assertEqual(await self.blocks.save_transaction('sh600000', ticks), len(ticks))
+            await self.tables.save_transaction('sh600000', ticks)
+
+        self.assertEqual(await self.blocks.read_transaction('sh600000'), await self._read_tables())
+        for args in [('2025-01-03',), ('2025-01-03 09:35', '2025-01-06 09:31:00'), (None, '2025-01-02 09:40')]:
+            self.assertEqual(await self.blocks.read_transaction('sh600000', *args), await self._read_tables(*args))
+            self.assertEqual(await self.blocks.get_transaction_count('sh600000', *args),
+                             await self.tables.get_transaction_count('sh600000', *args))
+        for limit in (10, 501, 700):
+            self.assertEqual(await self.blocks.read_transaction('sh600000', limit=limit),
+                             await self._read_tables(limit=limit))
+        # 边界日只有部分成交在时间范围内，需继续读取更早的交易日
+        for start, end, limit in [(None, '2025-01-06 09:31:00', 300), (None, '2025-01-03 09:26', 100),
+                                  ('2025-01-02 14:00', '2025-01-06 09:31:00', 600), (None, '2025-01-06 09:31:00', 2000)]:
+            expected = [r for r in await self._read_tables() if (start is None or r['time'] >= start) and r['time'] <= end]
+            self.assertEqual(await self.blocks.read_transaction('sh600000', start, end, limit), expected[-limit:])
+
+        self.assertEqual(await self.blocks.latest_times(['sh600000', 'sz000001']),
+                         {'sh600000': (await self._read_tables())[-1]['time']})
+        self.assertEqual(await self.blocks.get_earliest_time('sh600000'), '2025-01-02 09:25:00')
+        self.assertEqual(await self.blocks.saved_codes(), [('sh600000', 101)])
+        self.assertEqual(await self.blocks.read_transaction('sz000001'), [])
+
+        arrays = await self.blocks.read_arrays_since({'sh600000': '2025-01-06', 'sz000001': None})
+        self.assertEqual(list(arrays.keys()), ['sh600000'])
+        self.assertEqual(self.blocks.array_to_dicts(arrays['sh600000']), await self._read_tables('2025-01-06'))
+
+    async def test_merge_and_cleanup(self):
+        ticks = self._ticks('2025-01-02')
+        await self.blocks.save_transaction('sh600000', ticks[:300])
+        # 重新拉取时从最后一秒开始，覆盖已保存的最后一秒
+        last = ticks[299]['time']
+        await self.blocks.save_transaction('sh600000', [t for t in ticks if t['time'] >= last])
+        self.assertEqual(await self.blocks.read_transaction('sh600000'), ticks)
+
+        await self.blocks.save_transaction('sh600000', self._ticks('2025-01-03', 100))
+        await self.blocks.save_transaction('sh600000', self._ticks('2025-01-06', 100))
+        self.assertEqual(await self.blocks.cleanup_old_data_by_days('sh600000', max_days=4), len(ticks))
+        self.assertEqual(await self.blocks.get_transaction_count('sh600000'), 202)
+        self.assertEqual(await self.blocks.delete_transaction_data('sh600000'), 202)
+        self.assertEqual(await self.blocks.latest_times(['sh600000']), {})
+
+    async def test_import_from_tables(self):
+        for date in ['2025-01-02', '2025-01-03']:
+            await self.tables.save_transaction('sh600000', self._ticks(date))
+            await self.tables.save_transaction('sz000001', self._ticks(date, 50))
+        self.assertEqual(await self.blocks.import_from(self.tables), 2 * 501 + 2 * 51)
+        self.assertEqual(await self.blocks.read_transaction('sh600000'), await self._read_tables())
+        self.assertEqual(sorted(await self.blocks.saved_codes()), [('sh600000', 101), ('sz000001', 101)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the resumable update journal.
+"""
+
+import os, sys
+sys.path.insert(0, os.path.realpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+
+import unittest
+from unittest.mock import patch
+from base import BaseAsyncTestCase, HistoryDirMixin
+
+
+class TestUpdateJournal(HistoryDirMixin, BaseAsyncTestCase):
+    """Test that interrupted runs continue with the remaining steps and batches."""
+
+    async def _setup_test_data(self):
+        from app.stock.storage.sqlite import UpdateJournalStorage
+        from app.tasks.journal import UpdateJournal
+        self.setup_history_dir()
+        self.storage = UpdateJournalStorage()
+        self.journal_patchers = [patch.object(UpdateJournal, 'storage', self.storage),
+                                 patch.object(UpdateJournal, 'retry_delay', 0)]
+        for p in self.journal_patchers:
+            p.start()
+        self.calls = []
+
+    async def _cleanup_test_data(self):
+        for p in self.journal_patchers:
+            p.stop()
+        await self.dispose_storages(self.storage)
+        self.cleanup_history_dir()
+
+    def _journal(self, date='2025-01-03'):
+        from app.tasks.journal import UpdateJournal
+        return UpdateJournal('nightly', date)
+
+    def _codes(self, n):
+        return [f'sz{i:06d}' for i in range(n)]
+
+    async def test_resume_after_crash(self):
+        codes = self._codes(10)
+
+        async def crash_at_third_batch(batch):
+            self.calls.append(batch)
+            if len(self.calls) == 4:
+                raise KeyboardInterrupt
+            return []
+
+        journal = self._journal()
+        await journal.start()
+        await journal.run_step('index', lambda: self.calls.append('index'))
+        with self.assertRaises(KeyboardInterrupt):
+            await journal.run_batches('klines', codes, crash_at_third_batch, batch_size=3)
+        self.assertTrue(await journal.unfinished())
+
+        # 重启后跳过已完成的步骤和批次，代码列表不再重新获取
+        self.calls = []
+        journal = self._journal()
+        await journal.start()
+        await journal.run_step('index', lambda: self.calls.append('index'))
+
+        async def save(batch):
+            self.calls.append(batch)
+            return []
+        self.assertEqual(await journal.run_batches('klines', lambda: self.fail('codes reloaded'), save), [])
+        self.assertEqual(self.calls, [codes[6:9], codes[9:]])
+        self.assertTrue(await journal.finish())
+        self.assertFalse(await journal.unfinished())
+
+        self.calls = []
+        self.assertEqual(await self._journal().run_batches('klines', codes, save), [])
+        self.assertEqual(self.calls, [])
+
+    async def test_failed_codes_retried_alone(self):
+        codes = self._codes(8)
+        bad = {codes[1]: 2, codes[5]: 9}
+
+        async def flaky(batch):
+            self.calls.append(batch)
+            failed = [c for c in batch if bad.get(c, 0) > 0]
+            for c in failed:
+                bad[c] -= 1
+            return failed
+
+        journal = self._journal()
+        self.assertEqual(await journal.run_batches('klines', codes, flaky, batch_size=4), [codes[5]])
+        self.assertEqual(self.calls, [codes[:4], codes[4:], [codes[1]], [codes[5]], [codes[1]], [codes[5]]])
+        self.assertEqual(journal.failed_steps, ['klines'])
+        self.assertEqual(await journal.step_status('klines'), 'failed')
+
+        # 再次执行只重试仍失败的代码
+        self.calls = []
+        bad[codes[5]] = 0
+        self.assertEqual(await self._journal().run_batches('klines', codes, flaky), [])
+        self.assertEqual(self.calls, [[codes[5]]])
+        rows = await self.storage.read_journal('2025-01-03', 'nightly', 'klines')
+        self.assertEqual(sorted(c for r in rows if r['batch'] > 0 for c in r['codes'].split(',')), codes)
+        self.assertTrue(all(r['status'] == 'done' for r in rows))
+
+    async def test_failed_step_raises_and_reruns(self):
+        journal = self._journal()
+
+        def broken():
+            raise RuntimeError('upstream down')
+        with self.assertRaises(RuntimeError):
+            await journal.run_step('selectors', broken)
+        self.assertEqual(await journal.step_status('selectors'), 'failed')
+        await journal.run_step('selectors', lambda: self.calls.append('selectors'))
+        await journal.run_step('selectors', lambda: self.calls.append('selectors'))
+        self.assertEqual(self.calls, ['selectors'])
+        self.assertIsNone(await self._journal('2025-01-06').step_status('selectors'))
+
+    async def test_failed_catch_up_does_not_stop_today(self):
+        try:
+            from app.tasks.daily_update import DailyUpdater
+        except ImportError:
+            self.skipTest("Daily updater dependencies not available")
+        from datetime import datetime
+        from unittest.mock import AsyncMock
+        evening = self._journal('2025-01-03')
+        evening.task = 'daily_evening'
+        await evening.start()
+
+        async def broken_evening(journal):
+            raise RuntimeError('upstream down')
+        steps = ['download_all_index_history', 'update_new_stocks', 'download_newly_noticed_bonuses',
+                 'update_twice_selectors']
+        patchers = [patch.object(DailyUpdater, s, AsyncMock()) for s in steps] + [
+            patch.object(DailyUpdater, 'update_evening', side_effect=broken_evening),
+            patch('app.tasks.daily_update.datetime', **{'now.return_value': datetime(2025, 1, 6, 9)}),
+            patch('app.stock.date.TradingDate.is_holiday', return_value=False),
+            patch('app.stock.date.TradingDate.max_trading_date', return_value='2025-01-06'),
+            patch('app.stock.date.TradingDate.prev_trading_date', return_value='2025-01-03'),
+        ]
+        for p in patchers:
+            p.start()
+        try:
+            self.assertFalse(await DailyUpdater.update_all())
+            for s in steps:
+                getattr(DailyUpdater, s).assert_awaited_once()
+        finally:
+            for p in reversed(patchers):
+                p.stop()
+        rows = await self.storage.read_journal('2025-01-03', 'daily_evening', '')
+        self.assertEqual((rows[0]['status'], rows[0]['error']), ('failed', 'update_evening'))
+        rows = await self.storage.read_journal('2025-01-06', 'daily_morning', '')
+        self.assertEqual(rows[0]['status'], 'done')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+HDF5存储参数性能测试
+
+用合成数据按每日追加的方式写入各存储，对比不同分块和压缩参数的
+写入耗时、读取最近数据的延迟和文件大小，用于选择各存储的 h5_profile。
+
+使用示例:
+    # 默认参数测试所有存储
+    python tools/bench_h5_profiles.py
+
+    # 只测试分钟K线和成交数据，200只股票，60个交易日
+    python tools/bench_h5_profiles.py --storages kline_1min,trans --codes 200 --days 60
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import h5py
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.stock.storage.h5 import KLineStorage, KLineTsStorage, FflowStorage, TransactionStorage
+
+
+# 名称: (存储类, K线类型, 每日行数)
+STORAGES = {
+    'kline_day': (KLineStorage, 101, 1),
+    'kline_1min': (KLineStorage, 1, 240),
+    'kline_ts': (KLineTsStorage, 101, 1),
+    'fflow': (FflowStorage, 101, 1),
+    'trans': (TransactionStorage, 101, 3000),
+}
+
+PROFILES = {
+    'gzip9': {'chunk_rows': None, 'compression': 'gzip', 'level': 9, 'shuffle': False},
+    'gzip4-shuffle-256': {'chunk_rows': 256, 'compression': 'gzip', 'level': 4, 'shuffle': True},
+    'gzip4-shuffle-4k': {'chunk_rows': 4096, 'compression': 'gzip', 'level': 4, 'shuffle': True},
+    'gzip1-shuffle-1k': {'chunk_rows': 1024, 'compression': 'gzip', 'level': 1, 'shuffle': True},
+    'lzf-shuffle-4k': {'chunk_rows': 4096, 'compression': 'lzf', 'shuffle': True},
+    'lzf-shuffle-16k': {'chunk_rows': 16384, 'compression': 'lzf', 'shuffle': True},
+    'none-4k': {'chunk_rows': 4096, 'compression': None, 'shuffle': False},
+}
+
+
+def synthetic_days(storage, per_day, ndays, rng, start_day=0):
+    """生成ndays个交易日的整数化数据，每日per_day行"""
+    n = ndays * per_day
+    data = np.zeros(n, dtype=list(storage.saved_dtype.items()))
+    days = (np.datetime64('2020-01-02') + np.arange(start_day, start_day + ndays)).astype('datetime64[D]')
+    ymd = np.char.replace(days.astype('U10'), '-', '').astype(np.int64).repeat(per_day)
+    if per_day > 1:
+        minute = np.arange(per_day) * 240 // per_day
+        hhmm = np.where(minute < 120, 930 + minute // 60 * 100 + minute % 60 + 1,
+                        1300 + (minute - 120) // 60 * 100 + (minute - 120) % 60 + 1)
+        data['time'] = ymd * 1000000 + np.tile(hhmm, ndays) * 100
+    else:
+        data['time'] = ymd * 1000000
+    for col, dtype in storage.saved_dtype.items():
+        if col == 'time':
+            continue
+        if col in storage.price_cols:
+            data[col] = 100000 + np.cumsum(rng.integers(-30, 31, n))
+        elif col == 'bs':
+            data[col] = rng.choice([1, 2], n)
+        else:
+            data[col] = rng.lognormal(8, 1.5, n).astype(np.int64)
+    return data
+
+
+def bench_one(workdir, name, profile_name, profile, codes, days, history, tail):
+    storage, kline_type, per_day = STORAGES[name]
+    bench_storage = type(f'Bench{storage.__name__}', (storage,), {'profile': classmethod(lambda cls, kt=101: profile)})
+    rng = np.random.default_rng(0)
+    path = os.path.join(workdir, f'{name}_{profile_name}.h5')
+
+    wtime = 0
+    with h5py.File(path, 'w') as f:
+        grp = f.require_group('data')
+        initial = {c: synthetic_days(storage, per_day, history, rng) for c in range(codes)}
+        stime = time.perf_counter()
+        for c, data in initial.items():
+            bench_storage._append_dataset(grp, f'c{c}', data, kline_type)
+        wtime += time.perf_counter() - stime
+        for d in range(days):
+            daily = {c: synthetic_days(storage, per_day, 1, rng, history + d) for c in range(codes)}
+            stime = time.perf_counter()
+            for c, data in daily.items():
+                bench_storage._append_dataset(grp, f'c{c}', data, kline_type)
+            wtime += time.perf_counter() - stime
+
+    stime = time.perf_counter()
+    with h5py.File(path, 'r') as f:
+        for c in range(codes):
+            f['data'][f'c{c}'][-tail * per_day:]
+    rtime = (time.perf_counter() - stime) / codes
+    return wtime, rtime, os.path.getsize(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HDF5分块和压缩参数性能测试')
+    parser.add_argument('--storages', type=str, default=','.join(STORAGES), help='存储名称，逗号分隔')
+    parser.add_argument('--profiles', type=str, default=','.join(PROFILES), help='参数名称，逗号分隔')
+    parser.add_argument('--codes', type=int, default=100, help='股票数量')
+    parser.add_argument('--history', type=int, default=250, help='初始写入的交易日数')
+    parser.add_argument('--days', type=int, default=20, help='逐日追加的交易日数')
+    parser.add_argument('--tail', type=int, default=5, help='读取最近多少个交易日的数据')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_h5_')
+    try:
+        for name in args.storages.split(','):
+            storage, kline_type, per_day = STORAGES[name]
+            print(f"\n{name} ({storage.__name__}, 当前参数 {storage.profile(kline_type)})")
+            print(f"  {args.codes}只股票, 初始{args.history}天, 逐日追加{args.days}天, 每日{per_day}行")
+            print(f"  {'参数':<20}{'写入(s)':>10}{'读取最近(ms)':>14}{'文件(MB)':>10}")
+            for pname in args.profiles.split(','):
+                wtime, rtime, size = bench_one(workdir, name, pname, PROFILES[pname], args.codes, args.days,
+                                               args.history, args.tail)
+                print(f"  {pname:<20}{wtime:>10.2f}{rtime * 1000:>14.3f}{size / 1024 / 1024:>10.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+SQLite连接参数性能测试
+
+一个连接按批次持续批量写入(模拟夜间K线/成交数据写入)，同时另一个连接反复读取单只股票最近的数据
+(模拟API查询)，对比不同PRAGMA参数下的写入耗时和读取延迟。
+
+使用示例:
+    # 默认参数测试所有配置
+    python tools/bench_sqlite_pragmas.py
+
+    # 500只股票，写入40批，每批20000行
+    python tools/bench_sqlite_pragmas.py --codes 500 --batches 40 --batch-rows 20000
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.lofig import Config
+from app.db import set_sqlite_pragmas
+
+
+# 名称: PRAGMA参数, None为当前配置Config.sqlite_pragmas()
+PROFILES = {
+    'legacy': {},
+    'wal': {'journal_mode': 'WAL'},
+    'wal-normal': {'journal_mode': 'WAL', 'synchronous': 'NORMAL'},
+    'config': None,
+}
+
+
+def create_engine_for(db_path, pragmas):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}", echo=False,
+                                 connect_args={"check_same_thread": False, "timeout": 20})
+    return set_sqlite_pragmas(engine, pragmas)
+
+
+def synthetic_rows(codes, start_day, ndays):
+    """每只股票ndays个交易日的日K线"""
+    rows = []
+    for d in range(start_day, start_day + ndays):
+        day = str(np.datetime64('2000-01-03') + d)
+        for code in codes:
+            rows.append({'code': code, 'time': day, 'close': 10.0 + d % 7, 'volume': 1000 + d})
+    return rows
+
+
+async def seed(engine, codes, history):
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE klines (code TEXT, time TEXT, close REAL, volume INTEGER, PRIMARY KEY (code, time))"))
+        await conn.execute(text("INSERT INTO klines VALUES (:code, :time, :close, :volume)"),
+                           synthetic_rows(codes, 0, history))
+
+
+async def bulk_write(db_path, pragmas, codes, history, batches, batch_rows):
+    """按批次写入，每批一个事务"""
+    engine = create_engine_for(db_path, pragmas)
+    days = max(1, batch_rows // len(codes))
+    start = time.perf_counter()
+    try:
+        for i in range(batches):
+            rows = synthetic_rows(codes, history + i * days, days)
+            async with engine.begin() as conn:
+                await conn.execute(text("INSERT INTO klines VALUES (:code, :time, :close, :volume)"), rows)
+    finally:
+        await engine.dispose()
+    return time.perf_counter() - start
+
+
+async def read_loop(engine, codes, stop, limit):
+    """反复读取随机股票最近limit条数据，返回每次读取的耗时"""
+    rnd = random.Random(1)
+    latencies = []
+    while not stop.is_set():
+        start = time.perf_counter()
+        async with engine.connect() as conn:
+            result = await conn.execute(text(
+                "SELECT time, close, volume FROM klines WHERE code = :code ORDER BY time DESC LIMIT :limit"),
+                {'code': rnd.choice(codes), 'limit': limit})
+            result.all()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0)
+    return latencies
+
+
+async def bench_one(workdir, name, pragmas, ncodes, history, batches, batch_rows, limit):
+    db_path = os.path.join(workdir, f'{name}.db')
+    codes = [f'sz{i:06d}' for i in range(ncodes)]
+    reader = create_engine_for(db_path, pragmas)
+    try:
+        await seed(reader, codes, history)
+        stop = asyncio.Event()
+        reads = asyncio.create_task(read_loop(reader, codes, stop, limit))
+        # 写入在另一个线程的事件循环中执行，不占用读取所在的事件循环
+        wtime = await asyncio.to_thread(
+            asyncio.run, bulk_write(db_path, pragmas, codes, history, batches, batch_rows))
+        stop.set()
+        latencies = np.array(await reads) * 1000
+    finally:
+        await reader.dispose()
+    return wtime, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite连接参数性能测试')
+    parser.add_argument('--profiles', type=str, default=','.join(PROFILES), help='参数名称，逗号分隔')
+    parser.add_argument('--codes', type=int, default=200, help='股票数量')
+    parser.add_argument('--history', type=int, default=250, help='初始写入的交易日数')
+    parser.add_argument('--batches', type=int, default=20, help='写入批次数')
+    parser.add_argument('--batch-rows', type=int, default=10000, help='每批写入行数')
+    parser.add_argument('--limit', type=int, default=60, help='每次读取的行数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_sqlite_')
+    try:
+        print(f"{args.codes}只股票, 初始{args.history}天, 写入{args.batches}批, 每批{args.batch_rows}行")
+        print(f"  {'参数':<14}{'写入(s)':>10}{'读取次数':>10}{'p50(ms)':>10}{'p99(ms)':>10}{'最大(ms)':>10}")
+        for pname in args.profiles.split(','):
+            pragmas = PROFILES[pname]
+            if pragmas is None:
+                pragmas = Config.sqlite_pragmas()
+            wtime, lat = asyncio.run(bench_one(workdir, pname, pragmas, args.codes, args.history, args.batches,
+                                               args.batch_rows, args.limit))
+            if len(lat) == 0:
+                lat = np.zeros(1)
+            print(f"  {pname:<14}{wtime:>10.2f}{len(lat):>10}{np.percentile(lat, 50):>10.2f}"
+                  f"{np.percentile(lat, 99):>10.2f}{lat.max():>10.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
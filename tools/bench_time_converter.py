@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+时间转换性能测试
+
+对比 TimeConverter 逐个用datetime转换与向量化转换的耗时。
+
+使用示例:
+    # 默认30万条1分钟K线时间
+    python tools/bench_time_converter.py
+
+    # 指定条数和重复次数
+    python tools/bench_time_converter.py --rows 1000000 --repeat 5
+"""
+
+import argparse
+import sys
+import os
+import time
+import numpy as np
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.stock.storage.h5 import TimeConverter
+
+
+def minute_times(rows):
+    """生成rows条交易时段内的1分钟K线时间(int)"""
+    minutes = np.concatenate([np.arange(9 * 60 + 31, 11 * 60 + 31), np.arange(13 * 60 + 1, 15 * 60 + 1)])
+    days = np.arange(rows // len(minutes) + 1).astype('timedelta64[D]') + np.datetime64('2015-01-05')
+    dts = (days.astype('datetime64[m]')[:, None] + minutes.astype('timedelta64[m]')).ravel()[:rows]
+    return TimeConverter.datetime64_to_int(dts)
+
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        stime = time.perf_counter()
+        func()
+        cost = time.perf_counter() - stime
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+def bench(rows=300000, repeat=3):
+    conv = TimeConverter()
+    ints = minute_times(rows)
+    strs = conv.int_to_time(ints)
+    assert (conv._int_to_time_slow(ints) == strs).all()
+    assert (conv._time_to_int_slow(strs) == ints).all()
+
+    cases = [
+        ('int -> str', lambda: conv._int_to_time_slow(ints), lambda: conv.int_to_time(ints)),
+        ('str -> int', lambda: conv._time_to_int_slow(strs), lambda: conv.time_to_int(strs)),
+        ('int -> date', lambda: conv._int_to_time_slow(ints, True), lambda: conv.int_to_date(ints)),
+        ('str -> date', lambda: np.vectorize(lambda x: x.split(' ')[0])(strs), lambda: conv.date_part(strs)),
+        ('int -> datetime64', None, lambda: conv.int_to_datetime64(ints)),
+    ]
+    print(f"{rows} 条时间, 取 {repeat} 次最短耗时")
+    print(f"{'转换':<20}{'逐个转换(s)':>14}{'向量化(s)':>14}{'加速比':>10}")
+    for name, slow, fast in cases:
+        tfast = timeit(fast, repeat)
+        if slow is None:
+            print(f"{name:<20}{'-':>14}{tfast:>14.4f}{'-':>10}")
+            continue
+        tslow = timeit(slow, repeat)
+        print(f"{name:<20}{tslow:>14.4f}{tfast:>14.4f}{tslow / tfast:>9.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='TimeConverter 转换性能测试')
+    parser.add_argument('--rows', type=int, default=300000, help='时间条数')
+    parser.add_argument('--repeat', type=int, default=3, help='重复次数')
+    args = parser.parse_args()
+    bench(args.rows, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+K线列式归档构建工具
+
+从H5或SQLite增量构建 {history_dir}/archive/{kline_type}/ 下的列式归档，
+归档可用 KLineArchive 按np.memmap零拷贝读取，用于长周期回测和全市场扫描。
+
+使用示例:
+    # 从H5构建日线归档
+    python tools/build_kline_archive.py
+
+    # 从SQLite分区存储构建日线和周线归档，完成后整理为每只股票一个数据段
+    python tools/build_kline_archive.py --source sqlite --kline-types 101,102 --compact
+"""
+
+import argparse
+import asyncio
+import sys
+import os
+import time
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.stock.storage.archive import KLineArchive
+from app.stock.storage.sqlite import create_kline_storage
+
+
+async def build(kline_types, source='h5', compact=False):
+    sqlite_storage = create_kline_storage() if source == 'sqlite' else None
+    for kline_type in kline_types:
+        archive = KLineArchive(kline_type)
+        stime = time.time()
+        if source == 'sqlite':
+            added = await archive.build_from_sqlite(sqlite_storage)
+        else:
+            added = archive.build_from_h5()
+        print(f"{kline_type}: 追加 {added} 条记录, 共 {archive.nrows} 条 {len(archive.codes())} 只股票, "
+              f"耗时 {time.time() - stime:.1f}s")
+        if compact:
+            stime = time.time()
+            archive.compact()
+            print(f"{kline_type}: 整理完成, 耗时 {time.time() - stime:.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从H5或SQLite增量构建K线列式归档')
+    parser.add_argument('--source', choices=['h5', 'sqlite'], default='h5', help='数据来源')
+    parser.add_argument('--kline-types', type=str, default='101', help='K线类型，逗号分隔')
+    parser.add_argument('--compact', action='store_true', help='构建后整理为每只股票一个数据段')
+    args = parser.parse_args()
+    asyncio.run(build([int(t) for t in args.kline_types.split(',')], args.source, args.compact))
+
+
+if __name__ == '__main__':
+    main()
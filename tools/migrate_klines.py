@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+K线存储迁移工具
+
+将 klines.db 中每只股票每种K线一张表(klines_{code}_{kltype})的数据迁移到
+klines_part.db 中按K线类型分区的表(klines_{kltype}, 主键(code, time))。
+迁移完成后在 config.json 的 client 中设置 "kline_storage": "partitioned" 启用新存储。
+
+使用示例:
+    # 迁移全部K线数据
+    python tools/migrate_klines.py
+
+    # 只迁移日线和周线，每500张表提交一次
+    python tools/migrate_klines.py --kline-types 101,102 --batch-size 500
+
+    # 只统计需要迁移的表，不写入
+    python tools/migrate_klines.py --dry-run
+"""
+
+import argparse
+import asyncio
+import sqlite3
+import sys
+import os
+import time
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.lofig import logger
+from app.stock.storage.sqlite import KLineSQLiteStorage, KLinePartitionedStorage
+from app.stock.storage.models import create_watermark_table
+
+
+def legacy_tables(conn, kline_types):
+    """列出源库中需要迁移的K线表 [(表名, 股票代码, K线类型)]"""
+    rows = conn.execute("SELECT name FROM src.sqlite_master WHERE type='table' AND name LIKE 'klines%'").fetchall()
+    tables = []
+    for name, in rows:
+        parts = name.split('_')
+        if len(parts) != 3 or not parts[2].isdigit():
+            continue
+        if int(parts[2]) in kline_types:
+            tables.append((name, parts[1], int(parts[2])))
+    return tables
+
+
+def migrate(kline_types=None, batch_size=200, dry_run=False):
+    src = KLineSQLiteStorage()
+    dst = KLinePartitionedStorage()
+    if kline_types is None:
+        kline_types = dst.saved_kline_types
+
+    if not os.path.isfile(src.db_path):
+        print(f"源数据库不存在: {src.db_path}")
+        return 0
+
+    dst.ensure_tables()
+    columns = ', '.join(dst.saved_dtype.keys())
+
+    conn = sqlite3.connect(dst.db_path)
+    conn.execute("ATTACH DATABASE ? AS src", (src.db_path,))
+    tables = legacy_tables(conn, kline_types)
+    print(f"共 {len(tables)} 张表需要迁移: {src.db_path} -> {dst.db_path}")
+    if dry_run:
+        conn.close()
+        return 0
+
+    total = 0
+    stime = time.time()
+    try:
+        for i, (tbl, code, kltype) in enumerate(tables, 1):
+            cur = conn.execute(
+                f'INSERT OR REPLACE INTO main.klines_{kltype} (code, {columns}) SELECT ?, {columns} FROM src."{tbl}"',
+                (code,))
+            total += cur.rowcount
+            if i % batch_size == 0:
+                conn.commit()
+                print(f"  {i}/{len(tables)} 张表, {total} 条记录, 耗时 {time.time() - stime:.1f}s")
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"K线迁移失败: {e}")
+        raise
+    finally:
+        conn.close()
+
+    # 迁移绕过了insert_data，需要重建水位表
+    create_watermark_table().create(dst.sync_engine, checkfirst=True)
+    asyncio.run(dst.rebuild_watermarks())
+
+    print(f"迁移完成: {len(tables)} 张表, {total} 条记录, 耗时 {time.time() - stime:.1f}s")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='K线数据从单表存储迁移到分区存储')
+    parser.add_argument('--kline-types', type=str, help='K线类型，逗号分隔，默认全部')
+    parser.add_argument('--batch-size', type=int, default=200, help='每迁移多少张表提交一次')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要迁移的表')
+    args = parser.parse_args()
+
+    kline_types = None
+    if args.kline_types:
+        kline_types = [int(t) for t in args.kline_types.split(',')]
+    migrate(kline_types, args.batch_size, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
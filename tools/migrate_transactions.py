@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+交易数据存储迁移工具
+
+将 trans.db 中每只股票一张表、逐笔一行(trans_{code})的交易数据迁移到
+trans_blocks.db 中按(股票代码, 交易日)压缩分块的表(trans_blocks)。
+迁移完成后在 config.json 的 client 中设置 "transaction_storage": "blocks" 启用新存储。
+
+使用示例:
+    # 迁移全部交易数据
+    python tools/migrate_transactions.py
+
+    # 只迁移指定股票
+    python tools/migrate_transactions.py --codes sh600000,sz000001
+
+    # 只统计需要迁移的股票，不写入
+    python tools/migrate_transactions.py --dry-run
+"""
+
+import argparse
+import asyncio
+import sys
+import os
+import time
+
+# 添加项目根目录到Python路径
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.stock.storage.sqlite import TransactionSQLiteStorage, TransactionBlockStorage
+
+
+async def migrate(codes=None, batch_size=100, dry_run=False):
+    src = TransactionSQLiteStorage()
+    dst = TransactionBlockStorage()
+    if not os.path.isfile(src.db_path):
+        print(f"源数据库不存在: {src.db_path}")
+        return 0
+
+    if codes is None:
+        codes = [c for c, _ in await src.saved_codes()]
+    print(f"共 {len(codes)} 只股票需要迁移: {src.db_path} -> {dst.db_path}")
+    if dry_run:
+        return 0
+
+    stime = time.time()
+    total = await dst.import_from(src, codes, batch_size)
+    await dst.vacuum()
+    print(f"迁移完成: {len(codes)} 只股票, {total} 条记录, 耗时 {time.time() - stime:.1f}s, "
+          f"{os.path.getsize(src.db_path) / 2**20:.1f}MB -> {os.path.getsize(dst.db_path) / 2**20:.1f}MB")
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='交易数据从逐笔分表存储迁移到按交易日压缩分块存储')
+    parser.add_argument('--codes', type=str, help='股票代码，逗号分隔，默认全部')
+    parser.add_argument('--batch-size', type=int, default=100, help='每批读取的股票数')
+    parser.add_argument('--dry-run', action='store_true', help='只统计需要迁移的股票')
+    args = parser.parse_args()
+
+    codes = args.codes.split(',') if args.codes else None
+    asyncio.run(migrate(codes, args.batch_size, args.dry_run))
+
+
+if __name__ == '__main__':
+    main()